@@ -1,13 +1,17 @@
 # compare.py
 
 # standard libraries
-import logging, re
-from typing import Callable, Optional, Sequence
+import logging, math, re, threading
+from collections import Counter
+from typing import Callable, Dict, MutableMapping, Optional, Sequence
 
 # third-party libraries
 import pandas as pd
 from fuzzywuzzy import fuzz
 
+# local libraries
+from metrics import REGISTRY
+
 
 # Initializing settings and global variables
 
@@ -23,6 +27,7 @@ PAREN_PATTERN = re.compile(r'[\(\)]')
 PAREN_CONTENT_PATTERN = re.compile(r'\(([^\(]+)\)')
 
 ISBN_PATTERN = re.compile(r'[0-9]')
+NON_ISBN_CHAR_PATTERN = re.compile(r'[^0-9X]')
 
 # Publisher patterns
 UP_PATTERN = re.compile(r'\bup\b')
@@ -47,13 +52,13 @@ def tokenize(input: str) -> Sequence[str]:
 
 def normalize(input: str) -> str:
     normalized_str = AMP_PATTERN.sub('and', PUNC_PATTERN.sub('', input)).lower()
-    logger.debug(f'normalize: {input} -> {normalized_str}')
+    logger.debug('normalize: %s -> %s', input, normalized_str)
     return normalized_str
 
 
 def normalize_univ(input: str) -> str:
     norm_input = UNIV_PATTERN.sub('university', UOF_PATTERN.sub('university of', UP_PATTERN.sub('university press', input)))
-    logger.debug(f'normalize_univ: {input} -> {norm_input}')
+    logger.debug('normalize_univ: %s -> %s', input, norm_input)
     return norm_input
 
 
@@ -61,11 +66,26 @@ def polish_isbn(input: str) -> str:
     return input.split()[0]
 
 
+# The ISBN-13 form of an ISBN-10 or ISBN-13 cell (ignoring hyphens and trailing qualifiers), so the two forms
+# of one ISBN compare equal; None if the cell does not hold one
+def canonicalize_isbn(input: str) -> Optional[str]:
+    if not input.strip():
+        return None
+    isbn = NON_ISBN_CHAR_PATTERN.sub('', polish_isbn(input).upper())
+    if len(isbn) == 10 and isbn[:9].isdigit():
+        isbn = '978' + isbn[:9]
+        check_sum = sum(int(digit) * (1 if pos % 2 == 0 else 3) for pos, digit in enumerate(isbn))
+        return isbn + str((10 - check_sum % 10) % 10)
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn
+    return None
+
+
 # Extract extra or parenthetical content from a cell (used on ISBN a)
 def extract_extra_atoms(input: str) -> Optional[str]:
     if PAREN_CONTENT_PATTERN.match(input):
         groups = PAREN_CONTENT_PATTERN.match(input).groups()
-        logger.info(f'extract_extra_atoms: {groups}')
+        logger.debug('extract_extra_atoms: %s', groups)
         if len(groups) > 1:
             logger.warning('Multiple parenthetical expressions found.')
             return ' '.join(groups)
@@ -103,44 +123,166 @@ def classify_by_format(field_to_analyze: str) -> str:
     return format
 
 
+# Counts of comparisons made by compare functions, and of how many expensive scores were skipped. Each call
+# counts into its own Counter and merges it here under the lock, since matching runs on several threads.
+COMPARISON_STATS = Counter()
+COMPARISON_STATS_LOCK = threading.Lock()
+
+
+def merge_comparison_stats(call_stats: Counter) -> None:
+    with COMPARISON_STATS_LOCK:
+        COMPARISON_STATS.update(call_stats)
+
+
+# The total is its own series, so summing the outcome series (which overlap) never double counts it
+def collect_comparison_stats() -> Dict:
+    with COMPARISON_STATS_LOCK:
+        stats = dict(COMPARISON_STATS)
+    return {
+        'comparisons_total': {(): stats.get('comparisons', 0)},
+        'comparison_outcomes_total': {
+            (('outcome', outcome),): count for outcome, count in stats.items() if outcome != 'comparisons'
+        }
+    }
+
+
+REGISTRY.register_collector(collect_comparison_stats)
+
+
+# Smallest Levenshtein ratio (0-1) that fuzzywuzzy rounds to a score meeting the threshold, less a little
+# slack for floating point differences, so bounds below it can never produce a passing score
+def create_min_ratio(thresh: float) -> float:
+    return (math.ceil(thresh) - 0.5) / 100 - 1e-9
+
+
+# Number of characters two strings have in common, ignoring order; bounds their longest common subsequence
+def count_char_overlap(left_counts: Counter, right_counts: Counter) -> int:
+    if len(left_counts) > len(right_counts):
+        left_counts, right_counts = right_counts, left_counts
+    return sum(min(count, right_counts[char]) for char, count in left_counts.items())
+
+
+# Upper bound for fuzz.ratio, which is 2 * (matching characters) / (total length)
+def bound_full_ratio(left_len: int, right_len: int, overlap: int) -> float:
+    return 2 * overlap / (left_len + right_len)
+
+
+# Upper bound for fuzz.partial_ratio, which scores the shorter string against windows of the longer one
+# no longer than itself: 2 * M / (shorter + window) <= 2 * M / (shorter + M), with M <= overlap
+def bound_partial_ratio(left_len: int, right_len: int, overlap: int) -> float:
+    return 2 * overlap / (min(left_len, right_len) + overlap)
+
+
 # Create a comparison function for mapping along columns that finds the Levenshtein Difference between a 
-# a column value (right) and one or more given values from the HEB record (lefts)
-def create_compare_func(lefts: Sequence[str], thresh: float, transforms: Sequence[Callable] = []) -> Callable:
+# a column value (right) and one or more given values from the HEB record (lefts); pairs that cannot reach
+# the threshold (judged by length and character counts) are rejected without scoring when prune is True.
+# When decisions (a mapping like publisher_authority.PublisherAuthority) is given, the outcome for each pair
+# of normalized strings is looked up there first and stored there after scoring.
+def create_compare_func(
+    lefts: Sequence[str],
+    thresh: float,
+    transforms: Sequence[Callable] = [],
+    prune: bool = True,
+    decisions: Optional[MutableMapping] = None
+) -> Callable:
     left_dicts = []
     for left in lefts:
         left_tokens = tokenize(left)
         norm_left = normalize(left)
         for transform in transforms:
             norm_left = transform(norm_left)
-        left_dicts.append({'orig_left': left, 'left_tokens': left_tokens, 'norm_left': norm_left})
+        left_dicts.append({
+            'orig_left': left,
+            'left_tokens': left_tokens,
+            'norm_left': norm_left,
+            'left_counts': Counter(norm_left)
+        })
+    min_ratio = create_min_ratio(thresh)
 
     def compare_func(right: str) -> bool:
         norm_right = normalize(right)
         for transform in transforms:
             norm_right = transform(norm_right)
+        right_tokens = tokenize(right)
+        right_counts = None
+        call_stats = Counter()
 
-        for left_dict in left_dicts:
+        def compare_to_left(left_dict: Dict) -> bool:
+            nonlocal right_counts
+            call_stats['comparisons'] += 1
             one_norm_left = left_dict['norm_left']
-            full_lev_ratio = fuzz.ratio(one_norm_left, norm_right)
-            logger.debug(full_lev_ratio)
-            if full_lev_ratio >= thresh:
-                logger.debug(f'The full Levenstein distance ratio of {full_lev_ratio} met the {thresh} threshold.')
-                logger.debug(f'{one_norm_left} ~ {norm_right}')
-                return True
+            overlap = None
+
+            # Identical strings score 100 on both ratios
+            if prune and one_norm_left == norm_right:
+                call_stats['exact_matches'] += 1
+                if 100 >= thresh:
+                    return True
+
+            left_len = len(one_norm_left)
+            right_len = len(norm_right)
+            full_prunable = False
+            if prune and left_len + right_len > 0:
+                if bound_full_ratio(left_len, right_len, min(left_len, right_len)) < min_ratio:
+                    full_prunable = True
+                else:
+                    right_counts = right_counts if right_counts is not None else Counter(norm_right)
+                    overlap = count_char_overlap(left_dict['left_counts'], right_counts)
+                    full_prunable = bound_full_ratio(left_len, right_len, overlap) < min_ratio
+
+            if full_prunable:
+                call_stats['full_ratios_pruned'] += 1
+            else:
+                call_stats['full_ratios_scored'] += 1
+                full_lev_ratio = fuzz.ratio(one_norm_left, norm_right)
+                if full_lev_ratio >= thresh:
+                    logger.debug(
+                        'The full Levenstein distance ratio of %s met the %s threshold: %s ~ %s',
+                        full_lev_ratio, thresh, one_norm_left, norm_right
+                    )
+                    return True
 
             # This won't catch one word publishers (e.g. Holt) if the alternative representation has multiple words
-            right_tokens = tokenize(right)
-            token_diff = abs(len(left_dict['left_tokens']) - len(right_tokens))
-            logger.debug(token_diff)
-            if token_diff < 3 and len(left) > 4:
+            if allows_partial(left_dict):
+                if prune and left_len > 0 and right_len > 0:
+                    if overlap is None:
+                        right_counts = right_counts if right_counts is not None else Counter(norm_right)
+                        overlap = count_char_overlap(left_dict['left_counts'], right_counts)
+                    if bound_partial_ratio(left_len, right_len, overlap) < min_ratio:
+                        call_stats['partial_ratios_pruned'] += 1
+                        return False
+                call_stats['partial_ratios_scored'] += 1
                 partial_lev_ratio = fuzz.partial_ratio(one_norm_left, norm_right)
-                logger.debug(partial_lev_ratio)
                 if partial_lev_ratio >= thresh:
-                    logger.warning(f'The partial Levenstein distance ratio of {partial_lev_ratio} met the {thresh} threshold.')
-                    logger.warning(f'{one_norm_left} ~ {norm_right}')
+                    logger.debug(
+                        'The partial Levenstein distance ratio of %s met the %s threshold: %s ~ %s',
+                        partial_lev_ratio, thresh, one_norm_left, norm_right
+                    )
                     return True
-            
-        logger.debug(f'No Levenstein distance ratios met the {thresh} threshold.')
-        return False
+            return False
+
+        def allows_partial(left_dict: Dict) -> bool:
+            token_diff = abs(len(left_dict['left_tokens']) - len(right_tokens))
+            return token_diff < 3 and len(left) > 4
+
+        matched = False
+        for left_dict in left_dicts:
+            if decisions is None:
+                matched = compare_to_left(left_dict)
+            else:
+                # The outcome also depends on whether the partial ratio is tried, so that is part of the key
+                decision_key = (left_dict['norm_left'], norm_right, thresh, allows_partial(left_dict))
+                matched = decisions.get(decision_key)
+                if matched is None:
+                    matched = compare_to_left(left_dict)
+                    decisions[decision_key] = matched
+                else:
+                    call_stats['decisions_reused'] += 1
+            if matched:
+                break
+        else:
+            logger.debug('No Levenstein distance ratios met the %s threshold.', thresh)
+        merge_comparison_stats(call_stats)
+        return matched
 
     return compare_func
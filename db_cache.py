@@ -1,7 +1,7 @@
 # standard libraries
-import logging, json, os
+import argparse, logging, json, os, time
 from datetime import datetime
-from typing import Dict
+from typing import Any, Dict, Optional, Tuple
 
 # third-party libraries
 import pandas as pd
@@ -9,10 +9,20 @@ import requests
 from diskcache import Cache
 # from sqlalchemy import create_engine
 
+# local libraries
+from metrics import REGISTRY
+from quota import is_budgeted, DAILY_BUDGET_REF
+from rate_limit import compute_backoff, \
+                       get_bucket, \
+                       parse_retry_after, \
+                       MAX_RETRIES, \
+                       RETRY_STATUS_CODES, \
+                       THROTTLE_STATUS_CODES
+
 
 # Initializing settings and global variables
 
-# logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 try:
     with open(os.path.join('config', 'env.json')) as env_file:
@@ -24,11 +34,22 @@ DB_CACHE_PATH_ELEMS = ENV['DB_CACHE_PATH']
 DB_CACHE_PATH_STR = '/'.join(DB_CACHE_PATH_ELEMS)
 # ENGINE = create_engine(f'sqlite:///{DB_CACHE_PATH_STR}')
 
+CACHE_OPTS = ENV.get('CACHE', {})
+# Cached responses older than this are revalidated before use; None keeps them forever
+MAX_AGE_DAYS = CACHE_OPTS.get('MAX_AGE_DAYS', None)
+MAX_AGE_SECONDS = MAX_AGE_DAYS * 24 * 60 * 60 if MAX_AGE_DAYS is not None else None
+
+PRIVATE_KEYS = ['wskey']
+# Private parameters are not stored with cache entries, so a refresh adds them back by endpoint
+PRIVATE_PARAMS = {}
+if 'WORLDCAT' in ENV:
+    PRIVATE_PARAMS[ENV['WORLDCAT']['BIB_RESOURCE_BASE_URL']] = {'wskey': ENV['WORLDCAT']['WC_SEARCH_API_KEY']}
+
 
 # Functions - Caching
 
 # Create unique request string for WorldCat Search API caching
-def create_unique_request_str(base_url: str, params_dict: Dict[str, str], private_keys: list = ["wskey"]) -> str:
+def create_unique_request_str(base_url: str, params_dict: Dict[str, str], private_keys: list = PRIVATE_KEYS) -> str:
     sorted_params = sorted(params_dict.keys())
     fields = []
     for param in sorted_params:
@@ -37,49 +58,191 @@ def create_unique_request_str(base_url: str, params_dict: Dict[str, str], privat
     return base_url + '&'.join(fields)
 
 
+# Cache entries hold the response text with its fetch time and validators, and the request (less private
+# parameters) so it can be revalidated later
+def create_cache_entry(url: str, params: Dict[str, str], response_obj: requests.Response) -> Dict[str, Any]:
+    return {
+        'text': response_obj.text,
+        'fetched_at': time.time(),
+        'etag': response_obj.headers.get('ETag'),
+        'last_modified': response_obj.headers.get('Last-Modified'),
+        'url': url,
+        'params': {key: value for key, value in params.items() if key not in PRIVATE_KEYS}
+    }
+
+
+# Entries written before fetch times were kept are plain response strings, of unknown age
+def read_cache_entry(value: Any) -> Dict[str, Any]:
+    if isinstance(value, str):
+        return {'text': value, 'fetched_at': None, 'etag': None, 'last_modified': None}
+    return value
+
+
+def get_cached_text(value: Any) -> str:
+    return read_cache_entry(value)['text']
+
+
+def is_stale(entry: Dict[str, Any], now: Optional[float] = None) -> bool:
+    if MAX_AGE_SECONDS is None:
+        return False
+    if entry['fetched_at'] is None:
+        return True
+    return (now if now is not None else time.time()) - entry['fetched_at'] > MAX_AGE_SECONDS
+
+
+def create_conditional_headers(entry: Dict[str, Any]) -> Dict[str, str]:
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+# Revalidate a stale entry with a conditional request, returning the entry to keep and whether its response
+# changed; an unchanged (304) response only renews the fetch time, and a failed one keeps the stale entry
+def revalidate_entry(url: str, params: Dict[str, str], entry: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    response_obj = make_request_with_retries(url, params, create_conditional_headers(entry))
+    if response_obj.status_code == 304:
+        REGISTRY.inc('cache_revalidations_total', result='not_modified')
+        renewed_entry = {**entry, 'fetched_at': time.time()}
+        renewed_entry.setdefault('url', url)
+        renewed_entry.setdefault('params', {key: value for key, value in params.items() if key not in PRIVATE_KEYS})
+        return renewed_entry, False
+    if response_obj.status_code != 200:
+        REGISTRY.inc('cache_revalidations_total', result='failed')
+        logger.warning(f'Could not revalidate cached response (status code {response_obj.status_code}); keeping it')
+        return entry, False
+    new_entry = create_cache_entry(url, params, response_obj)
+    changed = new_entry['text'] != entry['text']
+    REGISTRY.inc('cache_revalidations_total', result='changed' if changed else 'unchanged')
+    return new_entry, changed
+
+
+# Raised when a request still fails with a retryable status (or connection error) after all retries,
+# so callers can tell a transient failure apart from a search with no results
+class TransientRequestError(Exception):
+    pass
+
+
+# Raised when an endpoint's daily request quota is used up; the request can be made in the next window
+class QuotaExceededError(TransientRequestError):
+    pass
+
+
+# Make the request, retrying transient failures with backoff under the endpoint's rate limit
+def make_request_with_retries(url: str, params: Dict[str, str], headers: Optional[Dict[str, str]] = None) -> requests.Response:
+    bucket = get_bucket(url)
+    attempt = 0
+    while True:
+        if is_budgeted(url) and not DAILY_BUDGET_REF.spend(url):
+            raise QuotaExceededError(f'The daily request budget for {url} is used up')
+        bucket.acquire()
+        REGISTRY.inc('requests_total', endpoint=url)
+        start = time.monotonic()
+        try:
+            response_obj = requests.get(url, params, headers=headers)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            REGISTRY.inc('http_responses_total', endpoint=url, status='error')
+            status_desc = type(error).__name__
+            retry_after = None
+        else:
+            status_code = response_obj.status_code
+            REGISTRY.observe('request_latency_seconds', time.monotonic() - start, endpoint=url)
+            REGISTRY.inc('http_responses_total', endpoint=url, status=status_code)
+            if status_code not in RETRY_STATUS_CODES:
+                bucket.speed_up()
+                return response_obj
+            status_desc = f'status code {status_code}'
+            retry_after = parse_retry_after(response_obj.headers.get('Retry-After'))
+            if status_code in THROTTLE_STATUS_CODES:
+                bucket.slow_down()
+
+        if attempt >= MAX_RETRIES:
+            if is_budgeted(url) and status_desc == 'status code 403':
+                DAILY_BUDGET_REF.mark_exhausted(url)
+                raise QuotaExceededError(f'{url} is refusing requests (status code 403); its quota is likely used up')
+            raise TransientRequestError(f'Request failed after {attempt + 1} attempts with {status_desc}')
+        delay = compute_backoff(attempt, retry_after)
+        logger.warning(f'Received {status_desc}; retrying in {delay:.1f} seconds')
+        time.sleep(delay)
+        attempt += 1
+
+
 # Make the request and cache new data, or retrieve the cached data
 def make_request_using_cache(url: str, params: Dict[str, str]) -> str:
     unique_req_url = create_unique_request_str(url, params)
 
-    # cache_df = pd.read_sql(f'''
-    #     SELECT * FROM request WHERE request_url = '{unique_req_url}';
-    # ''', ENGINE)
-    #
-    # if not cache_df.empty:
+    with Cache(DB_CACHE_PATH_STR) as ref:
+        cached_value = ref.get(unique_req_url)
+    if cached_value is not None:
+        entry = read_cache_entry(cached_value)
+        if not is_stale(entry):
+            REGISTRY.inc('cache_hits_total', store='request_cache')
+            return entry['text']
+        try:
+            new_entry, changed = revalidate_entry(url, params, entry)
+        except QuotaExceededError:
+            logger.warning('No request budget is left to revalidate a stale cached response; using it as is')
+            return entry['text']
+        except TransientRequestError as error:
+            logger.warning(f'Revalidating a stale cached response failed ({error}); using it as is')
+            return entry['text']
+        if new_entry is not entry:
+            with Cache(DB_CACHE_PATH_STR) as ref:
+                ref[unique_req_url] = new_entry
+        return new_entry['text']
+    REGISTRY.inc('cache_misses_total', store='request_cache')
+
+    response_obj = make_request_with_retries(url, params)
+    status_code = response_obj.status_code
+    if status_code != 200:
+        logger.warning(f'Received irregular status code: {status_code}')
+        return ''
 
+    new_entry = create_cache_entry(url, params, response_obj)
     with Cache(DB_CACHE_PATH_STR) as ref:
+        ref[unique_req_url] = new_entry
+    return new_entry['text']
 
-        if unique_req_url in ref:
 
-            # logger.debug('Retrieving cached data...')
-            # return cache_df.iloc[0]['response']
-            # print('found in cache')
-            return ref[unique_req_url]
+# Whether an open cache would answer a request ('fresh'), revalidate it ('stale'), or send it ('missing'),
+# without contacting the API
+def find_cache_status(ref: Cache, url: str, params: Dict[str, str]) -> str:
+    cached_value = ref.get(create_unique_request_str(url, params))
+    if cached_value is None:
+        return 'missing'
+    return 'stale' if is_stale(read_cache_entry(cached_value)) else 'fresh'
 
-        else:
-            # logger.debug('Making a request for new data...')
-            # print('making a new request')
-            response_obj = requests.get(url, params)
-            # logger.debug(response_obj.url)
-            status_code = response_obj.status_code
-            if status_code == 403:
-                # logger.warning('Reached API limit')
-                return ''
-            elif status_code != 200:
-                # logger.debug(response_obj.text)
-                # logger.warning(f'Received irregular status code: {status_code}')
-                return ''
-
-            response_text = response_obj.text
-            # new_request_df = pd.DataFrame({
-            #     'request_url': [unique_req_url],
-            #     'response': [response_text],
-            #     'timestamp': datetime.now().isoformat()
-            # })
-            # logger.debug(response_text)
-            ref[unique_req_url] = response_text
-            # new_request_df.to_sql('request', ENGINE, if_exists='append', index=False)
-            return response_text
+
+def has_fresh_entry(url: str, params: Dict[str, str]) -> bool:
+    with Cache(DB_CACHE_PATH_STR) as ref:
+        return find_cache_status(ref, url, params) == 'fresh'
+
+
+# Revalidate every stale entry that records its request, rewriting only the ones whose response changed
+# (or renewing their fetch time); legacy entries are revalidated when a run next requests them
+def refresh_cache() -> Tuple[int, int]:
+    num_revalidated = 0
+    num_changed = 0
+    with Cache(DB_CACHE_PATH_STR) as ref:
+        now = time.time()
+        for request_key in list(ref.iterkeys()):
+            entry = read_cache_entry(ref[request_key])
+            if 'url' not in entry or not is_stale(entry, now):
+                continue
+            params = {**entry['params'], **PRIVATE_PARAMS.get(entry['url'], {})}
+            try:
+                new_entry, changed = revalidate_entry(entry['url'], params, entry)
+            except TransientRequestError as error:
+                logger.warning(f'Stopping refresh after a transient failure: {error}')
+                break
+            if new_entry is not entry:
+                ref[request_key] = new_entry
+            num_revalidated += 1
+            num_changed += int(changed)
+    logger.info(f'Revalidated {num_revalidated} stale cache entries; {num_changed} had changed')
+    return num_revalidated, num_changed
 
 # # Functions - DB
 #
@@ -119,3 +282,13 @@ def make_request_using_cache(url: str, params: Dict[str, str]) -> str:
 #
 # if __name__ == '__main__':
 #     set_up_database()
+
+
+# Main Program
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Maintain the request cache.')
+    parser.add_argument('command', choices=['refresh'], help='Revalidate cached responses older than MAX_AGE_DAYS')
+    args = parser.parse_args()
+    refresh_cache()
@@ -0,0 +1,63 @@
+# diagnostics
+
+# standard libraries
+import hashlib, json, logging, os
+from typing import Any, Callable
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+DIAGNOSTICS_OPTS = ENV.get('DIAGNOSTICS', {})
+# Share of books (chosen by a stable hash of their ID) whose records and frames are logged at DEBUG
+SAMPLE_RATE = DIAGNOSTICS_OPTS.get('SAMPLE_RATE', 0.01)
+
+
+# Classes
+
+# A log argument rendered only when a handler emits the record, e.g.
+# logger.debug('Manifests:\n%s', Lazy(lambda: manifests_df.head(15)))
+class Lazy:
+
+    def __init__(self, func: Callable[[], Any]) -> None:
+        self.func = func
+
+    def __str__(self) -> str:
+        return str(self.func())
+
+
+# Functions
+
+def is_sampled(book_id: Any, sample_rate: float = SAMPLE_RATE) -> bool:
+    if sample_rate <= 0:
+        return False
+    if sample_rate >= 1:
+        return True
+    book_hash = int(hashlib.md5(str(book_id).encode('utf-8')).hexdigest()[:8], 16)
+    return book_hash < sample_rate * 0x100000000
+
+
+# Whether to log a book's detailed diagnostics (its records and frames): only for sampled books, and only
+# when the logger would emit them
+def logs_book_details(book_logger: logging.Logger, book_id: Any) -> bool:
+    return book_logger.isEnabledFor(logging.DEBUG) and is_sampled(book_id)
+
+
+def format_summary_fields(**fields: Any) -> str:
+    return ' '.join(
+        f'{field}={json.dumps(value) if isinstance(value, str) and (not value or " " in value) else value}'
+        for field, value in fields.items()
+    )
+
+
+# One line per book with its outcome as key=value pairs, for grepping or loading into a log index
+def log_book_summary(book_logger: logging.Logger, book_id: Any, **fields: Any) -> None:
+    if book_logger.isEnabledFor(logging.INFO):
+        book_logger.info('book_summary %s', format_summary_fields(id=book_id, **fields))
@@ -0,0 +1,263 @@
+# engine
+
+# standard libraries
+import json, logging, os
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from db_cache import TransientRequestError
+from metrics import REGISTRY, METRICS_OPTS
+from output_store import save_parquet, OUTPUT_FORMAT
+from pipeline import run_pipeline, Stage
+from snapshot import read_books_table
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+RUN_TS = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+ENGINE_OPTS = ENV.get('ENGINE', {})
+ENABLED_SOURCES = ENGINE_OPTS.get('SOURCES', ['WorldCat', 'LibraryCloud'])
+# Books looked up at once; each book's sources are searched concurrently on top of this
+BOOK_WORKERS = ENGINE_OPTS.get('WORKERS', 4)
+
+BOOKS_CSV_PATH_ELEMS = ENV['BOOKS_CSV_PATH']
+TEST_MODE_OPTS = ENV['TEST_MODE']
+
+# Provenance columns added to every output row (records keep their own Source column, e.g. "Harvard Library")
+BOOK_ID_COLUMN = 'Book_ID'
+SOURCE_COLUMN = 'Lookup_Source'
+
+
+# Classes
+
+# A catalog that books can be identified in. The source's script module is only imported when the adapter
+# is created. Every source's records are matched with identify.py's title and publisher comparisons, so
+# identify.py's configuration is needed whichever sources are searched.
+class SourceAdapter(ABC):
+
+    name = ''
+    # Whether the source skips the first row of an input workbook (a dummy record in the press's exports)
+    drops_first_row = False
+
+    # The book's dict in the shape the source's lookup expects
+    def prepare(self, book_dict: Dict[str, Any]) -> Dict[str, Any]:
+        return book_dict
+
+    # The book's matching records, or None when a transient request failure kept it from being searched
+    @abstractmethod
+    def look_up(self, book_dict: Dict[str, Any]) -> Optional[pd.DataFrame]:
+        pass
+
+    # Called once every book has been looked up
+    def finish(self) -> None:
+        pass
+
+
+# Matches WorldCat records to the book with identify.py's title and publisher comparisons
+class WorldCatAdapter(SourceAdapter):
+
+    name = 'WorldCat'
+    drops_first_row = True
+
+    def __init__(self) -> None:
+        import identify
+        self.identify = identify
+
+    def prepare(self, book_dict: Dict[str, Any]) -> Dict[str, Any]:
+        return {self.identify.INPUT_TO_IDENTIFY_CW.get(field, field): value for field, value in book_dict.items()}
+
+    def look_up(self, book_dict: Dict[str, Any]) -> Optional[pd.DataFrame]:
+        return self.identify.identify_chunk([book_dict])[0]
+
+    def finish(self) -> None:
+        self.identify.save_publisher_variants()
+
+
+# Finds Harvard LibraryCloud records for the book with hlapi.py's query plan, keeping those that pass
+# identify.py's title and publisher comparisons
+class LibraryCloudAdapter(SourceAdapter):
+
+    name = 'LibraryCloud'
+
+    def __init__(self) -> None:
+        import hlapi, identify
+        self.hlapi = hlapi
+        self.identify = identify
+
+    def prepare(self, book_dict: Dict[str, Any]) -> Dict[str, Any]:
+        return self.hlapi.prepare_book_dict(book_dict['ID'], book_dict)
+
+    def look_up(self, book_dict: Dict[str, Any]) -> Optional[pd.DataFrame]:
+        records_df = self.hlapi.try_look_up_book_in_resource(book_dict)
+        if records_df is None or records_df.empty:
+            return records_df
+        match_book_dict, match_records = create_match_inputs(book_dict, records_df)
+        matches = self.identify.run_checks_and_return_matches(match_book_dict, match_records)
+        return records_df.loc[[match_record['Key'] for match_record in matches]]
+
+    def finish(self) -> None:
+        self.identify.save_publisher_variants()
+
+
+ADAPTER_CLASSES = {adapter_class.name: adapter_class for adapter_class in [WorldCatAdapter, LibraryCloudAdapter]}
+
+
+# Functions
+
+# A LibraryCloud book and its records in the field names identify.py's matcher reads; the book's copyright
+# holder is a known publisher, as it is in hlapi.py's query plan
+def create_match_inputs(
+    book_dict: Dict[str, Any],
+    records_df: pd.DataFrame
+) -> Tuple[Dict[str, Any], Sequence[Dict[str, Any]]]:
+    match_book_dict = {
+        'ID': book_dict['ID'],
+        'Title': book_dict['Main Title'],
+        'Subtitle': book_dict['Subtitle'] if pd.notna(book_dict.get('Subtitle', pd.NA)) else '',
+        'Publisher 1': book_dict['Publisher'],
+        'Publisher 2': book_dict.get('Copyright Holder', pd.NA)
+    }
+    match_records = []
+    for record_key, record in records_df.iterrows():
+        subtitle = record.get('Subtitle', '')
+        match_records.append({
+            'Key': record_key,
+            'Title': record['Main Title'],
+            'Subtitle': f' {subtitle}' if pd.notna(subtitle) and subtitle else '',
+            'Publisher': record['Publisher'] if record['Publisher'] else pd.NA
+        })
+    return match_book_dict, match_records
+
+
+def create_adapters(source_names: Sequence[str] = ENABLED_SOURCES) -> Sequence[SourceAdapter]:
+    unknown_names = [source_name for source_name in source_names if source_name not in ADAPTER_CLASSES]
+    if unknown_names:
+        raise ValueError(f'Unknown sources {unknown_names}; expected some of {list(ADAPTER_CLASSES.keys())}')
+    return [ADAPTER_CLASSES[source_name]() for source_name in source_names]
+
+
+# The sources to search the book in: the workbook's first row is skipped by sources that drop it
+def select_adapters(book_pos: int, adapters: Sequence[SourceAdapter], input_path: str) -> Sequence[SourceAdapter]:
+    if book_pos == 0 and '.xlsx' in input_path:
+        return [adapter for adapter in adapters if not adapter.drops_first_row]
+    return adapters
+
+
+def try_look_up_in_source(adapter: SourceAdapter, book_dict: Dict[str, Any]) -> Optional[pd.DataFrame]:
+    try:
+        return adapter.look_up(adapter.prepare(book_dict))
+    except TransientRequestError as error:
+        logger.error(f'{adapter.name} lookup of {book_dict["ID"]} failed and should be retried later: {error}')
+        return None
+
+
+# Search every source for the book at once, so a book takes as long as its slowest source
+def look_up_in_sources(
+    book_dict: Dict[str, Any],
+    adapters: Sequence[SourceAdapter],
+    executor: ThreadPoolExecutor
+) -> Dict[str, Optional[pd.DataFrame]]:
+    futures = {adapter.name: executor.submit(try_look_up_in_source, adapter, book_dict) for adapter in adapters}
+    return {source_name: future.result() for source_name, future in futures.items()}
+
+
+# Combine a book's results from every source into one frame, each row tagged with the book and the source
+# it came from
+def merge_source_results(book_id: str, results: Dict[str, Optional[pd.DataFrame]]) -> pd.DataFrame:
+    source_dfs = [
+        source_df.reset_index(drop=True).assign(**{BOOK_ID_COLUMN: book_id, SOURCE_COLUMN: source_name})
+        for source_name, source_df in results.items()
+        if source_df is not None and not source_df.empty
+    ]
+    if not source_dfs:
+        return pd.DataFrame({})
+    return pd.concat(source_dfs, ignore_index=True, sort=False)
+
+
+# The first workbook row is kept here; select_adapters leaves it out for sources that drop it
+def load_books() -> pd.DataFrame:
+    books_df = read_books_table(os.path.join(*BOOKS_CSV_PATH_ELEMS), drop_first_row=False)
+    if TEST_MODE_OPTS['ON']:
+        logger.info('TEST_MODE is ON.')
+        books_df = books_df.iloc[:TEST_MODE_OPTS['NUM_RECORDS']]
+    return books_df
+
+
+def save_output(df: pd.DataFrame, stem: str) -> None:
+    if OUTPUT_FORMAT == 'parquet':
+        save_parquet(df, 'data', stem, RUN_TS, index=False)
+    else:
+        df.to_csv(os.path.join('data', f'{stem}.csv'), index=False)
+
+
+# Identify every book in all enabled sources in one pass, writing one output with per-source provenance
+def identify_books() -> None:
+    if METRICS_OPTS.get('ON', False):
+        REGISTRY.start_periodic_export()
+
+    adapters = create_adapters()
+    book_dicts = [row_tup[1].to_dict() for row_tup in load_books().iterrows()]
+    input_path = os.path.join(*BOOKS_CSV_PATH_ELEMS)
+    book_tups = [
+        (book_dict, select_adapters(book_pos, adapters, input_path)) for book_pos, book_dict in enumerate(book_dicts)
+    ]
+    source_executor = ThreadPoolExecutor(max_workers=BOOK_WORKERS * len(adapters))
+    stages = [
+        Stage('identify', lambda book_tup: look_up_in_sources(book_tup[0], book_tup[1], source_executor), BOOK_WORKERS)
+    ]
+
+    book_dfs = []
+    transient_failures = []
+    num_matches = {adapter.name: 0 for adapter in adapters}
+    for (book_dict, _), results in run_pipeline(book_tups, stages):
+        for source_name, source_df in results.items():
+            if source_df is None:
+                REGISTRY.inc('books_total', result='transient_failure', source=source_name)
+                transient_failures.append({**book_dict, SOURCE_COLUMN: source_name})
+            elif source_df.empty:
+                REGISTRY.inc('books_total', result='unmatched', source=source_name)
+            else:
+                REGISTRY.inc('books_total', result='matched', source=source_name)
+                num_matches[source_name] += 1
+        book_dfs.append(merge_source_results(book_dict['ID'], results))
+    source_executor.shutdown()
+    for adapter in adapters:
+        adapter.finish()
+
+    matches_df = pd.concat(book_dfs, ignore_index=True, sort=False) if book_dfs else pd.DataFrame({})
+    if not matches_df.empty:
+        save_output(matches_df, 'engine_matches')
+    if transient_failures:
+        save_output(pd.DataFrame(transient_failures), 'engine_transient_failures')
+
+    # Log Summary Report
+    report_str = '** Summary Report from engine.py **\n\n'
+    report_str += f'-- Total number of books included in search: {len(book_dicts)}\n'
+    for source_name, num_source_matches in num_matches.items():
+        report_str += f'-- Number of books with matching {source_name} records: {num_source_matches}\n'
+    report_str += f'-- Number of book searches to retry due to transient request failures: {len(transient_failures)}\n'
+    logger.info(f'\n\n{report_str}')
+
+    if METRICS_OPTS.get('ON', False):
+        REGISTRY.finish()
+
+
+# Main Program
+
+if __name__ == '__main__':
+    logging.basicConfig(level=ENV.get('LOG_LEVEL', 'INFO'))
+    identify_books()
@@ -0,0 +1,134 @@
+# estimate
+
+# standard libraries
+import argparse, json, logging, math, os
+from collections import Counter
+from typing import Any, Dict, Optional, Tuple
+
+# third-party libraries
+from diskcache import Cache
+
+# local libraries
+import identify
+from db_cache import find_cache_status, DB_CACHE_PATH_STR
+from metrics import JSON_PATH_STR
+from pipeline import PIPELINE_OPTS, STAGE_WORKERS
+from quota import DAILY_BUDGET, DAILY_BUDGET_REF
+from rate_limit import get_bucket
+from shard import open_checkpoint, parse_shard_spec, select_shard_rows
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+# How each book would start: from a stored result, the offline index, or its first request's cache status
+BOOK_STATUSES = ['stored', 'indexed', 'fresh', 'stale', 'missing']
+
+
+# Functions
+
+# Mean latency of the endpoint's requests in an earlier run's metrics export, if one was written
+def read_mean_latency(url: str, metrics_path: str = JSON_PATH_STR) -> Optional[float]:
+    if not os.path.isfile(metrics_path):
+        return None
+    with open(metrics_path) as metrics_file:
+        metrics_json = json.load(metrics_file)
+    for series in metrics_json.get('histograms', {}).get('request_latency_seconds', []):
+        if series['labels'].get('endpoint') == url and series['count'] > 0:
+            return series['sum'] / series['count']
+    return None
+
+
+# Requests are sent by the fetch workers, each waiting out a round trip, and never faster than the rate limit
+def project_wall_time(num_requests: int, mean_latency: float, rate: float, workers: int) -> float:
+    return max(num_requests * mean_latency / workers, num_requests / rate)
+
+
+# Classify every book identify_books would process, without making a request
+def count_book_statuses(shard: Optional[Tuple[int, int]] = None) -> Counter:
+    press_books_df = identify.load_press_books()
+    checkpoint = None
+    if shard is not None:
+        press_books_df = press_books_df.loc[select_shard_rows(press_books_df['ID'].to_list(), shard)]
+        checkpoint = open_checkpoint('identify', shard, False)
+    result_store = identify.open_identify_result_store()
+
+    statuses = Counter({status: 0 for status in BOOK_STATUSES})
+    with Cache(DB_CACHE_PATH_STR) as ref:
+        for _, press_book_row in press_books_df.iterrows():
+            book_dict = press_book_row.to_dict()
+            if identify.find_stored_result(book_dict, checkpoint, result_store) is not None:
+                statuses['stored'] += 1
+            elif identify.OFFLINE_MODE_OPTS['ON'] and identify.find_candidates(
+                'WorldCat', identify.create_full_title(book_dict), book_dict['Author_Last']
+            ):
+                statuses['indexed'] += 1
+            else:
+                params = identify.create_first_request_params(book_dict)
+                statuses[find_cache_status(ref, identify.WC_BIB_BASE_URL, params)] += 1
+    return statuses
+
+
+def estimate_run(shard: Optional[Tuple[int, int]] = None) -> Dict[str, Any]:
+    statuses = count_book_statuses(shard)
+    # Stale responses are revalidated with a (conditional) request, which counts against the quota too
+    num_requests = statuses['stale'] + statuses['missing']
+    mean_latency = read_mean_latency(identify.WC_BIB_BASE_URL)
+    rate = get_bucket(identify.WC_BIB_BASE_URL).max_rate
+    workers = STAGE_WORKERS.get('FETCH', 1) if PIPELINE_OPTS['ON'] else 1
+
+    estimate = {
+        'books': sum(statuses.values()),
+        'statuses': dict(statuses),
+        'requests': num_requests,
+        'mean_latency_seconds': mean_latency,
+        'wall_time_seconds': project_wall_time(num_requests, mean_latency, rate, workers) if mean_latency is not None else None,
+        'daily_budget': DAILY_BUDGET,
+        'budget_left_today': DAILY_BUDGET_REF.remaining(identify.WC_BIB_BASE_URL) if DAILY_BUDGET_REF is not None else None
+    }
+    # Quota windows the requests span, counting today's remaining budget as the first
+    budget_left_today = estimate['budget_left_today'] if estimate['budget_left_today'] is not None else DAILY_BUDGET
+    if num_requests <= budget_left_today:
+        estimate['quota_windows'] = 1
+    else:
+        estimate['quota_windows'] = 1 + math.ceil((num_requests - budget_left_today) / DAILY_BUDGET)
+    return estimate
+
+
+def format_estimate(estimate: Dict[str, Any]) -> str:
+    statuses = estimate['statuses']
+    report_str = '** Dry-run Estimate for identify.py **\n\n'
+    report_str += f'-- Total number of books included in search: {estimate["books"]}\n'
+    report_str += f'-- Books with stored results (no requests): {statuses["stored"]}\n'
+    report_str += f'-- Books with records in the offline index (no requests): {statuses["indexed"]}\n'
+    report_str += f'-- Books whose first request is cached: {statuses["fresh"]}\n'
+    report_str += f'-- Books whose first request is cached but stale (revalidated): {statuses["stale"]}\n'
+    report_str += f'-- Books whose first request is uncached: {statuses["missing"]}\n'
+    report_str += f'-- Expected WorldCat requests (quota consumption): at least {estimate["requests"]}\n'
+    if estimate['budget_left_today'] is not None:
+        report_str += f'-- Request budget left today: {estimate["budget_left_today"]} of {estimate["daily_budget"]}\n'
+    report_str += f'-- Quota windows needed: {estimate["quota_windows"]}\n'
+    if estimate['wall_time_seconds'] is None:
+        report_str += '-- Projected wall time: unknown (no latency statistics recorded; run once with METRICS on)\n'
+    else:
+        report_str += (
+            f'-- Projected wall time: {estimate["wall_time_seconds"] / 60:.1f} minutes '
+            f'(mean request latency {estimate["mean_latency_seconds"]:.2f} seconds)\n'
+        )
+    report_str += '-- Later result pages and title searches after ISBN lookups without hits are not included\n'
+    return report_str
+
+
+# Main Program
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the requests and time an identify.py run will take.')
+    parser.add_argument('--shard', type=parse_shard_spec, help='Estimate only shard i of N (i/N, numbered from 0)')
+    parser.add_argument('--json', action='store_true', help='Print the estimate as JSON')
+    args = parser.parse_args()
+    run_estimate = estimate_run(args.shard)
+    if args.json:
+        print(json.dumps(run_estimate, indent=2))
+    else:
+        print(f'\n\n{format_estimate(run_estimate)}')
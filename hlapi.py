@@ -1,9 +1,11 @@
 # identify
 
 # standard libraries
-import json, logging, os
+import argparse, json, logging, os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Sequence
+from typing import Callable, Dict, Optional, Sequence
+from urllib.parse import urlsplit, urlunsplit
 
 # third-party libraries
 import numpy as np
@@ -12,18 +14,44 @@ from bs4 import BeautifulSoup
 from datetime import datetime
 from tqdm import tqdm
 import isbnlib as ib
+from isbnlib import ISBNLibException
+from isbnlib.dev import ISBNLibHTTPError, ISBNLibURLError
 from safeprint import print
 from diskcache import Cache
 
 # local libraries
-from compare import classify_by_format, \
+from compare import canonicalize_isbn, \
+                    classify_by_format, \
                     create_compare_func, \
                     extract_extra_atoms, \
                     normalize, \
                     polish_isbn, \
                     normalize_univ, \
                     NA_PATTERN
-from db_cache import make_request_using_cache # , set_up_database
+from db_cache import make_request_using_cache, TransientRequestError # , set_up_database
+from incremental import open_result_store
+from metrics import REGISTRY, METRICS_OPTS
+from output_store import save_parquet as save_parquet_output, OUTPUT_FORMAT
+from pipeline import run_pipeline, Stage, PIPELINE_OPTS
+from rate_limit import get_bucket
+from records import CatalogRecord, records_to_frame, RECORD_STORE
+from snapshot import read_books_table, read_input_table
+from shard import create_shard_suffix, find_parent_ids, open_checkpoint, parse_shard_spec, select_shard_rows
+
+
+# The JSON endpoint next to an API endpoint, e.g. .../v2/items.json for .../v2/items (keeping the query)
+def create_json_url(base_url: str) -> str:
+    url_parts = urlsplit(base_url)
+    path = url_parts.path.rstrip('/')
+    if not path:
+        raise ValueError(f'Cannot derive a JSON endpoint from {base_url}; set BIB_RESOURCE_JSON_URL')
+    if path.endswith('.json'):
+        return base_url
+    json_url = urlunsplit(url_parts._replace(path=path + '.json'))
+    # urlunsplit drops an empty query's "?", which cache keys built from the base URL keep
+    if base_url.endswith('?') and not json_url.endswith('?'):
+        json_url += '?'
+    return json_url
 
 
 # Initialize settings and global variables
@@ -51,7 +79,21 @@ ALREADY_CSV_PATH_ELEMS = ENV['ALREADY_CSV_PATH']
 worldcat_config = ENV['RESOURCE']
 API_KEY = worldcat_config['BIB_RESOURCE_KEY']
 BIB_BASE_URL = worldcat_config['BIB_RESOURCE_BASE_URL']
+# "xml" (MODS XML) or "json", which is cheaper to parse and smaller to cache
+RESPONSE_FORMAT = worldcat_config.get('RESPONSE_FORMAT', 'xml')
+BIB_JSON_URL = worldcat_config.get('BIB_RESOURCE_JSON_URL') or create_json_url(BIB_BASE_URL)
 TEST_MODE_OPTS = ENV['TEST_MODE']
+QUERY_PLAN_OPTS = ENV.get('QUERY_PLAN', {'ON': False})
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=QUERY_PLAN_OPTS.get('WORKERS', 3)) if QUERY_PLAN_OPTS['ON'] else None
+ISBNLIB_OPTS = ENV.get('ISBNLIB', {'ON': False})
+# Shared by every enrichment call, so concurrent pipeline enrich workers stay within WORKERS lookups in total
+ISBNLIB_EXECUTOR = ThreadPoolExecutor(max_workers=ISBNLIB_OPTS.get('WORKERS', 4)) if ISBNLIB_OPTS['ON'] else None
+ISBN_FIRST_OPTS = ENV.get('ISBN_FIRST', {'ON': False})
+
+EDITIONS_CACHE_PATH = "isbnlib_editions"
+GB_CACHE_PATH = "gb_api_cache"
+
+CONFIG_FILE_NAMES = ['modsxml_lookup.json', 'input_to_identify.json', 'identify_to_output.json']
 
 with open(os.path.join('config', 'modsxml_lookup.json')) as lookup_file:
     MODSXML_LOOKUP = json.loads(lookup_file.read())
@@ -63,14 +105,18 @@ with open(os.path.join('config', 'identify_to_output.json')) as identify_to_outp
 
 
 
-def identify_books() -> None:
-    # Load input data
+# Unlike identify.py, the first workbook row is kept
+def load_press_books():
     input_path = os.path.join(*BOOKS_CSV_PATH_ELEMS)
-    if '.xlsx' in BOOKS_CSV_PATH_ELEMS[-1]:
-        press_books_df = pd.read_excel(input_path, dtype=str, index_col='ID')
-        # press_books_df = press_books_df.iloc[1:]  # Remove dummy record
-    else:
-        press_books_df = pd.read_csv(input_path, dtype=str, index_col='ID')
+    press_books_df = read_books_table(input_path, drop_first_row=False).set_index('ID')
+    return press_books_df
+
+def identify_books(shard=None, fresh=False) -> None:
+    if METRICS_OPTS.get('ON', False):
+        REGISTRY.start_periodic_export()
+
+    # Load input data
+    press_books_df = load_press_books()
 
     # print(press_books_df)
 
@@ -79,7 +125,7 @@ def identify_books() -> None:
     if ALREADY_CSV_PATH_ELEMS[-1] != "":
         already_input_path = os.path.join(*ALREADY_CSV_PATH_ELEMS)
         if '.xlsx' in ALREADY_CSV_PATH_ELEMS[-1]:
-            already_books_df = pd.read_excel(already_input_path, dtype=str,index_col=0)
+            already_books_df = read_input_table(already_input_path, index_col=0)
         else:
             already_books_df = pd.read_csv(already_input_path,dtype=str,index_col=0)
 
@@ -89,6 +135,8 @@ def identify_books() -> None:
         # #     print(id.split("_")[0])
         # #     press_books_df.drop(id.split("_")[0])
         # print(press_books_df)
+        if shard is not None:
+            already_books_df = already_books_df.loc[select_shard_rows(find_parent_ids(already_books_df.index.to_list()), shard)]
         matches_df = matches_df.append(already_books_df)
         # print(matches_df)
 
@@ -101,48 +149,104 @@ def identify_books() -> None:
         # logger.info('TEST_MODE is ON.')
         press_books_df = press_books_df.iloc[:len(matches_df)+TEST_MODE_OPTS['NUM_RECORDS']]
 
+    # Keep only this shard's books; a sharded run checkpoints each book so it can be resumed
+    checkpoint = None
+    shard_suffix = create_shard_suffix(shard)
+    if shard is not None:
+        press_books_df = press_books_df.loc[select_shard_rows(press_books_df.index.to_list(), shard)]
+        checkpoint = open_checkpoint('hlapi', shard, fresh)
+        print(f'Processing shard {shard[0]} of {shard[1]}: {len(press_books_df)} books')
+
+    # In incremental mode, books whose input row and configuration are unchanged reuse earlier results
+    result_store = open_result_store(
+        'hlapi',
+        CONFIG_FILE_NAMES,
+        {
+            'BIB_BASE_URL': BIB_BASE_URL,
+            'RESPONSE_FORMAT': RESPONSE_FORMAT,
+            'BIB_JSON_URL': BIB_JSON_URL,
+            'ISBN_FIRST': ISBN_FIRST_OPTS,
+            # Enrichment adds editions and metadata to the results; its worker count does not change them
+            'ISBNLIB': {key: value for key, value in ISBNLIB_OPTS.items() if key != 'WORKERS'}
+        }
+    )
+
     # For each record, fetch WorldCat data, compare to record, analyze and accumulate matches
     non_matching_books = {}
+    transient_failure_books = {}
+    looked_up_books = []
     num_books_with_matches = 0
 
-    iter = tqdm(press_books_df.iterrows())
-    for press_book_row_tup in iter:
-        iter.set_description("Looking up books")
-        new_book_dict = press_book_row_tup[1].to_dict()
-        new_book_dict['ID'] = press_book_row_tup[0]
-
-
-        uncat_isbn_string = new_book_dict['Uncategorized ISBN']
-        if type(uncat_isbn_string) == type(''):
-            uncat_isbns = uncat_isbn_string.split(' ; ')
-            new_book_dict['Uncategorized ISBN'] = ''
-            new_book_dict['ebook ISBN'] = ''
-            new_book_dict['paper ISBN'] = ''
-            new_book_dict['hardcover ISBN'] = ''
-
-            for isbn_string in uncat_isbns:
-                canon_isbn = get_canon_isbn(isbn_string)
-                isbn_fmat = identify_format(isbn_string)
-                if isbn_fmat == 'unknown':
-                    isbn_fmat = 'Uncategorized'
-                already_there = new_book_dict[f'{isbn_fmat} ISBN']
-                if canon_isbn not in already_there:
-                    if len(already_there) > 0:
-                        new_book_dict[f'{isbn_fmat} ISBN'] += " ; "
-                    new_book_dict[f'{isbn_fmat} ISBN'] += canon_isbn
+    # Gather the books to look up, with any result stored by the checkpoint or, in incremental mode, an earlier run
+    book_dicts = []
+    results = []
+    for press_book_row_tup in press_books_df.iterrows():
+        new_book_dict = prepare_book_dict(press_book_row_tup[0], press_book_row_tup[1].to_dict())
 
         if (new_book_dict['ID'] not in matches_df['ID']):
             # logger.info(new_book_dict)
 
-            matching_records_df = look_up_book_in_resource(new_book_dict)
-
-            matches_df = matches_df.append(pd.Series(
-                new_book_dict,
-                name=new_book_dict['ID']
-            ))
-
-            if not matching_records_df.empty:
-                matches_df = matches_df.append(matching_records_df)
+            matching_records_df = None
+            if checkpoint is not None and new_book_dict['ID'] in checkpoint:
+                matching_records_df = checkpoint[new_book_dict['ID']]
+            elif result_store is not None:
+                matching_records_df = result_store.get(new_book_dict)
+            book_dicts.append(new_book_dict)
+            results.append(matching_records_df)
+
+    pending_positions = [book_pos for book_pos, result in enumerate(results) if result is None]
+    pending_books = [book_dicts[book_pos] for book_pos in pending_positions]
+    if PIPELINE_OPTS['ON']:
+        lookups = look_up_books_in_pipeline(pending_books)
+    else:
+        lookups = ((new_book_dict, try_look_up_book_in_resource(new_book_dict)) for new_book_dict in pending_books)
+
+    # Write stage: store each finished book's result as soon as it is done
+    iter = tqdm(zip(pending_positions, lookups), total=len(pending_positions))
+    iter.set_description("Looking up books")
+    for book_pos, (new_book_dict, matching_records_df) in iter:
+        results[book_pos] = matching_records_df
+        if matching_records_df is not None:
+            if checkpoint is not None:
+                checkpoint[new_book_dict['ID']] = matching_records_df
+            if result_store is not None:
+                result_store.put(new_book_dict, matching_records_df)
+
+    for new_book_dict, matching_records_df in zip(book_dicts, results):
+        if matching_records_df is None:
+            REGISTRY.inc('books_total', result='transient_failure')
+            transient_failure_books[new_book_dict['ID']] = new_book_dict
+        else:
+            looked_up_books.append((new_book_dict, matching_records_df))
+
+    # Enrich all matched records at once so each ISBN is only looked up once per run; books looked up in the
+    # pipeline were already enriched by its enrich stage
+    if ISBNLIB_OPTS['ON']:
+        enriched_ids = {new_book_dict['ID'] for new_book_dict in pending_books} if PIPELINE_OPTS['ON'] else set()
+        run_isbns = []
+        for new_book_dict, matching_records_df in looked_up_books:
+            if new_book_dict['ID'] not in enriched_ids:
+                run_isbns += collect_isbns(matching_records_df.to_dict(orient='index'))
+        if run_isbns:
+            prefetch_isbn_enrichment(run_isbns)
+
+    for new_book_dict, matching_records_df in looked_up_books:
+        matches_df = matches_df.append(pd.Series(
+            new_book_dict,
+            name=new_book_dict['ID']
+        ))
+
+        if matching_records_df.empty:
+            REGISTRY.inc('books_total', result='unmatched')
+            non_matching_books[new_book_dict['ID']] = new_book_dict
+        else:
+            REGISTRY.inc('books_total', result='matched')
+            num_books_with_matches += 1
+            matches_df = matches_df.append(matching_records_df)
+            if ISBNLIB_OPTS['ON']:
+                gb_records = use_isbnlib(matching_records_df.to_dict(orient='index'))
+                if gb_records:
+                    matches_df = matches_df.append(pd.DataFrame.from_dict(gb_records, orient='index'))
 
     # logger.debug('Matching Manifests')
     # logger.debug(matches_df.describe())
@@ -150,6 +254,70 @@ def identify_books() -> None:
     # matches_df = matches_df[ENV["OUTPUT_COLUMNS"]]
     # print(matches_df)
 
+    matches_df = add_rightsholder_stats(matches_df)
+
+    # Generate Excel output
+    if not matches_df.empty:
+        save_output(matches_df,'output'+shard_suffix)
+        # matches_df.to_csv(os.path.join('data', 'matched_manifests.csv'), index=False)
+
+    if transient_failure_books:
+        transient_failures_df = pd.DataFrame.from_dict(transient_failure_books, orient='index')
+        save_output(transient_failures_df, 'transient_failures'+shard_suffix, excel=False)
+
+    # if non_matching_books:
+    #     no_isbn_matches_df = pd.DataFrame.from_dict(non_matching_books,orient='index')
+    #     no_isbn_matches_df = no_isbn_matches_df[ENV["OUTPUT_COLUMNS"]]
+    #     try:
+    #         save_excel(no_isbn_matches_df,'not_matched')
+    #     except:
+    #         save_csv(no_isbn_matches_df,'not_matched')
+        # no_isbn_matches_df.to_csv(os.path.join('data', 'no_isbn_matches.csv'), index=False)
+
+    # Log Summary Report
+    report_str = '** Summary Report from identify.py **\n\n'
+    report_str += f'-- Total number of books included in search: {len(press_books_df)}\n'
+    report_str += f'-- Number of books successfully matched with records with ISBNs: {num_books_with_matches}\n'
+    report_str += f'-- Number of books with no matching records: {len(non_matching_books)}\n'
+    report_str += f'-- Number of books not searched due to transient request failures: {len(transient_failure_books)}\n'
+    # logger.info(f'\n\n{report_str}')
+    print(f'\n\n{report_str}')
+    if result_store is not None:
+        print(f'-- Results reused from earlier runs: {result_store.num_reused}; looked up: {result_store.num_computed}')
+
+    if METRICS_OPTS.get('ON', False):
+        REGISTRY.finish()
+    return None
+
+
+# Build a book's dict from its input row, sorting its uncategorized ISBNs into format columns
+def prepare_book_dict(book_id, row_dict):
+    new_book_dict = dict(row_dict)
+    new_book_dict['ID'] = book_id
+
+    uncat_isbn_string = new_book_dict['Uncategorized ISBN']
+    if type(uncat_isbn_string) == type(''):
+        uncat_isbns = uncat_isbn_string.split(' ; ')
+        new_book_dict['Uncategorized ISBN'] = ''
+        new_book_dict['ebook ISBN'] = ''
+        new_book_dict['paper ISBN'] = ''
+        new_book_dict['hardcover ISBN'] = ''
+
+        for isbn_string in uncat_isbns:
+            canon_isbn = get_canon_isbn(isbn_string)
+            isbn_fmat = identify_format(isbn_string)
+            if isbn_fmat == 'unknown':
+                isbn_fmat = 'Uncategorized'
+            already_there = new_book_dict[f'{isbn_fmat} ISBN']
+            if canon_isbn not in already_there:
+                if len(already_there) > 0:
+                    new_book_dict[f'{isbn_fmat} ISBN'] += " ; "
+                new_book_dict[f'{isbn_fmat} ISBN'] += canon_isbn
+    return new_book_dict
+
+
+# Rank rightsholders across all books and flag books whose copyright holder differs from the publisher
+def add_rightsholder_stats(matches_df):
     # Add stats for copyright holder
     holders = {}
     for id in matches_df.index.values:
@@ -177,32 +345,7 @@ def identify_books() -> None:
             rightsholder = matches_df.at[id,'Copyright Holder']
         if not pd.isnull(rightsholder):
             matches_df.at[id,'Rightsholder Rank'] = holders[rightsholder]
-
-    # Generate Excel output
-    if not matches_df.empty:
-        try:
-            save_excel(matches_df,'output')
-        except:
-            save_csv(matches_df,'output')
-        # matches_df.to_csv(os.path.join('data', 'matched_manifests.csv'), index=False)
-
-    # if non_matching_books:
-    #     no_isbn_matches_df = pd.DataFrame.from_dict(non_matching_books,orient='index')
-    #     no_isbn_matches_df = no_isbn_matches_df[ENV["OUTPUT_COLUMNS"]]
-    #     try:
-    #         save_excel(no_isbn_matches_df,'not_matched')
-    #     except:
-    #         save_csv(no_isbn_matches_df,'not_matched')
-        # no_isbn_matches_df.to_csv(os.path.join('data', 'no_isbn_matches.csv'), index=False)
-
-    # Log Summary Report
-    report_str = '** Summary Report from identify.py **\n\n'
-    report_str += f'-- Total number of books included in search: {len(press_books_df)}\n'
-    report_str += f'-- Number of books successfully matched with records with ISBNs: {num_books_with_matches}\n'
-    report_str += f'-- Number of books with no matching records: {len(non_matching_books)}\n'
-    # logger.info(f'\n\n{report_str}')
-    return None
-
+    return matches_df
 
 def get_canon_isbn(isbnlike):
     isbn = classify_isbn(isbnlike)
@@ -256,39 +399,16 @@ def look_up_book_in_resource(book_dict: Dict[str, str]) -> pd.DataFrame:
     # Generate query string
     # logger.info(f'Looking for {book_dict["Main Title"]} in Harvard LibraryCloud...')
 
-    query_author = normalize(f"{book_dict['Author 1 Given']} {book_dict['Author 1 Initial']} {book_dict['Author 1 Family']}")
-    # query_author = book_dict['authorLast']
-    query_author.replace("'", " ")
-
-    title_bool_and = create_title_bool_and(book_dict)
-    params = {
-        'title' : title_bool_and,
-        'name' : query_author,
-        'limit': 10,
-        'publisher' : book_dict['Publisher']
-    }
-
-
-    query_str = f'&'.join([k+'='+str(params[k]) for k in list(params.keys())])
-    # logger.debug(query_str)
-    records = {}
-
-    result = make_request_using_cache(BIB_BASE_URL, params)
-    if result:
-        records.update(parse_modsxml(result,book_dict))
-        if len(list(records.keys())) == 0:
-            params.pop('publisher')
-            result = make_request_using_cache(BIB_BASE_URL, params)
-            if result:
-                records.update(parse_modsxml(result,book_dict))
-
-    if book_dict['Publisher'] != book_dict['Copyright Holder']:
-        params['publisher'] = book_dict['Copyright Holder']
-        second_result = make_request_using_cache(BIB_BASE_URL, params)
-        if second_result:
-            second_records = parse_modsxml(second_result,book_dict)
-            if len(list(second_records.keys())) > 0:
-                records.update(second_records)
+    records = look_up_isbns_in_resource(book_dict)
+    if not records:
+        query_plan = create_query_plan(book_dict)
+        if QUERY_PLAN_OPTS['ON']:
+            records = run_query_plan_concurrently(query_plan, book_dict)
+        else:
+            records = merge_query_results(
+                query_plan,
+                lambda query_name: fetch_and_parse_query(query_plan[query_name], book_dict)
+            )
 
     # print(records)
     # records.update(use_isbnlib({book_dict['ID']:book_dict}))
@@ -313,11 +433,151 @@ def look_up_book_in_resource(book_dict: Dict[str, str]) -> pd.DataFrame:
 
         # records.update(use_isbnlib(records))
 
-        records_df = pd.DataFrame.from_dict(records,orient='index')
+        records_df = records_to_frame(list(records.values()), index=list(records.keys()))
     # logger.info(f'Number of records found: {len(records_df)}')
     # logger.debug(records_df.head(10))
         return records_df
 
+# Returns None when a transient request failure kept the book from being searched
+def try_look_up_book_in_resource(book_dict: Dict[str, str]) -> Optional[pd.DataFrame]:
+    try:
+        return look_up_book_in_resource(book_dict)
+    except TransientRequestError as error:
+        print(f'Lookup of {book_dict["ID"]} failed and should be retried later: {error}')
+        return None
+
+
+# Enrich stage: fetch a book's ISBN editions and Google Books metadata into the caches while later books are
+# still being looked up
+def prefetch_book_enrichment(matching_records_df: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
+    if ISBNLIB_OPTS['ON'] and matching_records_df is not None and not matching_records_df.empty:
+        prefetch_isbn_enrichment(collect_isbns(matching_records_df.to_dict(orient='index')))
+    return matching_records_df
+
+
+# Run the lookups through the fetch and enrich stages concurrently, yielding each book with its result in
+# input order; the caller's loop is the write stage
+def look_up_books_in_pipeline(book_dicts: Sequence[Dict[str, str]]):
+    stages = [
+        Stage('fetch', try_look_up_book_in_resource),
+        Stage('enrich', prefetch_book_enrichment)
+    ]
+    return run_pipeline(book_dicts, stages)
+
+
+ISBN_COLUMNS = ['ebook ISBN', 'paper ISBN', 'hardcover ISBN', 'Uncategorized ISBN']
+
+# The canonical ISBNs in a record's (or book's) ISBN columns
+def collect_record_isbns(record):
+    isbns = []
+    for col in ISBN_COLUMNS:
+        value = record.get(col, '')
+        if pd.isna(value):
+            continue
+        for isbn_str in str(value).split(';'):
+            isbn = canonicalize_isbn(isbn_str)
+            if isbn is not None and isbn not in isbns:
+                isbns.append(isbn)
+    return isbns
+
+# Search LibraryCloud by each of the book's ISBNs in turn, returning the records carrying one of them from
+# the first search that finds any; those are accepted without the title searches, which are only run when
+# this returns nothing
+def look_up_isbns_in_resource(book_dict: Dict[str, str]) -> Dict[str, Dict]:
+    if not ISBN_FIRST_OPTS['ON']:
+        return {}
+    isbns = collect_record_isbns(book_dict)
+    for isbn in isbns:
+        records = fetch_and_parse_query({'identifier': isbn, 'limit': 10}, book_dict) or {}
+        hits = {
+            record_key: record for record_key, record in records.items()
+            if any(record_isbn in isbns for record_isbn in collect_record_isbns(record))
+        }
+        if hits:
+            return hits
+    return {}
+
+
+# Build the LibraryCloud queries for a book: with the publisher, without it (used when the first returns
+# nothing), and with the copyright holder as publisher when it differs
+def create_query_plan(book_dict: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+    query_author = normalize(f"{book_dict['Author 1 Given']} {book_dict['Author 1 Initial']} {book_dict['Author 1 Family']}")
+    # query_author = book_dict['authorLast']
+    query_author.replace("'", " ")
+
+    title_bool_and = create_title_bool_and(book_dict)
+    params = {
+        'title' : title_bool_and,
+        'name' : query_author,
+        'limit': 10
+    }
+
+    query_plan = {
+        'publisher': {**params, 'publisher': book_dict['Publisher']},
+        'no_publisher': params
+    }
+    if book_dict['Publisher'] != book_dict['Copyright Holder']:
+        query_plan['copyright_holder'] = {**params, 'publisher': book_dict['Copyright Holder']}
+    return query_plan
+
+
+# Returns None when the request failed, otherwise the parsed records (possibly none)
+def fetch_and_parse_query(params: Dict[str, str], book_dict: Dict[str, str]) -> Optional[Dict[str, Dict]]:
+    if RESPONSE_FORMAT == 'json':
+        result = make_request_using_cache(BIB_JSON_URL, params)
+        parse_response = parse_modsjson
+    else:
+        result = make_request_using_cache(BIB_BASE_URL, params)
+        parse_response = parse_modsxml
+    if not result:
+        return None
+    return parse_response(result, book_dict)
+
+
+# Merge query results with a fixed precedence: copyright holder results override publisher results,
+# and the query without publisher is only consulted when the publisher query parsed no records
+def merge_query_results(query_plan: Dict[str, Dict[str, str]], get_result: Callable) -> Dict[str, Dict]:
+    records = {}
+    publisher_records = get_result('publisher')
+    if publisher_records is not None:
+        records.update(publisher_records)
+        if len(records) == 0:
+            no_publisher_records = get_result('no_publisher')
+            if no_publisher_records is not None:
+                records.update(no_publisher_records)
+
+    if 'copyright_holder' in query_plan:
+        holder_records = get_result('copyright_holder')
+        if holder_records:
+            records.update(holder_records)
+    return records
+
+
+# Dispatch every query in the plan at once so worst-case latency is about one round trip, then merge with
+# the same precedence as the sequential path. With CANCEL_UNNEEDED on (for quota-sensitive runs), the query
+# without publisher is only sent once the publisher query found nothing, as it would be sequentially.
+def run_query_plan_concurrently(query_plan: Dict[str, Dict[str, str]], book_dict: Dict[str, str]) -> Dict[str, Dict]:
+    deferred_queries = ['no_publisher'] if QUERY_PLAN_OPTS.get('CANCEL_UNNEEDED', False) else []
+    futures = {
+        query_name: QUERY_EXECUTOR.submit(fetch_and_parse_query, params, book_dict)
+        for query_name, params in query_plan.items()
+        if query_name not in deferred_queries
+    }
+    used_queries = set()
+
+    def get_result(query_name: str) -> Optional[Dict[str, Dict]]:
+        used_queries.add(query_name)
+        if query_name not in futures:
+            futures[query_name] = QUERY_EXECUTOR.submit(fetch_and_parse_query, query_plan[query_name], book_dict)
+        return futures[query_name].result()
+
+    records = merge_query_results(query_plan, get_result)
+    for query_name, future in futures.items():
+        if query_name not in used_queries:
+            # Requests already in flight still finish and are cached; their results are discarded
+            future.cancel()
+    return records
+
 
 def create_title_bool_and(record: Dict[str, str]) -> str:
 
@@ -345,12 +605,20 @@ def parse_modsxml(xml_record,book_dict):
     items = result_xml.find("items")
     records = items.children
     record_dicts = {}
+    num_parsed = 0
     for r in records:
 
         rd = {}
         rd['ID'] = r.find('mods:recordIdentifier').text
         rd['Source'] = 'Harvard Library'
 
+        # Records already parsed from another response are shared rather than parsed again
+        record_key = book_dict['ID'] + "_" + rd['ID']
+        stored_record = RECORD_STORE.get('Harvard Library', rd['ID'])
+        if stored_record is not None:
+            record_dicts[record_key] = stored_record
+            continue
+
         # print(r)
         titleInfo = r.find("mods:titleInfo")
         try:
@@ -415,33 +683,8 @@ def parse_modsxml(xml_record,book_dict):
         except:
             rd['Year'] = ''
 
-        oclc = ''
-        lccn = ''
-        isbn = ''
-
-        isbns = {}
         idents = r.find_all("mods:identifier")
-        for ident in idents:
-
-            if 'type' in ident.attrs:
-                if ident['type'] == 'isbn':
-                    if '(' in ident.text:
-                        form_string = ident.text.split('(')[-1].split(')')[0]
-                    else:
-                        form_string = ident.text
-
-                    isbn = get_canon_isbn(ident.text)
-                    fmat = identify_format(form_string.lower())
-                    # if fmat == 'unknown':
-                    #     print(rd['ID'],'unknown',form_string)
-
-                    if isbn not in isbns:
-                        isbns[isbn] = fmat
-                    # logger.info('MODS ISBNs',isbns)
-                elif ident['type'] == 'oclc':
-                    oclc = ib.canonical(ident.text)
-                elif ident['type'] == 'lccn':
-                    lccn = ib.canonical(ident.text)
+        isbns = collect_mods_isbns([(ident['type'], ident.text) for ident in idents if 'type' in ident.attrs])
 
         # if len(list(isbns.keys())) < 2:
         #     forms = r.find_all("mods:form")
@@ -450,23 +693,7 @@ def parse_modsxml(xml_record,book_dict):
         #         if returned != 'unknown':
         #             isbns[isbn] = returned
 
-        if 'Uncategorized ISBN' not in rd:
-            rd['Uncategorized ISBN'] = ''
-
-        for isbn in list(isbns.keys()):
-            form = isbns[isbn]
-            # print(rd['Main Title'],form,isbn)
-            if form == 'ebook':
-                rd['ebook ISBN'] = isbn
-            elif form == 'hardcover':
-                rd['hardcover ISBN'] = isbn
-            elif form == 'paper':
-                rd['paper ISBN'] = isbn
-            elif form == 'unknown':
-                if rd['Uncategorized ISBN'] == '':
-                    rd['Uncategorized ISBN'] = isbn
-                else:
-                    rd['Uncategorized ISBN'] += " ; "+str(isbn)
+        add_isbn_columns(rd, isbns)
 
 
         # try:
@@ -485,15 +712,180 @@ def parse_modsxml(xml_record,book_dict):
 
         # logger.debug(rd)
 
-        record_key = book_dict['ID'] + "_" + rd['ID']
         # with Cache(f'hl_id_cache/{TS}') as ref:
         #     if record_key not in ref:
-        record_dicts[record_key] = rd
+        record_dicts[record_key] = RECORD_STORE.add('Harvard Library', rd['ID'], CatalogRecord.from_dict(rd))
+        num_parsed += 1
         #         ref[record_key] = 1
 
+    REGISTRY.inc('records_parsed_total', num_parsed, source='Harvard Library')
     return record_dicts
 
-def use_isbnlib(records):
+# Map each canonical ISBN among a record's (type, text) identifiers to the format named in its text
+def collect_mods_isbns(identifiers):
+    isbns = {}
+    for ident_type, ident_text in identifiers:
+        if ident_type == 'isbn':
+            if '(' in ident_text:
+                form_string = ident_text.split('(')[-1].split(')')[0]
+            else:
+                form_string = ident_text
+
+            isbn = get_canon_isbn(ident_text)
+            fmat = identify_format(form_string.lower())
+            # if fmat == 'unknown':
+            #     print(rd['ID'],'unknown',form_string)
+
+            if isbn not in isbns:
+                isbns[isbn] = fmat
+            # logger.info('MODS ISBNs',isbns)
+    return isbns
+
+def add_isbn_columns(rd, isbns):
+    if 'Uncategorized ISBN' not in rd:
+        rd['Uncategorized ISBN'] = ''
+
+    for isbn in list(isbns.keys()):
+        form = isbns[isbn]
+        # print(rd['Main Title'],form,isbn)
+        if form == 'ebook':
+            rd['ebook ISBN'] = isbn
+        elif form == 'hardcover':
+            rd['hardcover ISBN'] = isbn
+        elif form == 'paper':
+            rd['paper ISBN'] = isbn
+        elif form == 'unknown':
+            if rd['Uncategorized ISBN'] == '':
+                rd['Uncategorized ISBN'] = isbn
+            else:
+                rd['Uncategorized ISBN'] += " ; "+str(isbn)
+
+# In LibraryCloud's JSON, MODS elements are keys without the namespace prefix, attributes are keys starting
+# with "@", text sits under "#text" when an element has attributes, and repeated elements become lists
+
+# All values of an element anywhere below a node, in document order, like BeautifulSoup's find_all
+def find_all_json(node, key):
+    found = []
+    if isinstance(node, list):
+        for child in node:
+            found += find_all_json(child, key)
+    elif isinstance(node, dict):
+        for child_key, child in node.items():
+            if child_key == key:
+                found += child if isinstance(child, list) else [child]
+            if not child_key.startswith('@'):
+                found += find_all_json(child, key)
+    return found
+
+def find_json(node, key):
+    found = find_all_json(node, key)
+    return found[0] if found else None
+
+def json_strings(node):
+    if isinstance(node, str):
+        return [node]
+    if isinstance(node, list):
+        return [string for child in node for string in json_strings(child)]
+    if isinstance(node, dict):
+        return [string for child_key, child in node.items() if not child_key.startswith('@') for string in json_strings(child)]
+    return []
+
+# The text of an element, like BeautifulSoup's .text (all the text inside it, concatenated)
+def json_text(node):
+    return ''.join(json_strings(node))
+
+def json_attrs(node):
+    if not isinstance(node, dict):
+        return {}
+    return {key[1:]: value for key, value in node.items() if key.startswith('@')}
+
+# Parse a LibraryCloud JSON response into the same records parse_modsxml produces from XML
+def parse_modsjson(json_record,book_dict):
+    result = json.loads(json_record)
+    items = result.get('items') or {}
+    records = items.get('mods', [])
+    if isinstance(records, dict):
+        records = [records]
+    record_dicts = {}
+    num_parsed = 0
+    for r in records:
+
+        rd = {}
+        rd['ID'] = json_text(find_json(r, 'recordIdentifier'))
+        rd['Source'] = 'Harvard Library'
+
+        record_key = book_dict['ID'] + "_" + rd['ID']
+        stored_record = RECORD_STORE.get('Harvard Library', rd['ID'])
+        if stored_record is not None:
+            record_dicts[record_key] = stored_record
+            continue
+
+        titleInfo = find_json(r, 'titleInfo')
+        non_sort = find_json(titleInfo, 'nonSort')
+        rd['Main Title'] = json_text(find_json(titleInfo, 'title'))
+        if non_sort is not None:
+            rd['Main Title'] = json_text(non_sort).strip() + " " + rd['Main Title']
+
+        sub_title = find_json(titleInfo, 'subTitle')
+        rd['Subtitle'] = json_text(sub_title) if sub_title is not None else ''
+
+        names = find_all_json(r, 'name')
+        for n in [1,2]:
+
+            try:
+                name = json_text(find_json(names[n-1], 'namePart')).split(', ')
+                rd[f'Author {n} Given'] = name[1].split()[0]
+                rd[f'Author {n} Initial'] = name[1].split()[1]
+                rd[f'Author {n} Family'] = name[0]
+
+            except (IndexError, TypeError):
+                rd[f'Author {n} Given'] = ''
+                rd[f'Author {n} Initial'] = ''
+                rd[f'Author {n} Family'] = ''
+
+        if len(names) > 2:
+            rd['Author 3 Name'] = ' '.join(string.strip() for string in json_strings(names[2]) if string.strip())
+        else:
+            rd['Author 3 Name'] = ''
+
+        rd['Publisher'] = ''
+        for pub in find_all_json(r, 'publisher'):
+            pub_text = json_text(pub)
+            if pub_text not in rd['Publisher']:
+                if rd['Publisher'] == '':
+                    rd['Publisher'] = pub_text
+                else:
+                    rd['Publisher'] += ' ; ' + pub_text
+
+        cities = []
+        for term in find_all_json(r, 'placeTerm'):
+            term_attrs = json_attrs(term)
+            if term_attrs.get('type') == 'text' and 'authority' not in term_attrs:
+                cities.append(json_text(term))
+        rd['Pub City'] = ' ; '.join(cities)
+
+        for year in find_all_json(r, 'dateIssued'):
+            year_text = json_text(year)
+            if 'Year' not in rd:
+                rd['Year'] = year_text
+            elif year_text not in rd['Year']:
+                rd['Year'] += ' ; ' + year_text
+
+        identifiers = [
+            (json_attrs(ident)['type'], json_text(ident))
+            for ident in find_all_json(r, 'identifier') if 'type' in json_attrs(ident)
+        ]
+        add_isbn_columns(rd, collect_mods_isbns(identifiers))
+
+        rd['Online Link'] = 'https://api.lib.harvard.edu/v2/items.dc?q='+rd['ID']
+
+        record_dicts[record_key] = RECORD_STORE.add('Harvard Library', rd['ID'], CatalogRecord.from_dict(rd))
+        num_parsed += 1
+
+    REGISTRY.inc('records_parsed_total', num_parsed, source='Harvard Library')
+    return record_dicts
+
+def collect_isbns(records):
     isbns_to_lookup = []
     for id in list(records.keys()):
         rd = records[id]
@@ -513,25 +905,70 @@ def use_isbnlib(records):
                     isbn = get_canon_isbn(rd[k])
                     if isbn not in isbns_to_lookup:
                         isbns_to_lookup.append(isbn)
+    return isbns_to_lookup
 
-
+def use_isbnlib(records):
+    isbns_to_lookup = collect_isbns(records)
     final_isbns_to_lookup = fill_out_isbn_list(isbns_to_lookup)
     ret_records = look_up_gb_api_with_cache(final_isbns_to_lookup)
     return ret_records
 
+# Errors that say nothing about the ISBN itself; these results are not cached so they are retried next run
+TRANSIENT_ISBNLIB_ERRORS = (ISBNLibHTTPError, ISBNLibURLError)
+
+# isbnlib's other errors (no data for the ISBN, an ISBN it does not accept) are empty results, cached like any
+# other; errors outside isbnlib are bugs and propagate
+def fetch_editions(n):
+    get_bucket(EDITIONS_CACHE_PATH).acquire()
+    try:
+        return ib.editions(n)
+    except TRANSIENT_ISBNLIB_ERRORS:
+        return None
+    except ISBNLibException:
+        return []
+
+def fetch_meta(n):
+    get_bucket(GB_CACHE_PATH).acquire()
+    try:
+        return ib.meta(n) or {}
+    except TRANSIENT_ISBNLIB_ERRORS:
+        return None
+    except ISBNLibException:
+        return {}
+
+# Fetch results not yet cached for a whole run's ISBNs concurrently under the isbnlib rate limits and
+# write them all (including empty results) to the caches read by fill_out_isbn_list and look_up_gb_api_with_cache
+def prefetch_isbn_enrichment(isbns):
+    unique_isbns = list(dict.fromkeys(n for n in isbns if n not in ['',None]))
+    with Cache(EDITIONS_CACHE_PATH) as ref:
+        missing_isbns = [n for n in unique_isbns if "Editions_API_"+n not in ref]
+        for n, editions in zip(missing_isbns, ISBNLIB_EXECUTOR.map(fetch_editions, missing_isbns)):
+            if editions is not None:
+                ref["Editions_API_"+n] = editions
+
+    expanded_isbns = fill_out_isbn_list(unique_isbns)
+    with Cache(GB_CACHE_PATH) as ref:
+        missing_isbns = [n for n in expanded_isbns if "GB_API_"+n not in ref]
+        for n, goog_record in zip(missing_isbns, ISBNLIB_EXECUTOR.map(fetch_meta, missing_isbns)):
+            if goog_record is not None:
+                ref["GB_API_"+n] = goog_record
+
 def fill_out_isbn_list(isbns):
     returnable = []
-    with Cache("isbnlib_editions") as ref:
+    with Cache(EDITIONS_CACHE_PATH) as ref:
         for n in isbns:
             cache_key = "Editions_API_"+n
             if n not in ['',None]:
                 if cache_key in ref:
+                    REGISTRY.inc('cache_hits_total', store=EDITIONS_CACHE_PATH)
                     editions = ref[cache_key]
                 else:
-                    try:
-                        editions = ib.editions(n)
-                    except:
+                    REGISTRY.inc('cache_misses_total', store=EDITIONS_CACHE_PATH)
+                    editions = fetch_editions(n)
+                    if editions is None:
                         editions = []
+                    else:
+                        ref[cache_key] = editions
                 returnable.append(n)
                 for e in editions:
                     if (e not in returnable) and (len(e) > 1):
@@ -540,17 +977,19 @@ def fill_out_isbn_list(isbns):
 
 def look_up_gb_api_with_cache(isbns):
     ret_records = {}
-    with Cache("gb_api_cache") as ref:
+    with Cache(GB_CACHE_PATH) as ref:
         for n in isbns:
             cache_key = "GB_API_"+n
             if cache_key in ref:
+                REGISTRY.inc('cache_hits_total', store=GB_CACHE_PATH)
                 goog_record = ref[cache_key]
             else:
-                try:
-                    goog_record = ib.meta(n)
-                    ref[cache_key] = goog_record
-                except:
+                REGISTRY.inc('cache_misses_total', store=GB_CACHE_PATH)
+                goog_record = fetch_meta(n)
+                if goog_record is None:
                     goog_record = {}
+                else:
+                    ref[cache_key] = goog_record
 
             if goog_record != {}:
                 r = {}
@@ -597,6 +1036,21 @@ def save_csv(df,stem):
     dir = get_out_dir()
     df.to_csv(dir+f'{TS}-{stem}.csv')
 
+def save_output(df,stem,excel=True):
+    if OUTPUT_FORMAT == 'parquet':
+        save_parquet(df,stem)
+    elif not excel:
+        save_csv(df,stem)
+    else:
+        try:
+            save_excel(df,stem)
+        except:
+            save_csv(df,stem)
+
+def save_parquet(df,stem):
+    dir = get_out_dir()
+    save_parquet_output(df,dir,stem,TS)
+
 def get_out_dir():
 
     dir_name = "outputs/"
@@ -613,9 +1067,11 @@ def get_out_dir():
 # Main Program
 
 if __name__ == '__main__':
-    print('remninder: incorporate fix')
-    remind_person()
-    identify_books()
+    parser = argparse.ArgumentParser(description='Identify books by searching Harvard LibraryCloud.')
+    parser.add_argument('--shard', type=parse_shard_spec, help='Process only shard i of N (i/N, numbered from 0)')
+    parser.add_argument('--fresh', action='store_true', help="Ignore the shard's checkpoint and start over")
+    args = parser.parse_args()
+    identify_books(args.shard, args.fresh)
     end = datetime.now()
     print("Time elapsed:",end-BEGIN)
 
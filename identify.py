@@ -1,29 +1,44 @@
 # identify
 
 # standard libraries
-import json, logging, os
+import argparse, json, logging, os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Sequence
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
 
 # third-party libraries
 import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
+from diskcache import Cache
 
 # local libraries
-from compare import classify_by_format, \
+from compare import canonicalize_isbn, \
+                    classify_by_format, \
                     create_compare_func, \
                     extract_extra_atoms, \
                     normalize, \
                     polish_isbn, \
                     normalize_univ, \
                     NA_PATTERN
-from db_cache import make_request_using_cache # , set_up_database
+from diagnostics import log_book_summary, logs_book_details, Lazy
+from db_cache import has_fresh_entry, make_request_using_cache, QuotaExceededError, TransientRequestError # , set_up_database
+from incremental import open_result_store, ResultStore
+from metrics import REGISTRY, METRICS_OPTS
+from output_store import save_parquet, OUTPUT_FORMAT
+from pipeline import run_pipeline, Stage, PIPELINE_OPTS
+from publisher_authority import open_publisher_authority
+from quota import plan_books, write_remainder, DAILY_BUDGET_REF, REMAINDER_PATH_STR
+from record_index import add_records, find_candidates
+from records import CatalogRecord, records_to_frame, RECORD_STORE
+from snapshot import read_books_table
+from shard import create_shard_suffix, open_checkpoint, parse_shard_spec, select_shard_rows
 
 
 # Initialize settings and global variables
 
 logger = logging.getLogger(__name__)
+RUN_TS = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
 try:
     with open(os.path.join('config', 'env.json')) as env_file:
@@ -31,7 +46,7 @@ try:
 except FileNotFoundError:
     logger.error('Configuration file could not be found; please add env.json to the config directory.')
 
-logging.basicConfig(level=ENV.get('LOG_LEVEL', 'DEBUG'))
+logging.basicConfig(level=ENV.get('LOG_LEVEL', 'INFO'))
 
 # # Set up database if necessary
 # if not os.path.isfile(os.path.join(*ENV['DB_CACHE_PATH'])):
@@ -43,6 +58,27 @@ worldcat_config = ENV['WORLDCAT']
 WC_API_KEY = worldcat_config['WC_SEARCH_API_KEY']
 WC_BIB_BASE_URL = worldcat_config['BIB_RESOURCE_BASE_URL']
 TEST_MODE_OPTS = ENV['TEST_MODE']
+OFFLINE_MODE_OPTS = ENV.get('OFFLINE_MODE', {'ON': False})
+BATCH_MODE_OPTS = ENV.get('BATCH_MODE', {'ON': False})
+SRU_BATCH_OPTS = ENV.get('SRU_BATCH', {'ON': False})
+SRU_PAGING_OPTS = ENV.get('SRU_PAGING', {'ON': False})
+ISBN_FIRST_OPTS = ENV.get('ISBN_FIRST', {'ON': False})
+PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=SRU_PAGING_OPTS.get('WORKERS', 3))
+
+PUBLISHER_AUTHORITY = open_publisher_authority()
+
+MAX_RECORDS = 100
+PAGE_SIZE = SRU_PAGING_OPTS.get('PAGE_SIZE', MAX_RECORDS) if SRU_PAGING_OPTS['ON'] else MAX_RECORDS
+
+# Minimum fuzzy match ratios for a record's title and publisher to match a book's
+TITLE_MATCH_THRESHOLD = 85
+PUBLISHER_MATCH_THRESHOLD = 85
+
+# Input fields that affect a book's results; other columns can change without the book being searched again
+FINGERPRINT_FIELD_PREFIXES = ['ID', 'Title', 'Subtitle', 'Author', 'Publisher']
+if ISBN_FIRST_OPTS['ON']:
+    FINGERPRINT_FIELD_PREFIXES += ['ISBN', 'Uncategorized ISBN']
+CONFIG_FILE_NAMES = ['marcxml_lookup.json', 'input_to_identify.json', 'identify_to_output.json']
 
 with open(os.path.join('config', 'marcxml_lookup.json')) as lookup_file:
     MARCXML_LOOKUP = json.loads(lookup_file.read())
@@ -58,7 +94,7 @@ def create_full_title(record: Dict[str, str]) -> str:
     full_title = record['Title']
     if 'Subtitle' in record.keys() and record["Subtitle"] not in ["N/A", ""]:
         full_title += ' ' + record['Subtitle']
-    logger.debug('full_title: ' + full_title)
+    logger.debug('full_title: %s', full_title)
     return full_title
 
 
@@ -72,7 +108,7 @@ def mint_wc_key_name(key: str, subfield: str, index: int, num_subs: int, num_sta
 
 
 # Explode groups of related columns from one row into separate dictionaries
-def unflatten(book_record: Dict[str, str], column_prefixes: Sequence[str]) -> Sequence[Dict[str, str]]:
+def unflatten(book_record: Mapping, column_prefixes: Sequence[str]) -> Sequence[Dict[str, str]]:
     embedded_records = []
     num = 1
     more_records = True
@@ -88,22 +124,38 @@ def unflatten(book_record: Dict[str, str], column_prefixes: Sequence[str]) -> Se
             if len(non_null_values) > 0:
                 embedded_records.append(embedded_record)
             num += 1
-    logger.debug(embedded_records)
     return embedded_records
 
 
+# A record's (ISBN a, ISBN q) pairs: numbered columns when it has several 020 fields, plain "ISBN a" and
+# "ISBN q" when it has one (see mint_wc_key_name)
+def collect_isbn_pairs(record: Mapping) -> Sequence[Dict[str, str]]:
+    if 'ISBN a' in record.keys():
+        isbn_dict = {'ISBN a': record['ISBN a'], 'ISBN q': record.get('ISBN q', pd.NA)}
+        return [isbn_dict] if pd.notna(isbn_dict['ISBN a']) or pd.notna(isbn_dict['ISBN q']) else []
+    return unflatten(record, ['ISBN a', 'ISBN q'])
+
+
 # Functions - Processing
 
-def parse_marcxml(xml_record: str) -> Sequence[Dict[str, str]]:
+# Parse one page of an SRU response, returning its records and the total number of records for the query
+def parse_marcxml_page(xml_record: str) -> Tuple[Sequence[CatalogRecord], int]:
     result_xml = BeautifulSoup(xml_record, 'xml')
-    number_of_records = result_xml.find("numberOfRecords").text
-    if int(number_of_records) > 100:
-        logger.error(f'Number of records > 100: {number_of_records}')
+    number_of_records = int(result_xml.find("numberOfRecords").text)
 
     records = result_xml.find_all("recordData")
     record_dicts = []
+    num_parsed = 0
     for record in records:
         record_dict = {}
+        control_number = record.find('controlfield', tag='001')
+        if control_number:
+            record_dict['Control_Number'] = control_number.text.strip()
+            # Records already parsed from another response are shared rather than parsed again
+            stored_record = RECORD_STORE.get('WorldCat', record_dict['Control_Number'])
+            if stored_record is not None:
+                record_dicts.append(stored_record)
+                continue
         for marc_key in MARCXML_LOOKUP:
             marc_field = MARCXML_LOOKUP[marc_key]
             statements = record.find_all('datafield', tag=marc_field['datafield'])
@@ -119,80 +171,425 @@ def parse_marcxml(xml_record: str) -> Sequence[Dict[str, str]]:
                     else:
                         record_dict[key_name] = pd.NA
             if num > 1 and marc_key != 'ISBN':
-                logger.warning(f'Multiple values found for {marc_key}!')
-                logger.warning(record_dict)
-        logger.debug(record_dict)
-        record_dicts.append(record_dict)
-    return record_dicts
+                logger.warning('Multiple values found for %s in record %s', marc_key, record_dict.get('Control_Number'))
+        catalog_record = CatalogRecord.from_dict(record_dict)
+        num_parsed += 1
+        if 'Control_Number' in record_dict:
+            catalog_record = RECORD_STORE.add('WorldCat', record_dict['Control_Number'], catalog_record)
+        record_dicts.append(catalog_record)
+    REGISTRY.inc('records_parsed_total', num_parsed, source='WorldCat')
+    return record_dicts, number_of_records
 
 
-# Use the Bibliographic Resource tool to search for records and parse the returned MARC XML
-def look_up_book_in_worldcat(book_dict: Dict[str, str]) -> pd.DataFrame:
-    # Generate query string
-    full_title = create_full_title(book_dict)
-    logger.info(f'Looking for "{full_title}" in WorldCat...')
+def parse_marcxml(xml_record: str) -> Sequence[CatalogRecord]:
+    return parse_marcxml_page(xml_record)[0]
+
+
+def find_number_of_records(xml_record: str) -> int:
+    number_of_records = BeautifulSoup(xml_record, 'xml').find("numberOfRecords")
+    return int(number_of_records.text) if number_of_records else 0
+
 
+def create_worldcat_query(book_dict: Dict[str, str]) -> str:
     # Data currently has one author last name; otherwise I'd do what's commented below or process one-to-many relationship
     # query_author = normalize(f"{book_dict['Author_First']} {book_dict['Author_Last']})
     # Replacing apostrophe because they are breaking query strings when they occur
     query_author = book_dict['Author_Last'].replace("'", " ")
-    query_title = normalize(full_title)
-    query_str = f'srw.ti all "{query_title}" and srw.au all "{query_author}"'
-    logger.debug(query_str)
+    query_title = normalize(create_full_title(book_dict))
+    return f'srw.ti all "{query_title}" and srw.au all "{query_author}"'
+
+
+# Request a page of results. startRecord is left out for the first page, so with a PAGE_SIZE of 100 its cache
+# key is the same as for requests made before paging; smaller pages change maximumRecords and miss those entries.
+def create_worldcat_params(query_str: str, start_record: int = 1, maximum_records: int = MAX_RECORDS) -> Dict[str, Any]:
     params = {
         'wskey': WC_API_KEY,
         "query": query_str,
-        "maximumRecords": 100,
+        "maximumRecords": maximum_records,
         'frbrGrouping': 'off'
     }
-    result = make_request_using_cache(WC_BIB_BASE_URL, params)
-
-    if not result:
-        return pd.DataFrame({})
+    if start_record > 1:
+        params['startRecord'] = start_record
+    return params
 
-    records = parse_marcxml(result)
-    records_df = pd.DataFrame(records)
-    logger.info(f'Number of WorldCat records found: {len(records_df)}')
-    logger.debug(records_df.head(10))
-    return records_df
 
+def request_worldcat_query(query_str: str, start_record: int = 1, maximum_records: int = MAX_RECORDS) -> str:
+    logger.debug(query_str)
+    return make_request_using_cache(WC_BIB_BASE_URL, create_worldcat_params(query_str, start_record, maximum_records))
+
+
+# The parameters of the first request made for a book: its ISBN query when it has ISBNs to look up first,
+# otherwise its title and author query
+def create_first_request_params(book_dict: Dict[str, str]) -> Dict[str, Any]:
+    isbns = collect_book_isbns(book_dict)
+    if isbns:
+        return create_worldcat_params(create_isbn_query(isbns))
+    return create_worldcat_params(create_worldcat_query(book_dict), maximum_records=PAGE_SIZE)
+
+
+# The number of API requests a book's first request would cost: none when the response is cached (or offline
+# mode has indexed records for it). Later pages, title searches after an ISBN lookup without hits, and batched
+# queries are not counted; the daily budget still stops them once it is used up.
+def count_uncached_requests(book_dict: Dict[str, str]) -> int:
+    if OFFLINE_MODE_OPTS['ON'] and find_candidates('WorldCat', create_full_title(book_dict), book_dict['Author_Last']):
+        return 0
+    return 0 if has_fresh_entry(WC_BIB_BASE_URL, create_first_request_params(book_dict)) else 1
+
+
+# Use records from the local index when offline mode has them for the book
+def find_indexed_lookup(book_dict: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    if not OFFLINE_MODE_OPTS['ON']:
+        return None
+    indexed_records = find_candidates('WorldCat', create_full_title(book_dict), book_dict['Author_Last'])
+    if indexed_records:
+        logger.info(f'Number of indexed WorldCat records found: {len(indexed_records)}')
+        return {'records': [CatalogRecord.from_dict(record) for record in indexed_records], 'response': None}
+    logger.info('No indexed WorldCat records found; falling back to the API')
+    return None
 
-def run_checks_and_return_matches(orig_record: Dict[str, str], results_df: pd.DataFrame) -> pd.DataFrame:
-    checked_df = results_df.copy()
-    logger.debug(orig_record)
-    logger.debug(checked_df)
 
-    if checked_df.empty:
-        return pd.DataFrame({})
+# Use the Bibliographic Resource tool to search for records and parse the returned MARC XML
+# Fetch step of a lookup: the records from the local index when offline mode has them, otherwise the API response
+def fetch_worldcat_lookup(book_dict: Dict[str, str]) -> Dict[str, Any]:
+    logger.debug('Looking for "%s" in WorldCat...', Lazy(lambda: create_full_title(book_dict)))
+    indexed_lookup = find_indexed_lookup(book_dict)
+    if indexed_lookup is not None:
+        return indexed_lookup
+    isbn_lookup = try_fetch_isbn_lookup(book_dict)
+    if isbn_lookup is not None:
+        return isbn_lookup
+    query_str = create_worldcat_query(book_dict)
+    return {'records': None, 'response': request_worldcat_query(query_str, maximum_records=PAGE_SIZE), 'query': query_str}
+
+
+# Parse step of a lookup
+def parse_worldcat_lookup(lookup: Dict[str, Any]) -> Sequence[CatalogRecord]:
+    if lookup.get('batch') is not None:
+        return route_batch_records(lookup['batch'])[lookup['batch_pos']]
+    if lookup['records'] is not None:
+        return lookup['records']
+    if not lookup['response']:
+        return []
+
+    records, number_of_records = parse_marcxml_page(lookup['response'])
+    lookup['number_of_records'] = number_of_records
+    # Matching one book at a time fetches later pages lazily; otherwise they are all fetched here
+    if number_of_records > len(records):
+        if SRU_PAGING_OPTS['ON'] and (SRU_PAGING_OPTS.get('EXHAUSTIVE', False) or BATCH_MODE_OPTS['ON']):
+            records = list(records) + fetch_remaining_pages(lookup['query'], len(records) + 1, number_of_records)
+        elif not SRU_PAGING_OPTS['ON']:
+            logger.warning(f'Only {len(records)} of {number_of_records} records were retrieved')
+    if OFFLINE_MODE_OPTS['ON']:
+        add_records('WorldCat', records)
+    return records
+
+
+def look_up_book_in_worldcat(book_dict: Dict[str, str]) -> Sequence[CatalogRecord]:
+    return parse_worldcat_lookup(fetch_worldcat_lookup(book_dict))
+
+
+# Functions - ISBN Lookups
+
+# The canonical ISBNs in a book's ISBN columns (e.g. "ISBN_13 1" or "Uncategorized ISBN"), when ISBNs are
+# looked up first
+def collect_book_isbns(book_dict: Dict[str, str]) -> Sequence[str]:
+    if not ISBN_FIRST_OPTS['ON']:
+        return []
+    isbns = []
+    for field, value in book_dict.items():
+        if 'ISBN' not in str(field) or pd.isna(value):
+            continue
+        for isbn_str in str(value).split(';'):
+            isbn = canonicalize_isbn(isbn_str)
+            if isbn is not None and isbn not in isbns:
+                isbns.append(isbn)
+    return isbns
+
+
+def create_isbn_query(isbns: Sequence[str]) -> str:
+    return ' or '.join(f'srw.bn = "{isbn}"' for isbn in isbns)
+
+
+# Records carrying one of the book's ISBNs; an ISBN search can also return records that only mention them
+def find_isbn_hits(records: Sequence[CatalogRecord], isbns: Sequence[str]) -> Sequence[CatalogRecord]:
+    hits = []
+    for record in records:
+        record_isbns = [
+            canonicalize_isbn(isbn_dict['ISBN a'])
+            for isbn_dict in collect_isbn_pairs(record) if pd.notna(isbn_dict['ISBN a'])
+        ]
+        if any(isbn in isbns for isbn in record_isbns):
+            hits.append(record)
+    return hits
+
+
+# Search by the book's ISBNs, returning a lookup of the exact hits, which are accepted without title and
+# publisher comparison, or None when the book has no ISBNs or no record carries one of them (the book is
+# then searched by title)
+def fetch_isbn_lookup(book_dict: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    isbns = collect_book_isbns(book_dict)
+    if not isbns:
+        return None
+    query_str = create_isbn_query(isbns)
+    response = request_worldcat_query(query_str)
+    hits = find_isbn_hits(parse_marcxml_page(response)[0], isbns) if response else []
+    if not hits:
+        logger.debug('No records carry the book\'s ISBNs; falling back to title search')
+        return None
+    logger.debug('Number of WorldCat records with the book\'s ISBNs: %s', len(hits))
+    return {'records': hits, 'response': None, 'query': query_str, 'exact': True}
+
+
+# A failed ISBN lookup falls back to title search, unless the quota is used up (title search would fail too)
+def try_fetch_isbn_lookup(book_dict: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    try:
+        return fetch_isbn_lookup(book_dict)
+    except QuotaExceededError:
+        raise
+    except TransientRequestError as error:
+        logger.warning(f'ISBN lookup failed; falling back to title search: {error}')
+        return None
+
+
+# Functions - Paging
+
+def find_paging_end(number_of_records: int) -> int:
+    return min(number_of_records, SRU_PAGING_OPTS.get('MAX_RECORDS_PER_BOOK', 1000))
+
+
+# Fetch and parse every page from start_record on at once
+def fetch_remaining_pages(query_str: str, start_record: int, number_of_records: int) -> Sequence[CatalogRecord]:
+    start_records = range(start_record, find_paging_end(number_of_records) + 1, PAGE_SIZE)
+    responses = PAGE_EXECUTOR.map(
+        lambda page_start: request_worldcat_query(query_str, page_start, PAGE_SIZE),
+        start_records
+    )
+    records = []
+    for response in list(responses):
+        if response:
+            records += parse_marcxml_page(response)[0]
+    logger.info(f'Fetched {len(start_records)} more pages of WorldCat records')
+    return records
+
+
+# Enough formats have been found when the manifests cover every format in STOP_WHEN_FORMATS
+def has_enough_formats(manifests_df: pd.DataFrame) -> bool:
+    if manifests_df.empty:
+        return False
+    stop_when_formats = SRU_PAGING_OPTS.get('STOP_WHEN_FORMATS', ['Ebook', 'Paperback', 'Hardcover'])
+    return set(stop_when_formats) <= set(manifests_df['Format'].dropna())
+
+
+# Add a page's manifests to those found so far, returning the merged manifests and whether the page added
+# any ISBN and format pair not already found
+def merge_page_manifests(manifests_df: pd.DataFrame, page_manifests_df: pd.DataFrame) -> Tuple[pd.DataFrame, bool]:
+    if page_manifests_df.empty:
+        return manifests_df, False
+    if manifests_df.empty:
+        return page_manifests_df, True
+    merged_df = pd.concat([manifests_df, page_manifests_df], ignore_index=True, sort=False)
+    merged_df = merged_df.drop_duplicates(subset=['ISBN', 'Format'])
+    return merged_df, len(merged_df) > len(manifests_df)
+
+
+# Match a book's records, fetching later pages one at a time (at most MAX_LAZY_PAGES) while the formats found
+# fall short. Once as many records as an unpaged request returns have been fetched, paging also stops at the
+# first page that adds no new match. Each page is matched on its own and its manifests merged into those
+# already found.
+def match_with_lazy_paging(
+    book_dict: Dict[str, str],
+    records: Sequence[CatalogRecord],
+    lookup: Optional[Dict[str, Any]]
+) -> pd.DataFrame:
+    manifests_df = classify_and_find_unique_manifests(book_dict, run_checks_and_return_matches(book_dict, records))
+    if lookup is None or 'query' not in lookup or not SRU_PAGING_OPTS['ON']:
+        return manifests_df
+
+    num_fetched = len(records)
+    paging_end = find_paging_end(lookup.get('number_of_records', 0))
+    max_lazy_pages = SRU_PAGING_OPTS.get('MAX_LAZY_PAGES', 4)
+    num_pages = 0
+    while num_fetched < paging_end and num_pages < max_lazy_pages and not has_enough_formats(manifests_df):
+        response = request_worldcat_query(lookup['query'], num_fetched + 1, PAGE_SIZE)
+        if not response:
+            break
+        page_records = parse_marcxml_page(response)[0]
+        if not page_records:
+            break
+        if OFFLINE_MODE_OPTS['ON']:
+            add_records('WorldCat', page_records)
+        num_fetched += len(page_records)
+        num_pages += 1
+        logger.info(f'Fetched another page of WorldCat records ({num_fetched} of {paging_end})')
+        page_manifests_df = classify_and_find_unique_manifests(
+            book_dict, run_checks_and_return_matches(book_dict, page_records)
+        )
+        manifests_df, found_new = merge_page_manifests(manifests_df, page_manifests_df)
+        if not found_new and num_fetched >= MAX_RECORDS:
+            break
+    return manifests_df
+
+
+# Functions - Batched Queries
+
+def create_words(input: str) -> set:
+    return set(normalize(input).split())
+
+
+# Books with short titles and an author can share a query; longer titles make results too broad to route
+def is_batchable(book_dict: Dict[str, str]) -> bool:
+    if not isinstance(book_dict.get('Author_Last'), str) or not book_dict['Author_Last'].strip():
+        return False
+    return len(create_words(create_full_title(book_dict))) <= SRU_BATCH_OPTS.get('MAX_TITLE_WORDS', 4)
+
+
+# Group the batchable books among the positions into CQL disjunctions of up to BOOKS_PER_QUERY books within
+# MAX_QUERY_LENGTH characters
+def create_query_batches(book_dicts: Sequence[Dict[str, str]], positions: Sequence[int]) -> Sequence[Sequence[int]]:
+    books_per_query = SRU_BATCH_OPTS.get('BOOKS_PER_QUERY', 5)
+    max_query_length = SRU_BATCH_OPTS.get('MAX_QUERY_LENGTH', 1000)
+    batches = []
+    batch = []
+    batch_length = 0
+    for book_pos in positions:
+        book_dict = book_dicts[book_pos]
+        if not is_batchable(book_dict):
+            continue
+        query_length = len(create_worldcat_query(book_dict)) + len(' or ()')
+        if batch and (len(batch) == books_per_query or batch_length + query_length > max_query_length):
+            batches.append(batch)
+            batch, batch_length = [], 0
+        batch.append(book_pos)
+        batch_length += query_length
+    if batch:
+        batches.append(batch)
+    return [batch for batch in batches if len(batch) > 1]
+
+
+def create_batch_query(book_dicts: Sequence[Dict[str, str]]) -> str:
+    return ' or '.join(f'({create_worldcat_query(book_dict)})' for book_dict in book_dicts)
+
+
+# Route a batch's records back to its books: a record goes to each book whose normalized title words all
+# appear in the record's title, and whose author appears in the record's author (when the record has one
+# and more than one book's title fits)
+def route_batch_records(batch: Dict[str, Any]) -> Sequence[Sequence[CatalogRecord]]:
+    if batch['records_by_book'] is not None:
+        return batch['records_by_book']
+
+    records = parse_marcxml(batch['response'])
+    if OFFLINE_MODE_OPTS['ON']:
+        add_records('WorldCat', records)
+    book_words = [
+        (create_words(create_full_title(book_dict)), create_words(book_dict['Author_Last']))
+        for book_dict in batch['books']
+    ]
+    records_by_book = [[] for _ in batch['books']]
+    for record in records:
+        record_title = ' '.join(
+            str(record[field]) for field in ['Title', 'Subtitle'] if field in record and pd.notna(record[field])
+        )
+        record_title_words = create_words(record_title)
+        title_fits = [book_pos for book_pos, (title_words, _) in enumerate(book_words) if title_words <= record_title_words]
+        record_author = record.get('Author')
+        if len(title_fits) > 1 and isinstance(record_author, str):
+            record_author_words = create_words(record_author)
+            title_fits = [book_pos for book_pos in title_fits if book_words[book_pos][1] <= record_author_words]
+        for book_pos in title_fits:
+            records_by_book[book_pos].append(record)
+    logger.info(f'Routed {len(records)} WorldCat records to {len(batch["books"])} books')
+    batch['records_by_book'] = records_by_book
+    return records_by_book
+
+
+# Fetch the books among the positions that can share queries in batches, returning their lookups by position;
+# the other books (not batchable, or in a failed or saturated batch) are left to be looked up one at a time
+def fetch_batched_lookups(book_dicts: Sequence[Dict[str, str]], positions: Sequence[int]) -> Dict[int, Dict[str, Any]]:
+    batched_lookups = {}
+    for batch_positions in create_query_batches(book_dicts, positions):
+        batch_books = [book_dicts[book_pos] for book_pos in batch_positions]
+        try:
+            response = request_worldcat_query(create_batch_query(batch_books))
+        except TransientRequestError as error:
+            logger.warning(f'Batched lookup failed; falling back to per-book queries: {error}')
+            continue
+        if not response:
+            continue
+        # A full result set may have cut off some books' records, so those books are searched separately
+        if find_number_of_records(response) >= MAX_RECORDS:
+            logger.info(f'Batched query of {len(batch_books)} books saturated; falling back to per-book queries')
+            continue
+        batch = {'response': response, 'books': batch_books, 'records_by_book': None}
+        for batch_pos, book_pos in enumerate(batch_positions):
+            batched_lookups[book_pos] = {'records': None, 'response': None, 'batch': batch, 'batch_pos': batch_pos}
+    return batched_lookups
+
+
+# Publisher comparisons are looked up in (and added to) the publisher authority table when it is on
+def create_publisher_compare_func(known_publishers: Sequence[str]):
+    if PUBLISHER_AUTHORITY is None:
+        return create_compare_func(known_publishers, PUBLISHER_MATCH_THRESHOLD, [normalize_univ])
+    for publisher in known_publishers:
+        PUBLISHER_AUTHORITY.add_variant(publisher)
+    compare_func = create_compare_func(
+        known_publishers, PUBLISHER_MATCH_THRESHOLD, [normalize_univ], decisions=PUBLISHER_AUTHORITY
+    )
+
+    def compare_to_publisher(publisher: str) -> bool:
+        PUBLISHER_AUTHORITY.add_variant(publisher)
+        return compare_func(publisher)
+    return compare_to_publisher
+
+
+# Write the publisher names seen this run to the publisher authority table, for export
+def save_publisher_variants() -> None:
+    if PUBLISHER_AUTHORITY is not None:
+        PUBLISHER_AUTHORITY.save_variants()
+
+
+# Concatenate title and subtitle the way pandas string addition does: missing if either part is missing
+def create_record_full_title(record: CatalogRecord) -> Optional[str]:
+    title = record.get('Title', pd.NA)
+    subtitle = record.get('Subtitle', pd.NA)
+    if pd.isna(title) or pd.isna(subtitle):
+        return None
+    return title + subtitle
+
+
+def run_checks_and_return_matches(orig_record: Dict[str, str], records: Sequence[CatalogRecord]) -> Sequence[CatalogRecord]:
+    log_details = logs_book_details(logger, orig_record['ID'])
+    if log_details:
+        logger.debug('Book: %s', orig_record)
+
+    if len(records) == 0:
+        return []
 
     # Create comparison functions
     full_title = create_full_title(orig_record)
-    compare_to_title = create_compare_func([full_title], 85)
+    compare_to_title = create_compare_func([full_title], TITLE_MATCH_THRESHOLD)
 
     known_publishers = []
     for pub_dict in unflatten(orig_record, ['Publisher']):
         if pd.notna(pub_dict['Publisher']):
             known_publishers.append(pub_dict['Publisher'])
-    logger.debug(known_publishers)
-    compare_to_publisher = create_compare_func(known_publishers, 85, [normalize_univ])
-
-    # Create full title column
-    checked_df['Full_Title'] = checked_df['Title'] + checked_df['Subtitle']
-    logger.debug(checked_df['Full_Title'])
+    compare_to_publisher = create_publisher_compare_func(known_publishers)
 
-    # Run comparisons
-    checked_df['Title_Match'] = checked_df['Full_Title'].map(compare_to_title, na_action='ignore')
-    checked_df['Publisher_Match'] = checked_df['Publisher'].map(compare_to_publisher, na_action='ignore')
-    logger.info(checked_df[['Title', 'Publisher', 'Title_Match', 'Publisher_Match']])
+    # Run comparisons, gathering records where both title and publisher are present and match
+    manifests = []
+    for record in records:
+        full_title = create_record_full_title(record)
+        publisher = record.get('Publisher', pd.NA)
+        title_match = full_title is not None and compare_to_title(full_title)
+        publisher_match = not pd.isna(publisher) and title_match and compare_to_publisher(publisher)
+        if log_details:
+            logger.debug('%s | %s | %s | %s', record.get('Title'), publisher, title_match, publisher_match)
+        if title_match and publisher_match:
+            manifests.append(record)
 
-    # Gather matching manifestation records
-    manifest_df = checked_df.loc[(
-        (checked_df['Title_Match']) & (checked_df['Publisher_Match'])
-    )]
-
-    logger.info(f'Matched {len(manifest_df)} records!')
-    logger.info(manifest_df.head(20))
-    return manifest_df
+    logger.debug('Matched %s records', len(manifests))
+    if log_details:
+        logger.debug('Matches: %s', Lazy(lambda: manifests[:20]))
+    return manifests
 
 
 # Determines format for a row on multiple analyzed columns
@@ -200,22 +597,20 @@ def determine_format(row: pd.Series):
     results = row[['Q Format', 'Overflow Format']].drop_duplicates().dropna()
     results = [result for result in results if result != "#NA#"]
     if len(results) > 1:
-        logger.warning('Different formats were found ')
-        logger.warning(results)
+        logger.warning('Different formats were found: %s', results)
     elif len(results) < 1:
         return pd.NA
     else:
         return results[0]
 
 
-def classify_and_find_unique_manifests(orig_record: Dict[str, str], matches_df: pd.DataFrame):
-    if matches_df.empty:
+def classify_and_find_unique_manifests(orig_record: Dict[str, str], matches: Sequence[CatalogRecord]):
+    if len(matches) == 0:
         return pd.DataFrame({})
 
     all_isbn_dicts = []
-    for match_row_tup in matches_df.iterrows():
-        match_dict = match_row_tup[1].to_dict()
-        isbn_dicts = unflatten(match_dict, ['ISBN a', 'ISBN q'])
+    for match_record in matches:
+        isbn_dicts = collect_isbn_pairs(match_record)
         all_isbn_dicts += isbn_dicts
 
     all_isbns_df = pd.DataFrame(all_isbn_dicts)
@@ -223,7 +618,7 @@ def classify_and_find_unique_manifests(orig_record: Dict[str, str], matches_df:
     if all_isbns_df.empty:
         return pd.DataFrame({})
 
-    logger.debug(all_isbns_df.columns)
+    log_details = logs_book_details(logger, orig_record['ID'])
     # Transform and analyze
     all_isbns_df['ISBN'] = all_isbns_df['ISBN a'].map(polish_isbn, na_action='ignore')
     all_isbns_df['ISBN Overflow'] = all_isbns_df['ISBN a'].map(extract_extra_atoms, na_action='ignore')
@@ -245,10 +640,8 @@ def classify_and_find_unique_manifests(orig_record: Dict[str, str], matches_df:
         isbn_format_series = isbn_format_row_tup[1]
         if isbn_format_series['ISBN'] in unique_isbns and isbn_format_series['Format'] == pd.NA:
             complete_isbn_format_df = complete_isbn_format_df.append(isbn_format_series)
-            logger.info("ISBN without format was added!")
-            logger.info(isbn_format_series)
+            logger.info('ISBN without format was added: %s', isbn_format_series['ISBN'])
 
-    logger.debug(complete_isbn_format_df.head(15))
     complete_isbn_format_df = complete_isbn_format_df.drop(columns=['ISBN a', 'ISBN q', 'ISBN Overflow', 'Overflow Format', 'Q Format'])
     complete_isbn_format_df = complete_isbn_format_df.assign(**{'Source': 'WorldCat'})
 
@@ -258,71 +651,431 @@ def classify_and_find_unique_manifests(orig_record: Dict[str, str], matches_df:
         'HEB_Title': orig_record['Title'],
         'Source': 'WorldCat'
     })
-    logger.info(complete_isbn_format_df)
+    if log_details:
+        logger.debug('Manifests:\n%s', Lazy(lambda: complete_isbn_format_df.head(20)))
     return complete_isbn_format_df
 
 
-def identify_books() -> None:
-    # Load input data
-    input_path = os.path.join(*BOOKS_CSV_PATH_ELEMS)
-    if '.xlsx' in BOOKS_CSV_PATH_ELEMS[-1]:
-        press_books_df = pd.read_excel(input_path, dtype=str)
-        press_books_df = press_books_df.iloc[1:]  # Remove dummy record
+# Functions - Batch Processing
+
+# Gather the candidate records for a chunk of books into one frame, with each row tagged by its book's
+# position in the chunk and its record's position overall (to keep per-book ordering when reshaping)
+def create_candidates_frame(candidates: Sequence[Sequence[CatalogRecord]]) -> pd.DataFrame:
+    all_records = []
+    book_positions = []
+    for book_pos, records in enumerate(candidates):
+        all_records += records
+        book_positions += [book_pos] * len(records)
+    candidates_df = records_to_frame(all_records)
+    if not candidates_df.empty:
+        candidates_df['Book_Pos'] = book_positions
+        candidates_df['Record_Pos'] = range(len(candidates_df))
+    return candidates_df
+
+
+# Title and publisher matching for every candidate of every book in the frame at once
+def run_checks_in_batch(book_dicts: Sequence[Dict[str, str]], candidates_df: pd.DataFrame) -> pd.DataFrame:
+    if candidates_df.empty or 'Title' not in candidates_df or 'Subtitle' not in candidates_df or 'Publisher' not in candidates_df:
+        return pd.DataFrame({})
+
+    compare_to_titles = []
+    compare_to_publishers = []
+    for book_dict in book_dicts:
+        compare_to_titles.append(create_compare_func([create_full_title(book_dict)], TITLE_MATCH_THRESHOLD))
+        known_publishers = [
+            pub_dict['Publisher'] for pub_dict in unflatten(book_dict, ['Publisher']) if pd.notna(pub_dict['Publisher'])
+        ]
+        compare_to_publishers.append(create_publisher_compare_func(known_publishers))
+
+    full_titles = candidates_df['Title'] + candidates_df['Subtitle']
+    title_matches = [
+        pd.notna(full_title) and compare_to_titles[book_pos](full_title)
+        for book_pos, full_title in zip(candidates_df['Book_Pos'], full_titles)
+    ]
+    matches = [
+        title_match and pd.notna(publisher) and compare_to_publishers[book_pos](publisher)
+        for book_pos, title_match, publisher in zip(candidates_df['Book_Pos'], title_matches, candidates_df['Publisher'])
+    ]
+    manifest_df = candidates_df.loc[matches]
+    logger.info('Matched %s records across %s books', len(manifest_df), Lazy(lambda: manifest_df['Book_Pos'].nunique()))
+    return manifest_df
+
+
+# Reshape numbered "ISBN a n"/"ISBN q n" columns into one row per pair, in the order unflatten yields them
+def explode_isbn_pairs(matches_df: pd.DataFrame) -> pd.DataFrame:
+    pair_dfs = []
+    # Records with a single 020 field carry un-numbered columns (see collect_isbn_pairs)
+    if 'ISBN a' in matches_df.columns:
+        single_df = matches_df.reindex(columns=['Book_Pos', 'Record_Pos', 'ISBN a', 'ISBN q'])
+        pair_dfs.append(single_df.assign(Pair_Num=0).dropna(how='all', subset=['ISBN a', 'ISBN q']))
+    num = 1
+    while f'ISBN a {num}' in matches_df.columns:
+        pair_df = matches_df[['Book_Pos', 'Record_Pos', f'ISBN a {num}', f'ISBN q {num}']]
+        pair_df = pair_df.rename(columns={f'ISBN a {num}': 'ISBN a', f'ISBN q {num}': 'ISBN q'})
+        pair_dfs.append(pair_df.assign(Pair_Num=num).dropna(how='all', subset=['ISBN a', 'ISBN q']))
+        num += 1
+    if not pair_dfs:
+        return pd.DataFrame({})
+    all_isbns_df = pd.concat(pair_dfs).sort_values(['Record_Pos', 'Pair_Num'], kind='mergesort')
+    return all_isbns_df.drop(columns=['Record_Pos', 'Pair_Num']).reset_index(drop=True)
+
+
+# ISBN/format classification for all books at once, grouped by book; mirrors classify_and_find_unique_manifests
+def classify_in_batch(book_dicts: Sequence[Dict[str, str]], matches_df: pd.DataFrame) -> pd.DataFrame:
+    if matches_df.empty:
+        return pd.DataFrame({})
+
+    all_isbns_df = explode_isbn_pairs(matches_df)
+    if all_isbns_df.empty:
+        return pd.DataFrame({})
+
+    all_isbns_df['ISBN'] = all_isbns_df['ISBN a'].map(polish_isbn, na_action='ignore')
+    all_isbns_df['ISBN Overflow'] = all_isbns_df['ISBN a'].map(extract_extra_atoms, na_action='ignore')
+
+    unique_isbn_format_df = all_isbns_df.fillna('#NA#').drop_duplicates()
+    unique_isbn_format_df['Q Format'] = all_isbns_df['ISBN q'].map(classify_by_format, na_action='ignore').fillna('#NA#')
+    unique_isbn_format_df['Overflow Format'] = unique_isbn_format_df['ISBN Overflow'].map(classify_by_format, na_action='ignore').fillna('#NA#')
+    unique_isbn_format_df['Format'] = unique_isbn_format_df.apply(determine_format, axis='columns').fillna('#NA#')
+
+    unique_isbn_format_df = unique_isbn_format_df.drop_duplicates(subset=['Book_Pos', 'ISBN', 'Format'])
+    unique_isbn_format_df = unique_isbn_format_df.where(unique_isbn_format_df != '#NA#', pd.NA)
+    complete_isbn_format_df = unique_isbn_format_df.dropna(axis='index', subset=['ISBN', 'Format'])
+
+    book_positions = complete_isbn_format_df['Book_Pos']
+    complete_isbn_format_df = complete_isbn_format_df[['ISBN', 'Format']].assign(**{
+        'Source': 'WorldCat',
+        'HEB_ID': book_positions.map(lambda book_pos: book_dicts[book_pos]['ID']),
+        'HEB_Title': book_positions.map(lambda book_pos: book_dicts[book_pos]['Title']),
+        'Book_Pos': book_positions
+    })
+    return complete_isbn_format_df
+
+
+# Match and classify the candidates for a chunk of books, returning each book's manifests
+def match_and_classify_batch(
+    book_dicts: Sequence[Dict[str, str]],
+    candidates: Sequence[Sequence[CatalogRecord]]
+) -> Sequence[pd.DataFrame]:
+    candidates_df = create_candidates_frame(candidates)
+    matches_df = run_checks_in_batch(book_dicts, candidates_df)
+    manifests_df = classify_in_batch(book_dicts, matches_df)
+    if manifests_df.empty:
+        return [pd.DataFrame({}) for _ in book_dicts]
+    manifests_by_book = dict(tuple(manifests_df.groupby('Book_Pos', sort=False)))
+    return [
+        manifests_by_book[book_pos].drop(columns=['Book_Pos']) if book_pos in manifests_by_book else pd.DataFrame({})
+        for book_pos in range(len(book_dicts))
+    ]
+
+
+# Functions - Chunk Processing
+
+# Fetch stage: each book's lookup, or None for books a transient request failure kept from being searched
+def fetch_chunk(book_dicts: Sequence[Dict[str, str]]) -> Sequence[Optional[Dict[str, Any]]]:
+    lookups = [find_indexed_lookup(new_book_dict) for new_book_dict in book_dicts]
+    pending_positions = [book_pos for book_pos, lookup in enumerate(lookups) if lookup is None]
+    if ISBN_FIRST_OPTS['ON']:
+        failed_positions = set()
+        for book_pos in pending_positions:
+            try:
+                lookups[book_pos] = try_fetch_isbn_lookup(book_dicts[book_pos])
+            except QuotaExceededError as error:
+                logger.error(f'Lookup failed and should be retried later: {error}')
+                failed_positions.add(book_pos)
+        pending_positions = [
+            book_pos for book_pos in pending_positions if lookups[book_pos] is None and book_pos not in failed_positions
+        ]
+    if SRU_BATCH_OPTS['ON']:
+        for book_pos, lookup in fetch_batched_lookups(book_dicts, pending_positions).items():
+            lookups[book_pos] = lookup
+        pending_positions = [book_pos for book_pos in pending_positions if lookups[book_pos] is None]
+    for book_pos in pending_positions:
+        new_book_dict = book_dicts[book_pos]
+        if logs_book_details(logger, new_book_dict['ID']):
+            logger.debug('Book: %s', new_book_dict)
+        logger.debug('Looking for "%s" in WorldCat...', Lazy(lambda: create_full_title(new_book_dict)))
+        try:
+            query_str = create_worldcat_query(new_book_dict)
+            lookups[book_pos] = {
+                'records': None,
+                'response': request_worldcat_query(query_str, maximum_records=PAGE_SIZE),
+                'query': query_str
+            }
+        except TransientRequestError as error:
+            logger.error(f'Lookup failed and should be retried later: {error}')
+    return lookups
+
+
+# Parse stage: each book's candidate records
+def parse_chunk(lookups: Sequence[Optional[Dict[str, Any]]]) -> Sequence[Optional[Sequence[CatalogRecord]]]:
+    chunk_candidates = []
+    for lookup in lookups:
+        records = None
+        if lookup is not None:
+            try:
+                records = parse_worldcat_lookup(lookup)
+            except TransientRequestError as error:
+                logger.error(f'Fetching more pages failed; lookup should be retried later: {error}')
+        chunk_candidates.append(records)
+    return chunk_candidates
+
+
+# Match/classify stage: each book's manifests (one at a time, or together in batch mode), or None for books
+# that were not searched
+def match_chunk(
+    book_dicts: Sequence[Dict[str, str]],
+    chunk_candidates: Sequence[Optional[Sequence[CatalogRecord]]],
+    lookups: Optional[Sequence[Optional[Dict[str, Any]]]] = None
+) -> Sequence[Optional[pd.DataFrame]]:
+    results = [None] * len(book_dicts)
+    searched_positions = [book_pos for book_pos, records in enumerate(chunk_candidates) if records is not None]
+    # Exact ISBN hits need no title and publisher comparison
+    if lookups is not None:
+        for book_pos in searched_positions:
+            if lookups[book_pos] is not None and lookups[book_pos].get('exact', False):
+                results[book_pos] = classify_and_find_unique_manifests(book_dicts[book_pos], chunk_candidates[book_pos])
+        searched_positions = [book_pos for book_pos in searched_positions if results[book_pos] is None]
+    searched_books = [book_dicts[book_pos] for book_pos in searched_positions]
+    candidates = [chunk_candidates[book_pos] for book_pos in searched_positions]
+    if BATCH_MODE_OPTS['ON']:
+        manifests = match_and_classify_batch(searched_books, candidates)
     else:
-        press_books_df = pd.read_csv(input_path, dtype=str)
+        manifests = []
+        for book_pos, new_book_dict, wc_records in zip(searched_positions, searched_books, candidates):
+            try:
+                manifests.append(
+                    match_with_lazy_paging(new_book_dict, wc_records, lookups[book_pos] if lookups else None)
+                )
+            except TransientRequestError as error:
+                logger.error(f'Fetching more pages failed; lookup should be retried later: {error}')
+                manifests.append(None)
+    for book_pos, unique_manifests_df in zip(searched_positions, manifests):
+        results[book_pos] = unique_manifests_df
+    return results
+
+
+# The number of candidate records parsed for each book (before any lazily fetched pages), or None for books
+# that were not searched
+def count_candidates(chunk_candidates: Sequence[Optional[Sequence[CatalogRecord]]]) -> Sequence[Optional[int]]:
+    return [len(records) if records is not None else None for records in chunk_candidates]
+
+
+# Look up, match and classify a chunk of books, returning each book's manifests, or None for books a
+# transient request failure kept from being searched
+def identify_chunk(book_dicts: Sequence[Dict[str, str]]) -> Sequence[Optional[pd.DataFrame]]:
+    return identify_chunk_with_counts(book_dicts)[0]
+
+
+# identify_chunk, also returning each book's number of candidate records for its summary
+def identify_chunk_with_counts(
+    book_dicts: Sequence[Dict[str, str]]
+) -> Tuple[Sequence[Optional[pd.DataFrame]], Sequence[Optional[int]]]:
+    lookups = fetch_chunk(book_dicts)
+    chunk_candidates = parse_chunk(lookups)
+    return match_chunk(book_dicts, chunk_candidates, lookups), count_candidates(chunk_candidates)
+
+
+# Run chunks through the fetch, parse and match stages concurrently, yielding each chunk with its results
+# (as identify_chunk_with_counts returns them) in input order; the caller's loop is the write stage
+def identify_chunks_in_pipeline(chunks: Sequence[Sequence[Dict[str, str]]]):
+    stages = [
+        Stage('fetch', lambda chunk: (chunk, fetch_chunk(chunk))),
+        Stage('parse', lambda fetched: (fetched[0], fetched[1], parse_chunk(fetched[1]))),
+        Stage('match', lambda parsed: (match_chunk(parsed[0], parsed[2], parsed[1]), count_candidates(parsed[2])))
+    ]
+    return run_pipeline(chunks, stages)
+
+
+# A book's result from the shard checkpoint or, in incremental mode, from an earlier run with the same input
+def find_stored_result(
+    book_dict: Dict[str, str],
+    checkpoint: Optional[Cache],
+    result_store: Optional[ResultStore]
+) -> Optional[pd.DataFrame]:
+    if checkpoint is not None and book_dict['ID'] in checkpoint:
+        return checkpoint[book_dict['ID']]
+    if result_store is not None:
+        return result_store.get(book_dict)
+    return None
+
+
+def save_output(df: pd.DataFrame, stem: str) -> None:
+    if OUTPUT_FORMAT == 'parquet':
+        save_parquet(df, 'data', stem, RUN_TS, index=False)
+    else:
+        df.to_csv(os.path.join('data', f'{stem}.csv'), index=False)
+
+
+def load_press_books() -> pd.DataFrame:
+    press_books_df = read_books_table(os.path.join(*BOOKS_CSV_PATH_ELEMS))
 
     # Crosswalk to consistent column names
     press_books_df = press_books_df.rename(columns=INPUT_TO_IDENTIFY_CW)
-    logger.debug(press_books_df.columns)
+    logger.debug('Input columns: %s', Lazy(lambda: list(press_books_df.columns)))
 
     # Limit number of records for testing purposes
     if TEST_MODE_OPTS['ON']:
         logger.info('TEST_MODE is ON.')
         press_books_df = press_books_df.iloc[:TEST_MODE_OPTS['NUM_RECORDS']]
+    return press_books_df
+
+
+def open_identify_result_store() -> Optional[ResultStore]:
+    return open_result_store(
+        'identify',
+        CONFIG_FILE_NAMES,
+        {
+            'TITLE_MATCH_THRESHOLD': TITLE_MATCH_THRESHOLD,
+            'PUBLISHER_MATCH_THRESHOLD': PUBLISHER_MATCH_THRESHOLD,
+            'WC_BIB_BASE_URL': WC_BIB_BASE_URL,
+            'OFFLINE_MODE': OFFLINE_MODE_OPTS,
+            'ISBN_FIRST': ISBN_FIRST_OPTS,
+            # Paging and batching change which records a book is matched against; worker counts do not
+            'SRU_PAGING': {key: value for key, value in SRU_PAGING_OPTS.items() if key != 'WORKERS'},
+            'SRU_BATCH': SRU_BATCH_OPTS,
+            'BATCH_MODE': BATCH_MODE_OPTS
+        },
+        FINGERPRINT_FIELD_PREFIXES
+    )
+
+
+def identify_books(shard: Optional[Tuple[int, int]] = None, fresh: bool = False) -> None:
+    if METRICS_OPTS.get('ON', False):
+        REGISTRY.start_periodic_export()
+
+    # Load input data
+    press_books_df = load_press_books()
+
+    # Keep only this shard's books; a sharded run checkpoints each book so it can be resumed
+    checkpoint = None
+    shard_suffix = create_shard_suffix(shard)
+    if shard is not None:
+        press_books_df = press_books_df.loc[select_shard_rows(press_books_df['ID'].to_list(), shard)]
+        checkpoint = open_checkpoint('identify', shard, fresh)
+        logger.info(f'Processing shard {shard[0]} of {shard[1]}: {len(press_books_df)} books')
+
+    # In incremental mode, books whose relevant fields and configuration are unchanged reuse earlier results
+    result_store = open_identify_result_store()
 
     # For each record, fetch WorldCat data, compare to record, analyze and accumulate matches
     match_manifest_df = pd.DataFrame({})
     non_matching_books = []
+    transient_failure_books = []
     num_books_with_matches = 0
 
-    for press_book_row_tup in press_books_df.iterrows():
-        new_book_dict = press_book_row_tup[1].to_dict()
-        logger.info(new_book_dict)
-
-        wc_records_df = look_up_book_in_worldcat(new_book_dict)
-        new_matches_df = run_checks_and_return_matches(new_book_dict, wc_records_df)
-        unique_manifests_df = classify_and_find_unique_manifests(new_book_dict, new_matches_df)
-
-        if unique_manifests_df.empty:
-            logger.warning(f'No matching records with ISBNs were found!')
+    book_dicts = [press_book_row_tup[1].to_dict() for press_book_row_tup in press_books_df.iterrows()]
+    results = [find_stored_result(new_book_dict, checkpoint, result_store) for new_book_dict in book_dicts]
+
+    # Process the books without a stored result in chunks (of one book unless in a batch mode)
+    pending_positions = [book_pos for book_pos, result in enumerate(results) if result is None]
+
+    # Under a daily quota, books answered from the cache go first, and the others only as far as the
+    # remaining budget covers; the rest are left for the next quota window
+    deferred_positions = set()
+    if DAILY_BUDGET_REF is not None:
+        uncached_counts = [count_uncached_requests(book_dicts[book_pos]) for book_pos in pending_positions]
+        remaining = DAILY_BUDGET_REF.remaining(WC_BIB_BASE_URL)
+        planned, deferred = plan_books(uncached_counts, remaining)
+        deferred_positions = {pending_positions[pending_pos] for pending_pos in deferred}
+        pending_positions = [pending_positions[pending_pos] for pending_pos in planned]
+        logger.info(
+            f'Quota plan: {uncached_counts.count(0)} books cached, {len(planned) - uncached_counts.count(0)} '
+            f'to request (budget left today: {remaining}), {len(deferred_positions)} deferred'
+        )
+    chunk_size = BATCH_MODE_OPTS.get('CHUNK_SIZE', 500) if BATCH_MODE_OPTS['ON'] else 1
+    if SRU_BATCH_OPTS['ON']:
+        # Books can only share a query with books in the same chunk
+        chunk_size = max(chunk_size, SRU_BATCH_OPTS.get('BOOKS_PER_QUERY', 5))
+    position_chunks = [
+        pending_positions[chunk_start:chunk_start + chunk_size]
+        for chunk_start in range(0, len(pending_positions), chunk_size)
+    ]
+    chunks = [[book_dicts[book_pos] for book_pos in position_chunk] for position_chunk in position_chunks]
+    if PIPELINE_OPTS['ON']:
+        chunk_results = identify_chunks_in_pipeline(chunks)
+    else:
+        chunk_results = ((chunk, identify_chunk_with_counts(chunk)) for chunk in chunks)
+
+    # Write stage: store each finished book's result as soon as its chunk is done
+    num_candidates = [None] * len(book_dicts)
+    for position_chunk, (chunk, (chunk_manifests, chunk_counts)) in zip(position_chunks, chunk_results):
+        for book_pos, new_book_dict, unique_manifests_df, count in zip(position_chunk, chunk, chunk_manifests, chunk_counts):
+            results[book_pos] = unique_manifests_df
+            num_candidates[book_pos] = count
+            if unique_manifests_df is not None:
+                if checkpoint is not None:
+                    checkpoint[new_book_dict['ID']] = unique_manifests_df
+                if result_store is not None:
+                    result_store.put(new_book_dict, unique_manifests_df)
+
+    for book_pos, (new_book_dict, unique_manifests_df) in enumerate(zip(book_dicts, results)):
+        # Books with stored results were not looked up in this run, so they have no candidate count
+        summary_fields = {'candidates': num_candidates[book_pos]} if num_candidates[book_pos] is not None else {}
+        if book_pos in deferred_positions:
+            book_result = 'deferred'
+        elif unique_manifests_df is None:
+            book_result = 'transient_failure'
+            transient_failure_books.append(new_book_dict)
+        elif unique_manifests_df.empty:
+            book_result = 'unmatched'
             non_matching_books.append(new_book_dict)
         else:
+            book_result = 'matched'
             num_books_with_matches += 1
             match_manifest_df = match_manifest_df.append(unique_manifests_df)
-            isbns = unique_manifests_df['ISBN'].drop_duplicates().to_list()
-            logger.info(f'Book successfully matched with record(s) with {len(isbns)} unique ISBN(s): {isbns}')
+            summary_fields.update({
+                'isbns': unique_manifests_df['ISBN'].nunique(),
+                'formats': ','.join(sorted(unique_manifests_df['Format'].dropna().unique()))
+            })
+        REGISTRY.inc('books_total', result=book_result)
+        log_book_summary(logger, new_book_dict['ID'], result=book_result, **summary_fields)
 
-    logger.debug('Matching Manifests')
-    logger.debug(match_manifest_df.describe())
+    logger.debug('Matching Manifests:\n%s', Lazy(lambda: match_manifest_df.describe()))
 
-    # Generate CSV output
+    # Generate CSV (or Parquet) output
     if not match_manifest_df.empty:
-        match_manifest_df.to_csv(os.path.join('data', 'matched_manifests.csv'), index=False)
+        save_output(match_manifest_df, 'matched_manifests' + shard_suffix)
 
     if non_matching_books:
         no_isbn_matches_df = pd.DataFrame(non_matching_books)
-        no_isbn_matches_df.to_csv(os.path.join('data', 'no_isbn_matches.csv'), index=False)
+        save_output(no_isbn_matches_df, 'no_isbn_matches' + shard_suffix)
+
+    if transient_failure_books:
+        transient_failures_df = pd.DataFrame(transient_failure_books)
+        save_output(transient_failures_df, f'transient_failures{shard_suffix}')
+
+    # Once the quota has run out, books that failed may have failed for lack of budget, so they are left for
+    # the next window along with the deferred ones
+    remainder_books = [book_dicts[book_pos] for book_pos in sorted(deferred_positions)]
+    if DAILY_BUDGET_REF is not None:
+        if DAILY_BUDGET_REF.is_exhausted(WC_BIB_BASE_URL):
+            remainder_books += transient_failure_books
+        root, ext = os.path.splitext(REMAINDER_PATH_STR)
+        write_remainder(remainder_books, root + shard_suffix + ext)
 
     # Log Summary Report
     report_str = '** Summary Report from identify.py **\n\n'
     report_str += f'-- Total number of books included in search: {len(press_books_df)}\n'
     report_str += f'-- Number of books successfully matched with records with ISBNs: {num_books_with_matches}\n'
     report_str += f'-- Number of books with no matching records: {len(non_matching_books)}\n'
+    report_str += f'-- Number of books not searched due to transient request failures: {len(transient_failure_books)}\n'
+    if DAILY_BUDGET_REF is not None:
+        report_str += f'-- Number of books left for the next quota window: {len(remainder_books)}\n'
     logger.info(f'\n\n{report_str}')
+    if result_store is not None:
+        result_store.log_summary()
+    save_publisher_variants()
+
+    if METRICS_OPTS.get('ON', False):
+        REGISTRY.finish()
     return None
 
 
 # Main Program
 
 if __name__ == '__main__':
-    identify_books()
+    parser = argparse.ArgumentParser(description='Identify books by searching WorldCat.')
+    parser.add_argument('--shard', type=parse_shard_spec, help='Process only shard i of N (i/N, numbered from 0)')
+    parser.add_argument('--fresh', action='store_true', help="Ignore the shard's checkpoint and start over")
+    args = parser.parse_args()
+    identify_books(args.shard, args.fresh)
@@ -0,0 +1,95 @@
+# incremental
+
+# standard libraries
+import hashlib, json, logging, os
+from typing import Any, Mapping, Optional, Sequence
+
+# third-party libraries
+import pandas as pd
+from diskcache import Cache
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+INCREMENTAL_OPTS = ENV.get('INCREMENTAL', {'ON': False})
+RESULTS_PATH_STR = os.path.join(*INCREMENTAL_OPTS.get('RESULTS_PATH', ['data', 'incremental_results']))
+
+
+# Functions
+
+# Hash the contents of the config files and the settings a script's results depend on, so that changing
+# a lookup, a crosswalk, or a threshold invalidates every stored result
+def create_config_version(config_file_names: Sequence[str], settings: Mapping[str, Any]) -> str:
+    version_hash = hashlib.sha1()
+    for config_file_name in sorted(config_file_names):
+        with open(os.path.join('config', config_file_name), 'rb') as config_file:
+            version_hash.update(config_file_name.encode('utf-8'))
+            version_hash.update(config_file.read())
+    version_hash.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    return version_hash.hexdigest()
+
+
+# Hash a row's relevant fields (those starting with one of the prefixes, or all of them) with the config version
+def create_row_fingerprint(
+    book_dict: Mapping[str, Any],
+    config_version: str,
+    field_prefixes: Optional[Sequence[str]] = None
+) -> str:
+    fields = {
+        str(field): None if pd.isna(value) else str(value)
+        for field, value in book_dict.items()
+        if field_prefixes is None or any(str(field).startswith(prefix) for prefix in field_prefixes)
+    }
+    row_str = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha1((config_version + row_str).encode('utf-8')).hexdigest()
+
+
+# Per-book results from earlier runs, keyed by script name and row fingerprint
+class ResultStore:
+
+    def __init__(self, script_name: str, config_version: str, field_prefixes: Optional[Sequence[str]] = None) -> None:
+        self.script_name = script_name
+        self.config_version = config_version
+        self.field_prefixes = field_prefixes
+        self.cache = Cache(RESULTS_PATH_STR)
+        self.num_reused = 0
+        self.num_computed = 0
+
+    def create_key(self, book_dict: Mapping[str, Any]) -> str:
+        return f'{self.script_name}:' + create_row_fingerprint(book_dict, self.config_version, self.field_prefixes)
+
+    def get(self, book_dict: Mapping[str, Any]) -> Optional[pd.DataFrame]:
+        result = self.cache.get(self.create_key(book_dict))
+        if result is not None:
+            self.num_reused += 1
+        return result
+
+    def put(self, book_dict: Mapping[str, Any], result: pd.DataFrame) -> None:
+        self.num_computed += 1
+        self.cache[self.create_key(book_dict)] = result
+
+    def log_summary(self) -> None:
+        logger.info(
+            f'Incremental run: reused {self.num_reused} stored results and computed {self.num_computed}'
+        )
+
+
+def open_result_store(
+    script_name: str,
+    config_file_names: Sequence[str],
+    settings: Mapping[str, Any],
+    field_prefixes: Optional[Sequence[str]] = None
+) -> Optional[ResultStore]:
+    if not INCREMENTAL_OPTS.get('ON', False):
+        return None
+    config_version = create_config_version(config_file_names, settings)
+    logger.info(f'Incremental mode is ON; config version {config_version[:12]}')
+    return ResultStore(script_name, config_version, field_prefixes)
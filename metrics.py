@@ -0,0 +1,215 @@
+# metrics
+
+# standard libraries
+import json, logging, os, threading, time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+METRICS_OPTS = ENV.get('METRICS', {})
+PROMETHEUS_PATH_STR = os.path.join(*METRICS_OPTS.get('PROMETHEUS_PATH', ['data', 'metrics.prom']))
+JSON_PATH_STR = os.path.join(*METRICS_OPTS.get('JSON_PATH', ['data', 'metrics.json']))
+EXPORT_INTERVAL = METRICS_OPTS.get('INTERVAL_SECONDS', 60)
+
+METRIC_PREFIX = 'ebook_ident_'
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Help text for each metric, which also fixes the order they are exported in
+METRIC_HELP = {
+    'requests_total': 'HTTP requests sent, by endpoint',
+    'http_responses_total': 'HTTP responses received, by endpoint and status code',
+    'request_latency_seconds': 'HTTP request latency in seconds, by endpoint',
+    'cache_hits_total': 'Cache lookups that found an entry, by cache store',
+    'cache_misses_total': 'Cache lookups that found no entry, by cache store',
+    'cache_revalidations_total': 'Stale request cache entries revalidated, by result',
+    'records_parsed_total': 'Catalog records parsed, by source',
+    'records_reused_total': 'Catalog records taken from the record store instead of being parsed again, by source',
+    'comparisons_total': 'Title/publisher comparisons',
+    'comparison_outcomes_total': 'Title/publisher comparison shortcuts and scores, by outcome',
+    'books_total': 'Books processed, by result'
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+# Classes
+
+class Histogram:
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    # Cumulative counts per upper bound, as Prometheus expects
+    def cumulative_counts(self) -> Sequence[Tuple[str, int]]:
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((str(bound), total))
+        cumulative.append(('+Inf', self.count))
+        return cumulative
+
+
+# Thread-safe store of counters and histograms; collectors are called at export time to report
+# values kept elsewhere (e.g. compare.COMPARISON_STATS) as counters
+class MetricsRegistry:
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.collectors: Sequence[Callable[[], Dict[str, Dict[Labels, float]]]] = []
+        self.lock = threading.Lock()
+        self.exporter: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = create_labels_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = create_labels_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(LATENCY_BUCKETS)
+            series[key].observe(value)
+
+    def register_collector(self, collector: Callable[[], Dict[str, Dict[Labels, float]]]) -> None:
+        self.collectors.append(collector)
+
+    def get_counter(self, name: str, **labels: str) -> float:
+        key = create_labels_key(labels)
+        with self.lock:
+            return self.counters.get(name, {}).get(key, 0)
+
+    def collect_counters(self) -> Dict[str, Dict[Labels, float]]:
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+        for collector in self.collectors:
+            for name, series in collector().items():
+                counters.setdefault(name, {}).update(series)
+        return counters
+
+    def to_json(self) -> Dict:
+        counters = self.collect_counters()
+        with self.lock:
+            histograms = {
+                name: [
+                    {
+                        'labels': dict(key),
+                        'buckets': dict(histogram.cumulative_counts()),
+                        'sum': histogram.sum,
+                        'count': histogram.count
+                    }
+                    for key, histogram in series.items()
+                ]
+                for name, series in self.histograms.items()
+            }
+        return {
+            'timestamp': time.time(),
+            'counters': {
+                name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                for name, series in counters.items()
+            },
+            'histograms': histograms
+        }
+
+    def to_prometheus(self) -> str:
+        counters = self.collect_counters()
+        lines = []
+        names = list(METRIC_HELP.keys()) + [
+            name for name in list(counters.keys()) + list(self.histograms.keys()) if name not in METRIC_HELP
+        ]
+        for name in names:
+            full_name = METRIC_PREFIX + name
+            if name in counters:
+                lines.append(f'# HELP {full_name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {full_name} counter')
+                for key, value in counters[name].items():
+                    lines.append(f'{full_name}{format_labels(key)} {value}')
+            elif name in self.histograms:
+                lines.append(f'# HELP {full_name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {full_name} histogram')
+                with self.lock:
+                    series = list(self.histograms[name].items())
+                for key, histogram in series:
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(f'{full_name}_bucket{format_labels(key + (("le", bound),))} {count}')
+                    lines.append(f'{full_name}_sum{format_labels(key)} {histogram.sum}')
+                    lines.append(f'{full_name}_count{format_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    # Write both exports, replacing the files atomically so the scheduler never reads a partial file
+    def export(self) -> None:
+        for path, content in [
+            (PROMETHEUS_PATH_STR, self.to_prometheus()),
+            (JSON_PATH_STR, json.dumps(self.to_json(), indent=2))
+        ]:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as export_file:
+                export_file.write(content)
+            os.replace(temp_path, path)
+
+    def start_periodic_export(self, interval: float = EXPORT_INTERVAL) -> None:
+        if self.exporter is not None:
+            return
+        self.stop_event.clear()
+
+        def export_loop() -> None:
+            while not self.stop_event.wait(interval):
+                try:
+                    self.export()
+                except OSError as error:
+                    logger.warning(f'Could not export metrics: {error}')
+
+        self.exporter = threading.Thread(target=export_loop, name='metrics-exporter', daemon=True)
+        self.exporter.start()
+
+    # Stop the periodic export and write the final values
+    def finish(self) -> None:
+        if self.exporter is not None:
+            self.stop_event.set()
+            self.exporter.join()
+            self.exporter = None
+        self.export()
+
+
+# Functions
+
+def create_labels_key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+
+
+def format_labels(key: Labels) -> str:
+    if not key:
+        return ''
+    label_strs = []
+    for label, value in key:
+        escaped_value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        label_strs.append(f'{label}="{escaped_value}"')
+    return '{' + ','.join(label_strs) + '}'
+
+
+REGISTRY = MetricsRegistry()
@@ -1,7 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import pandas as pd
-from hlapi import look_up_book_in_resource
+from db_cache import TransientRequestError
+from hlapi import look_up_book_in_resource, save_output, save_parquet
+from output_store import read_output, OUTPUT_FORMAT
 from tqdm import tqdm
 
+ISBN_COLS = ["ebook ISBN","paper ISBN","hardcover ISBN","Uncategorized ISBN"]
+
 def prepend_id_on_gb_record(df):
     for id in df.index.values:
         sor = df.at[id,'Sort']
@@ -14,23 +20,70 @@ def prepend_id_on_gb_record(df):
 # prepend_id_on_gb_record(df)
 # df.to_excel("outputs/fixed-full-output.xlsx",index=False)
 
-def remove_false_paper_positives(df):
-    isbn_cols = ["ebook ISBN","paper ISBN","hardcover ISBN","Uncategorized ISBN"]
-    id_list = df.index.values
-    tqdm_iter = tqdm(id_list)
-    tqdm_iter.set_description("Fixing paperback ISBNs")
-    for sort_id in tqdm_iter:
+# Map each parent (HEB) ID to the sort IDs of its LibraryCloud child rows
+def group_child_rows_by_parent(df):
+    child_rows = {}
+    for sort_id in df.index.values:
         if "HEB" not in df.at[sort_id,"ID"]:
             if "GB_API" not in df.at[sort_id,"ID"]:
                 hebid = sort_id.split("_")[0]
-                michpub_record_dict = df.loc[hebid].to_dict()
-                new_records = look_up_book_in_resource(michpub_record_dict)
-                if sort_id in new_records.index.values:
-                    for col_name in isbn_cols:
-                        df.at[sort_id,col_name] = None
-                        if col_name in new_records.columns.values:
-                            df.at[sort_id,col_name] = new_records.at[sort_id,col_name]
-
-df = pd.read_excel("outputs/2020-04-16-fixed-full-output.xlsx",index_col="Sort")
-remove_false_paper_positives(df)
-df.to_excel("outputs/fixed-full-output.xlsx")
+                child_rows.setdefault(hebid, []).append(sort_id)
+    return child_rows
+
+# Look up each parent record once, spreading the parents across a thread pool; a parent whose lookup kept
+# failing with transient request errors maps to None
+def look_up_parents(df, hebids, max_workers=4):
+    new_records_by_parent = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(look_up_book_in_resource, df.loc[hebid].to_dict()): hebid
+            for hebid in hebids
+        }
+        tqdm_iter = tqdm(as_completed(futures), total=len(futures))
+        tqdm_iter.set_description("Fixing paperback ISBNs")
+        for future in tqdm_iter:
+            hebid = futures[future]
+            try:
+                new_records_by_parent[hebid] = future.result()
+            except TransientRequestError as error:
+                print(f'Lookup of {hebid} failed and should be retried later: {error}')
+                new_records_by_parent[hebid] = None
+    return new_records_by_parent
+
+def remove_false_paper_positives(df, max_workers=4):
+    child_rows = group_child_rows_by_parent(df)
+    new_records_by_parent = look_up_parents(df, list(child_rows.keys()), max_workers)
+
+    # Child rows found again take the new ISBN columns (blank where the new record has none); rows of parents
+    # that could not be looked up are left as they are
+    corrections = []
+    failed_hebids = []
+    for hebid, sort_ids in child_rows.items():
+        new_records = new_records_by_parent[hebid]
+        if new_records is None:
+            failed_hebids.append(hebid)
+            continue
+        found_ids = [sort_id for sort_id in sort_ids if sort_id in new_records.index.values]
+        if found_ids:
+            corrections.append(new_records.loc[found_ids].reindex(columns=ISBN_COLS))
+
+    if corrections:
+        corrections_df = pd.concat(corrections).astype(object)
+        corrections_df = corrections_df.where(pd.notna(corrections_df), None)
+        # Outputs written without some of the ISBN columns get them (blank) before the assignment
+        missing_cols = [col for col in ISBN_COLS if col not in df.columns]
+        if missing_cols:
+            df = df.reindex(columns=list(df.columns) + missing_cols)
+        df.loc[corrections_df.index, ISBN_COLS] = corrections_df.values
+    return df, failed_hebids
+
+if __name__ == '__main__':
+    df = read_output("outputs/2020-04-16-fixed-full-output.xlsx")
+    df, failed_hebids = remove_false_paper_positives(df)
+    if failed_hebids:
+        print(f'{len(failed_hebids)} parents could not be looked up because requests kept failing; run them again')
+        save_output(df.loc[failed_hebids], 'fix_transient_failures', excel=False)
+    if OUTPUT_FORMAT == 'parquet':
+        save_parquet(df,"fixed-full-output")
+    else:
+        df.to_excel("outputs/fixed-full-output.xlsx")
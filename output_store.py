@@ -0,0 +1,84 @@
+# output_store
+
+# standard libraries
+import json, logging, os
+from typing import Optional, Sequence
+
+# third-party libraries
+import pandas as pd
+
+# local libraries
+from snapshot import read_input_table
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+OUTPUT_OPTS = ENV.get('OUTPUT', {})
+OUTPUT_FORMAT = OUTPUT_OPTS.get('FORMAT', 'csv')
+# None (one file per output), "run" (a dataset partitioned by run timestamp), or a column name like "Source"
+PARTITION_BY = OUTPUT_OPTS.get('PARTITION_BY', None)
+
+CATEGORICAL_COLUMNS = ['Format', 'Source', 'Publisher']
+RUN_COLUMN = 'Run'
+
+
+# Functions
+
+# Give output columns explicit types: ISBN columns become nullable strings (keeping leading zeros and X
+# check digits) and low-cardinality columns categoricals; all other columns keep the types they have
+def apply_output_dtypes(df: pd.DataFrame, categorical_columns: Sequence[str] = CATEGORICAL_COLUMNS) -> pd.DataFrame:
+    typed_df = df.copy()
+    for column in typed_df.columns:
+        if column in categorical_columns:
+            typed_df[column] = typed_df[column].map(str, na_action='ignore').astype('string').astype('category')
+        elif 'ISBN' in column:
+            typed_df[column] = typed_df[column].map(str, na_action='ignore').astype('string')
+    return typed_df
+
+
+# Write a typed Parquet file, or a partitioned Parquet dataset, and return its path; outputs without the
+# partitioning column (e.g. transient failure lists) are written as one file
+def save_parquet(
+    df: pd.DataFrame,
+    out_dir: str,
+    stem: str,
+    run_ts: str,
+    index: bool = True,
+    partition_by: Optional[str] = PARTITION_BY
+) -> str:
+    typed_df = apply_output_dtypes(df)
+    if index and typed_df.index.name is None:
+        typed_df.index.name = 'Sort'
+
+    if partition_by == 'run':
+        # One dataset per output accumulating a partition per run
+        typed_df[RUN_COLUMN] = pd.Categorical([run_ts] * len(typed_df))
+        path = os.path.join(out_dir, f'{stem}.parquet')
+        typed_df.to_parquet(path, index=index, partition_cols=[RUN_COLUMN])
+    elif partition_by is not None and partition_by in typed_df.columns:
+        path = os.path.join(out_dir, f'{run_ts}-{stem}.parquet')
+        typed_df.to_parquet(path, index=index, partition_cols=[partition_by])
+    else:
+        path = os.path.join(out_dir, f'{run_ts}-{stem}.parquet')
+        typed_df.to_parquet(path, index=index)
+    logger.info(f'Wrote {len(typed_df)} rows to {path}')
+    return path
+
+
+# Read an output back in whichever format it was written
+def read_output(path: str, index_col: Optional[str] = 'Sort', run_ts: Optional[str] = None) -> pd.DataFrame:
+    if path.endswith('.parquet') or os.path.isdir(path):
+        filters = [(RUN_COLUMN, '=', run_ts)] if run_ts is not None else None
+        df = pd.read_parquet(path, filters=filters)
+        if index_col is not None and index_col in df.columns:
+            df = df.set_index(index_col)
+        return df
+    return read_input_table(path, index_col=index_col)
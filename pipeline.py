@@ -0,0 +1,160 @@
+# pipeline
+
+# standard libraries
+import json, logging, os, queue, threading
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Tuple
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+PIPELINE_OPTS = ENV.get('PIPELINE', {'ON': False})
+QUEUE_SIZE = PIPELINE_OPTS.get('QUEUE_SIZE', 8)
+STAGE_WORKERS = PIPELINE_OPTS.get('WORKERS', {})
+
+# Marks the end of a stage's input
+DONE = object()
+
+
+# Classes
+
+class Stage:
+
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: Optional[int] = None) -> None:
+        self.name = name
+        self.func = func
+        self.workers = workers if workers is not None else STAGE_WORKERS.get(name.upper(), 1)
+
+
+# Carries an exception raised by a stage through the later stages to the consumer
+class StageFailure:
+
+    def __init__(self, stage_name: str, error: BaseException) -> None:
+        self.stage_name = stage_name
+        self.error = error
+
+
+# Functions
+
+# Put an item on a bounded queue, giving up if the pipeline is stopped while waiting for room
+def put_unless_stopped(out_queue: queue.Queue, item: Any, stop_event: threading.Event) -> bool:
+    while not stop_event.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_stage_worker(
+    stage: Stage,
+    in_queue: queue.Queue,
+    out_queue: queue.Queue,
+    finished: Callable[[], None],
+    stop_event: threading.Event
+) -> None:
+    while not stop_event.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is DONE:
+            finished()
+            return
+        seq, value = item
+        if not isinstance(value, StageFailure):
+            try:
+                value = stage.func(value)
+            except Exception as error:
+                logger.error(f'Pipeline stage {stage.name} failed: {error}')
+                value = StageFailure(stage.name, error)
+        put_unless_stopped(out_queue, (seq, value), stop_event)
+
+
+# Run items through the stages, each stage with its own worker threads and a bounded queue in front of it,
+# yielding (item, result) pairs in input order. The number of items in flight is capped, so a slow item
+# cannot let finished ones pile up. If a stage raises, the results before that item are still yielded
+# before the error is re-raised.
+def run_pipeline(
+    items: Iterable[Any],
+    stages: Sequence[Stage],
+    queue_size: int = QUEUE_SIZE
+) -> Iterator[Tuple[Any, Any]]:
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    max_in_flight = queue_size * len(queues) + sum(stage.workers for stage in stages)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    stop_event = threading.Event()
+    items_by_seq = {}
+
+    def feed() -> None:
+        for seq, item in enumerate(items):
+            while not in_flight.acquire(timeout=0.1):
+                if stop_event.is_set():
+                    break
+            if stop_event.is_set():
+                break
+            items_by_seq[seq] = item
+            if not put_unless_stopped(queues[0], (seq, item), stop_event):
+                return
+        for _ in range(stages[0].workers):
+            put_unless_stopped(queues[0], DONE, stop_event)
+
+    # When the last worker of a stage finishes, the next stage's workers (or the consumer) are told to finish
+    def create_finished_callback(stage_pos: int) -> Callable[[], None]:
+        remaining = [stages[stage_pos].workers]
+        lock = threading.Lock()
+
+        def finished() -> None:
+            with lock:
+                remaining[0] -= 1
+                is_last = remaining[0] == 0
+            if is_last:
+                num_next = stages[stage_pos + 1].workers if stage_pos + 1 < len(stages) else 1
+                for _ in range(num_next):
+                    put_unless_stopped(queues[stage_pos + 1], DONE, stop_event)
+        return finished
+
+    threads = [threading.Thread(target=feed, name='pipeline-feed', daemon=True)]
+    for stage_pos, stage in enumerate(stages):
+        finished = create_finished_callback(stage_pos)
+        for worker_num in range(stage.workers):
+            threads.append(threading.Thread(
+                target=run_stage_worker,
+                args=(stage, queues[stage_pos], queues[stage_pos + 1], finished, stop_event),
+                name=f'pipeline-{stage.name}-{worker_num}',
+                daemon=True
+            ))
+    for thread in threads:
+        thread.start()
+
+    # Reorder results so they are yielded in input order
+    pending_results = {}
+    next_seq = 0
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is DONE:
+                break
+            seq, value = item
+            pending_results[seq] = value
+            while next_seq in pending_results:
+                value = pending_results.pop(next_seq)
+                if isinstance(value, StageFailure):
+                    raise value.error
+                yield items_by_seq.pop(next_seq), value
+                in_flight.release()
+                next_seq += 1
+    finally:
+        # On an error or when the consumer stops early, the feeder and workers stop taking and queueing
+        # items; wait for them to finish the items they are working on and exit
+        stop_event.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,129 @@
+# publisher_authority
+
+# standard libraries
+import csv, json, logging, os
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+# third-party libraries
+from diskcache import Cache
+
+# local libraries
+from compare import normalize, normalize_univ
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+PUBLISHER_AUTHORITY_OPTS = ENV.get('PUBLISHER_AUTHORITY', {'ON': False})
+AUTHORITY_PATH_STR = os.path.join(*PUBLISHER_AUTHORITY_OPTS.get('PATH', ['data', 'publisher_authority']))
+
+DecisionKey = Tuple[str, str, float, bool]
+
+
+# Functions
+
+# The canonical form of a publisher name: the form publisher comparisons score
+def canonicalize_publisher(publisher: str) -> str:
+    return normalize_univ(normalize(publisher))
+
+
+# Cache keys are tuples tagged by kind, so names containing any character round-trip unchanged
+def create_decision_cache_key(decision_key: DecisionKey) -> Tuple[str, float, bool, str, str]:
+    norm_left, norm_right, thresh, allows_partial = decision_key
+    return ('dec', thresh, allows_partial, norm_left, norm_right)
+
+
+def create_variant_cache_key(publisher: str) -> Tuple[str, str]:
+    return ('var', publisher)
+
+
+# Classes
+
+# Persistent table of publisher variants and their canonical forms, plus the outcome of every comparison of
+# two canonical forms at a threshold. Decisions are held in memory as well, so each one costs a disk read
+# at most once per run. Variants are only read by export, so they are kept in memory while comparing and
+# written together by save_variants. Used as the decisions mapping of compare.create_compare_func.
+class PublisherAuthority(MutableMapping):
+
+    def __init__(self, path: str = AUTHORITY_PATH_STR) -> None:
+        self.cache = Cache(path)
+        self.decisions: Dict[DecisionKey, Optional[bool]] = {}
+        self.variants: Dict[str, str] = {}
+        self.unsaved_variants: Set[str] = set()
+
+    def __getitem__(self, decision_key: DecisionKey) -> bool:
+        if decision_key not in self.decisions:
+            self.decisions[decision_key] = self.cache.get(create_decision_cache_key(decision_key))
+        decision = self.decisions[decision_key]
+        if decision is None:
+            raise KeyError(decision_key)
+        return decision
+
+    def __setitem__(self, decision_key: DecisionKey, matched: bool) -> None:
+        self.decisions[decision_key] = matched
+        self.cache[create_decision_cache_key(decision_key)] = matched
+
+    def __delitem__(self, decision_key: DecisionKey) -> None:
+        self.decisions.pop(decision_key, None)
+        del self.cache[create_decision_cache_key(decision_key)]
+
+    def __iter__(self) -> Iterator[DecisionKey]:
+        for cache_key in self.cache.iterkeys():
+            if isinstance(cache_key, tuple) and cache_key[0] == 'dec':
+                _, thresh, allows_partial, norm_left, norm_right = cache_key
+                yield (norm_left, norm_right, thresh, allows_partial)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in iter(self))
+
+    # Note a publisher name as it appears in the data, returning its canonical form
+    def add_variant(self, publisher: str) -> str:
+        if publisher not in self.variants:
+            self.variants[publisher] = canonicalize_publisher(publisher)
+            self.unsaved_variants.add(publisher)
+        return self.variants[publisher]
+
+    # Write the variants noted since the last save to the table in one transaction
+    def save_variants(self) -> None:
+        unsaved_variants, self.unsaved_variants = self.unsaved_variants, set()
+        with self.cache.transact():
+            for publisher in unsaved_variants:
+                self.cache[create_variant_cache_key(publisher)] = self.variants[publisher]
+        logger.info(f'Saved {len(unsaved_variants)} publisher variants to the publisher authority table')
+
+    # Write the variants and the canonical pairs found to match, for review
+    def export(self, path: str) -> None:
+        with open(path, 'w', newline='') as export_file:
+            writer = csv.writer(export_file)
+            writer.writerow(['Kind', 'Left', 'Right', 'Threshold', 'Matched'])
+            for cache_key in self.cache.iterkeys():
+                if not isinstance(cache_key, tuple):
+                    continue
+                if cache_key[0] == 'var':
+                    writer.writerow(['variant', cache_key[1], self.cache[cache_key], '', ''])
+                elif cache_key[0] == 'dec':
+                    _, thresh, _, norm_left, norm_right = cache_key
+                    writer.writerow(['decision', norm_left, norm_right, thresh, self.cache[cache_key]])
+
+
+def open_publisher_authority() -> Optional[PublisherAuthority]:
+    if not PUBLISHER_AUTHORITY_OPTS.get('ON', False):
+        return None
+    return PublisherAuthority()
+
+
+# Main Program
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    export_path = os.path.join('data', 'publisher_authority.csv')
+    PublisherAuthority().export(export_path)
+    logger.info(f'Wrote the publisher authority table to {export_path}')
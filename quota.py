@@ -0,0 +1,104 @@
+# quota
+
+# standard libraries
+import json, logging, os
+from datetime import date
+from typing import Dict, Optional, Sequence, Tuple
+
+# third-party libraries
+import pandas as pd
+from diskcache import Cache
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+QUOTA_OPTS = ENV.get('QUOTA', {'ON': False})
+DAILY_BUDGET = QUOTA_OPTS.get('DAILY_BUDGET', 50000)
+USAGE_PATH_STR = os.path.join(*QUOTA_OPTS.get('USAGE_PATH', ['data', 'quota_usage']))
+REMAINDER_PATH_STR = os.path.join(*QUOTA_OPTS.get('REMAINDER_PATH', ['data', 'quota_remainder.csv']))
+
+# Only the WorldCat Search API has a daily request quota
+BUDGETED_URLS = [ENV['WORLDCAT']['BIB_RESOURCE_BASE_URL']] if 'WORLDCAT' in ENV else []
+
+
+# Classes
+
+# Requests sent to an endpoint today, counted on disk so that every run (and shard) on a machine draws
+# from the same daily budget
+class DailyBudget:
+
+    def __init__(self, budget: int = DAILY_BUDGET, path: str = USAGE_PATH_STR) -> None:
+        self.budget = budget
+        self.cache = Cache(path)
+
+    def create_key(self, url: str) -> str:
+        return f'{date.today().isoformat()}|{url}'
+
+    def remaining(self, url: str) -> int:
+        return max(0, self.budget - self.cache.get(self.create_key(url), 0))
+
+    # Count a request against the budget, returning False (without counting it) if none is left
+    def spend(self, url: str) -> bool:
+        key = self.create_key(url)
+        if self.cache.incr(key, default=0) > self.budget:
+            self.cache.decr(key)
+            return False
+        return True
+
+    # The API reported the quota as used up, whatever our count says
+    def mark_exhausted(self, url: str) -> None:
+        self.cache[self.create_key(url)] = self.budget
+
+    def is_exhausted(self, url: str) -> bool:
+        return self.remaining(url) == 0
+
+
+# Functions
+
+def open_daily_budget() -> Optional[DailyBudget]:
+    if not QUOTA_OPTS.get('ON', False):
+        return None
+    return DailyBudget()
+
+
+DAILY_BUDGET_REF = open_daily_budget()
+
+
+def is_budgeted(url: str) -> bool:
+    return DAILY_BUDGET_REF is not None and url in BUDGETED_URLS
+
+
+# Order books so those whose planned requests are all cached come first, then as many of the others (in
+# input order) as the remaining budget covers; returns the positions to process and the positions deferred
+# to the next quota window
+def plan_books(uncached_counts: Sequence[int], remaining: int) -> Tuple[Sequence[int], Sequence[int]]:
+    cached_positions = [book_pos for book_pos, count in enumerate(uncached_counts) if count == 0]
+    planned_positions = list(cached_positions)
+    deferred_positions = []
+    for book_pos, count in enumerate(uncached_counts):
+        if count == 0:
+            continue
+        if deferred_positions or count > remaining:
+            deferred_positions.append(book_pos)
+        else:
+            planned_positions.append(book_pos)
+            remaining -= count
+    return planned_positions, deferred_positions
+
+
+# Write the books left for the next quota window; running with this file as the input resumes the work
+def write_remainder(books: Sequence[Dict[str, str]], path: str = REMAINDER_PATH_STR) -> None:
+    if not books:
+        if os.path.isfile(path):
+            os.remove(path)
+        return
+    pd.DataFrame(books).to_csv(path, index=False)
+    logger.info(f'Wrote {len(books)} books left for the next quota window to {path}')
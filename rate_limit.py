@@ -0,0 +1,108 @@
+# rate_limit
+
+# standard libraries
+import json, logging, os, random, threading, time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+# Requests per second and burst size for each base URL, with a DEFAULT entry for everything else
+RATE_LIMITS = ENV.get('RATE_LIMITS', {})
+DEFAULT_RATE_LIMIT = RATE_LIMITS.get('DEFAULT', {'RATE': 5.0, 'BURST': 5})
+
+RETRY_OPTS = ENV.get('RETRY', {})
+MAX_RETRIES = RETRY_OPTS.get('MAX_RETRIES', 5)
+BASE_DELAY = RETRY_OPTS.get('BASE_DELAY', 1.0)
+MAX_DELAY = RETRY_OPTS.get('MAX_DELAY', 60.0)
+
+# Status codes worth retrying: 403 (API limit), 429 (too many requests), and server errors
+RETRY_STATUS_CODES = {403, 429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {403, 429}
+
+
+# Classes
+
+# Token bucket that blocks callers until a token is available; the refill rate is cut when the
+# server throttles and recovers gradually toward the configured rate as requests succeed
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float, min_rate: Optional[float] = None) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+        logger.warning(f'Throttled; reduced request rate to {self.rate:.2f}/s')
+
+    def speed_up(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+BUCKETS: Dict[str, TokenBucket] = {}
+BUCKETS_LOCK = threading.Lock()
+
+
+# Functions
+
+def get_bucket(base_url: str) -> TokenBucket:
+    with BUCKETS_LOCK:
+        if base_url not in BUCKETS:
+            limit = RATE_LIMITS.get(base_url, DEFAULT_RATE_LIMIT)
+            BUCKETS[base_url] = TokenBucket(limit['RATE'], limit['BURST'])
+        return BUCKETS[base_url]
+
+
+# Read a Retry-After header given either in seconds or as an HTTP date
+def parse_retry_after(header_value: Optional[str]) -> Optional[float]:
+    if not header_value:
+        return None
+    try:
+        return max(0.0, float(header_value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(header_value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+# Exponential backoff with full jitter, unless the server said how long to wait
+def compute_backoff(attempt: int, retry_after: Optional[float] = None) -> float:
+    if retry_after is not None:
+        return min(retry_after, MAX_DELAY)
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
@@ -0,0 +1,193 @@
+# record_index
+
+# standard libraries
+import hashlib, json, logging, math, os, re
+from collections import Counter
+from typing import Callable, Dict, Optional, Sequence, Set, Tuple
+
+# third-party libraries
+from diskcache import Cache
+
+# local libraries
+from compare import normalize, normalize_univ
+from db_cache import get_cached_text, DB_CACHE_PATH_STR
+from metrics import REGISTRY
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+OFFLINE_MODE_OPTS = ENV.get('OFFLINE_MODE', {})
+INDEX_PATH_STR = os.path.join(*OFFLINE_MODE_OPTS.get('INDEX_PATH', ['data', 'record_index']))
+MIN_TITLE_OVERLAP = OFFLINE_MODE_OPTS.get('MIN_TITLE_OVERLAP', 0.75)
+
+WORD_PATTERN = re.compile(r'\w+')
+ISBN_DIGITS_PATTERN = re.compile(r'\b[0-9]{9}[0-9Xx]\b|\b97[89][0-9]{10}\b')
+STOP_WORDS = {'a', 'an', 'and', 'the', 'of'}
+
+TITLE_FIELDS = ['Title', 'Main Title', 'Subtitle']
+AUTHOR_FIELDS = ['Author']
+PUBLISHER_FIELDS = ['Publisher']
+
+INDEXED_REQUESTS_KEY = 'indexed_requests'
+
+
+# Functions - Tokens
+
+# Collect values for a field name and its numbered or subfield variants (e.g. "Publisher 2", "ISBN a 1")
+def collect_field_values(record: Dict[str, str], field_names: Sequence[str]) -> Sequence[str]:
+    values = []
+    for key, value in record.items():
+        if not isinstance(value, str) or value == '':
+            continue
+        for field_name in field_names:
+            if key == field_name or key.startswith(field_name + ' '):
+                values.append(value)
+                break
+    return values
+
+
+def create_word_tokens(input: str, transforms: Sequence[Callable] = []) -> Set[str]:
+    norm_input = normalize(input)
+    for transform in transforms:
+        norm_input = transform(norm_input)
+    return {word for word in WORD_PATTERN.findall(norm_input) if word not in STOP_WORDS}
+
+
+def convert_isbn10_to_isbn13(isbn: str) -> str:
+    if len(isbn) != 10:
+        return isbn
+    core = '978' + isbn[:9]
+    total = sum(int(digit) * (1 if i % 2 == 0 else 3) for i, digit in enumerate(core))
+    return core + str((10 - total % 10) % 10)
+
+
+def extract_isbns(input: str) -> Set[str]:
+    return {convert_isbn10_to_isbn13(isbn.upper()) for isbn in ISBN_DIGITS_PATTERN.findall(input.replace('-', ''))}
+
+
+# Create the prefixed index tokens for a record (ti: title words, au: author words, pu: publisher words, isbn:)
+def create_index_tokens(record: Dict[str, str]) -> Set[str]:
+    tokens = set()
+    for value in collect_field_values(record, TITLE_FIELDS):
+        tokens.update('ti:' + word for word in create_word_tokens(value))
+    for value in collect_field_values(record, AUTHOR_FIELDS):
+        tokens.update('au:' + word for word in create_word_tokens(value))
+    for key, value in record.items():
+        if key.startswith('Author ') and key.endswith(('Family', 'Name')) and isinstance(value, str):
+            tokens.update('au:' + word for word in create_word_tokens(value))
+    for value in collect_field_values(record, PUBLISHER_FIELDS):
+        tokens.update('pu:' + word for word in create_word_tokens(value, [normalize_univ]))
+    for key, value in record.items():
+        if 'ISBN' in key and isinstance(value, str):
+            tokens.update('isbn:' + isbn for isbn in extract_isbns(value))
+    return tokens
+
+
+# Identify a record by its control number or identifier, falling back to a hash of its contents
+def create_record_key(source: str, record: Dict[str, str]) -> str:
+    for id_field in ['Control_Number', 'ID']:
+        if isinstance(record.get(id_field), str) and record[id_field] != '':
+            return f'{source}:{record[id_field]}'
+    record_str = json.dumps({k: str(v) for k, v in record.items()}, sort_keys=True)
+    return f'{source}:{hashlib.sha1(record_str.encode()).hexdigest()}'
+
+
+# Functions - Building
+
+def add_records(source: str, records: Sequence[Dict[str, str]], ref: Optional[Cache] = None) -> int:
+    if ref is None:
+        with Cache(INDEX_PATH_STR) as new_ref:
+            return add_records(source, records, new_ref)
+
+    postings = {}
+    for record in records:
+        record_key = create_record_key(source, record)
+        ref['rec:' + record_key] = dict(record)
+        for token in create_index_tokens(record):
+            postings.setdefault(token, set()).add(record_key)
+
+    # Merge postings in one transaction, so concurrent writers (e.g. identify runs sharing the index) cannot
+    # overwrite each other's record keys between the read and the write
+    with ref.transact():
+        for token, record_keys in postings.items():
+            ref['tok:' + token] = ref.get('tok:' + token, set()) | record_keys
+    return len(records)
+
+
+# Parse every cached response whose request string starts with a known base URL and index its records;
+# parsers maps base URL -> (source name, parser returning a list of record dicts)
+def build_index(parsers: Dict[str, Tuple[str, Callable[[str], Sequence[Dict[str, str]]]]]) -> int:
+    num_records = 0
+    with Cache(DB_CACHE_PATH_STR) as cache_ref, Cache(INDEX_PATH_STR) as index_ref:
+        indexed_requests = index_ref.get(INDEXED_REQUESTS_KEY, set())
+        # Longer base URLs first, so that e.g. .../items.json requests are not parsed as .../items ones
+        sorted_parsers = sorted(parsers.items(), key=lambda parser_item: len(parser_item[0]), reverse=True)
+        for request_key in cache_ref.iterkeys():
+            if request_key in indexed_requests:
+                continue
+            for base_url, (source, parser) in sorted_parsers:
+                if request_key.startswith(base_url):
+                    response_text = get_cached_text(cache_ref[request_key])
+                    if response_text:
+                        num_records += add_records(source, parser(response_text), index_ref)
+                    break
+            indexed_requests.add(request_key)
+        index_ref[INDEXED_REQUESTS_KEY] = indexed_requests
+    logger.info(f'Indexed {num_records} records from {DB_CACHE_PATH_STR} into {INDEX_PATH_STR}')
+    return num_records
+
+
+# Functions - Searching
+
+# Retrieve indexed records from a source sharing most title words with the query (and any author word)
+def find_candidates(source: str, title: str, author: Optional[str] = None) -> Sequence[Dict[str, str]]:
+    title_tokens = {'ti:' + word for word in create_word_tokens(title)}
+    if not title_tokens:
+        return []
+    author_tokens = {'au:' + word for word in create_word_tokens(author)} if isinstance(author, str) else set()
+
+    with Cache(INDEX_PATH_STR) as ref:
+        counts = Counter()
+        for token in title_tokens:
+            counts.update(ref.get('tok:' + token, set()))
+        num_needed = math.ceil(MIN_TITLE_OVERLAP * len(title_tokens))
+        record_keys = {
+            record_key for record_key, count in counts.items()
+            if count >= num_needed and record_key.startswith(source + ':')
+        }
+
+        if author_tokens and record_keys:
+            author_record_keys = set()
+            for token in author_tokens:
+                author_record_keys |= ref.get('tok:' + token, set())
+            record_keys &= author_record_keys
+
+        REGISTRY.inc('cache_hits_total' if record_keys else 'cache_misses_total', store='record_index')
+        return [ref['rec:' + record_key] for record_key in sorted(record_keys)]
+
+
+# Main Program
+
+if __name__ == '__main__':
+    logging.basicConfig(level=ENV.get('LOG_LEVEL', 'DEBUG'))
+    from identify import parse_marcxml, WC_BIB_BASE_URL
+    index_parsers = {WC_BIB_BASE_URL: ('WorldCat', parse_marcxml)}
+    if 'RESOURCE' in ENV:
+        from hlapi import parse_modsjson, parse_modsxml, BIB_BASE_URL, BIB_JSON_URL
+        index_parsers[BIB_BASE_URL] = (
+            'Harvard Library',
+            lambda response_text: list(parse_modsxml(response_text, {'ID': ''}).values())
+        )
+        index_parsers[BIB_JSON_URL] = (
+            'Harvard Library',
+            lambda response_text: list(parse_modsjson(response_text, {'ID': ''}).values())
+        )
+    build_index(index_parsers)
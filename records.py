@@ -0,0 +1,135 @@
+# records
+
+# standard libraries
+import sys, threading
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+# third-party libraries
+import numpy as np
+import pandas as pd
+
+# local libraries
+from metrics import REGISTRY
+
+
+# Initializing settings and global variables
+
+# Values longer than this (e.g. notes, long titles) are rarely repeated, so they are not worth interning
+INTERN_MAX_LEN = 100
+
+
+# Classes
+
+# The field names shared by every record parsed with the same set of keys, with a position lookup
+class RecordSchema:
+    __slots__ = ('fields', 'positions')
+
+    def __init__(self, fields: Tuple[str, ...]) -> None:
+        self.fields = fields
+        self.positions = {field: position for position, field in enumerate(fields)}
+
+
+SCHEMAS: Dict[Tuple[str, ...], RecordSchema] = {}
+
+
+def get_schema(fields: Iterable[str]) -> RecordSchema:
+    field_tuple = tuple(sys.intern(field) for field in fields)
+    schema = SCHEMAS.get(field_tuple)
+    if schema is None:
+        schema = SCHEMAS.setdefault(field_tuple, RecordSchema(field_tuple))
+    return schema
+
+
+def intern_value(value: Any) -> Any:
+    if isinstance(value, str) and len(value) <= INTERN_MAX_LEN:
+        return sys.intern(value)
+    return value
+
+
+# A read-only parsed catalog record: a shared schema plus a tuple of values, used wherever the
+# code previously held one dict (with its own copies of the keys) per record
+class CatalogRecord(Mapping):
+    __slots__ = ('schema', 'values_')
+
+    def __init__(self, schema: RecordSchema, values: Tuple[Any, ...]) -> None:
+        self.schema = schema
+        self.values_ = values
+
+    @classmethod
+    def from_dict(cls, record_dict: Dict[str, Any]) -> 'CatalogRecord':
+        return cls(get_schema(record_dict.keys()), tuple(intern_value(value) for value in record_dict.values()))
+
+    def __getitem__(self, key: str) -> Any:
+        return self.values_[self.schema.positions[key]]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.schema.positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.schema.fields)
+
+    def __len__(self) -> int:
+        return len(self.values_)
+
+    def __repr__(self) -> str:
+        return f'CatalogRecord({self.to_dict()})'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(zip(self.schema.fields, self.values_))
+
+
+# Run-wide store of parsed records keyed by source and record identifier (WorldCat control number or
+# LibraryCloud recordIdentifier), so a record returned for many queries is parsed once and every result set
+# holds a reference to the same record
+class RecordStore:
+
+    def __init__(self) -> None:
+        self.records: Dict[Tuple[str, str], CatalogRecord] = {}
+        self.lock = threading.Lock()
+        # Records returned from the store instead of being parsed again, by source
+        self.num_reused: Dict[str, int] = {}
+
+    def get(self, source: str, record_id: str) -> Optional[CatalogRecord]:
+        with self.lock:
+            record = self.records.get((source, record_id))
+            if record is not None:
+                self.num_reused[source] = self.num_reused.get(source, 0) + 1
+        return record
+
+    # Keep the first record stored under an ID and return it
+    def add(self, source: str, record_id: str, record: CatalogRecord) -> CatalogRecord:
+        with self.lock:
+            return self.records.setdefault((source, record_id), record)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.records.clear()
+            self.num_reused = {}
+
+    def collect_metrics(self) -> Dict[str, Dict[Tuple[Tuple[str, str], ...], int]]:
+        with self.lock:
+            return {'records_reused_total': {(('source', source),): num for source, num in self.num_reused.items()}}
+
+
+RECORD_STORE = RecordStore()
+REGISTRY.register_collector(RECORD_STORE.collect_metrics)
+
+
+# Functions
+
+# Build a DataFrame column by column from records; fields missing from a record become NaN, as they
+# would when building the frame from a list of dicts
+def records_to_frame(records: Sequence[Mapping], index: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    if len(records) == 0:
+        return pd.DataFrame({})
+
+    columns = {}
+    for record in records:
+        for field in record:
+            columns.setdefault(field, None)
+    data = {
+        column: [record[column] if column in record else np.nan for record in records]
+        for column in columns
+    }
+    return pd.DataFrame(data, index=index)
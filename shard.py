@@ -0,0 +1,175 @@
+# shard
+
+# standard libraries
+import argparse, glob, hashlib, logging, os, re
+from typing import Optional, Sequence, Tuple
+
+# third-party libraries
+import pandas as pd
+from diskcache import Cache
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+SHARD_SPEC_PATTERN = re.compile(r'^(\d+)/(\d+)$')
+
+IDENTIFY_OUTPUT_STEMS = ['matched_manifests', 'no_isbn_matches', 'transient_failures']
+
+
+# Functions - Sharding
+
+# Parse a shard specification like "2/8" (the third of eight shards; shards are numbered from 0)
+def parse_shard_spec(spec: str) -> Tuple[int, int]:
+    match = SHARD_SPEC_PATTERN.match(spec.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f'Shard must be given as i/N, not {spec}')
+    shard_index, num_shards = int(match.group(1)), int(match.group(2))
+    if num_shards < 1 or shard_index >= num_shards:
+        raise argparse.ArgumentTypeError(f'Shard index must be between 0 and {num_shards - 1}')
+    return shard_index, num_shards
+
+
+# Assign an ID to a shard with a hash that is stable across processes and machines (unlike hash())
+def find_shard_for_id(book_id: str, num_shards: int) -> int:
+    return int(hashlib.md5(str(book_id).encode('utf-8')).hexdigest(), 16) % num_shards
+
+
+def select_shard_rows(ids: Sequence[str], shard: Tuple[int, int]) -> Sequence[bool]:
+    shard_index, num_shards = shard
+    return [find_shard_for_id(book_id, num_shards) == shard_index for book_id in ids]
+
+
+def create_shard_suffix(shard: Optional[Tuple[int, int]]) -> str:
+    if shard is None:
+        return ''
+    return f'.shard-{shard[0]}-of-{shard[1]}'
+
+
+# Find the parent book ID of each row of hlapi output: parents have no underscore in their sort ID,
+# LibraryCloud rows are prefixed with their parent's ID, and Google Books rows follow their parent
+def find_parent_ids(sort_ids: Sequence[str]) -> Sequence[str]:
+    parent_ids = []
+    parent_id = None
+    for sort_id in sort_ids:
+        if '_' not in sort_id:
+            parent_id = sort_id
+        elif not sort_id.startswith('GB_API'):
+            parent_id = sort_id.split('_')[0]
+        parent_ids.append(parent_id)
+    return parent_ids
+
+
+# Checkpoint of finished per-book results so a restarted shard skips the books it already processed
+def open_checkpoint(script_name: str, shard: Tuple[int, int], fresh: bool = False) -> Cache:
+    checkpoint = Cache(os.path.join('data', f'checkpoint-{script_name}{create_shard_suffix(shard)}'))
+    if fresh:
+        checkpoint.clear()
+    return checkpoint
+
+
+# Functions - Merging
+
+# Order merged rows the way a single-node run would: by the input position of each row's book,
+# keeping each book's rows in the order its shard wrote them
+def sort_by_input_order(df: pd.DataFrame, book_ids: Sequence[str], input_ids: Sequence[str]) -> pd.DataFrame:
+    input_positions = {book_id: position for position, book_id in enumerate(input_ids)}
+    order = pd.Series([input_positions.get(book_id, len(input_positions)) for book_id in book_ids])
+    return df.iloc[order.argsort(kind='mergesort').to_list()]
+
+
+# Find the output each shard wrote for a stem, using the most recent one when a shard ran more than once
+def find_shard_paths(out_dir: str, stem: str, num_shards: int) -> Sequence[str]:
+    paths = []
+    for shard_index in range(num_shards):
+        suffix = create_shard_suffix((shard_index, num_shards))
+        shard_paths = sorted(glob.glob(os.path.join(out_dir, f'*{stem}{suffix}.*')))
+        if shard_paths:
+            paths.append(shard_paths[-1])
+        else:
+            logger.warning(f'No {stem} output found for shard {shard_index} of {num_shards}')
+    return paths
+
+
+def merge_identify_outputs(num_shards: int) -> None:
+    from identify import load_press_books, save_output
+    from output_store import read_output
+
+    input_ids = load_press_books()['ID'].to_list()
+    for stem in IDENTIFY_OUTPUT_STEMS:
+        shard_paths = find_shard_paths('data', stem, num_shards)
+        if not shard_paths:
+            continue
+        merged_df = pd.concat([read_output(path, index_col=None) for path in shard_paths])
+        id_column = 'HEB_ID' if 'HEB_ID' in merged_df.columns else 'ID'
+        merged_df = sort_by_input_order(merged_df, merged_df[id_column].to_list(), input_ids)
+        save_output(merged_df, stem)
+        logger.info(f'Merged {len(shard_paths)} shard outputs into {stem}')
+
+
+def merge_hlapi_outputs(num_shards: int) -> None:
+    from hlapi import add_rightsholder_stats, load_press_books, save_output
+    from output_store import read_output
+
+    input_ids = load_press_books().index.to_list()
+    shard_paths = find_shard_paths('outputs', 'output', num_shards)
+    if shard_paths:
+        merged_df = pd.concat([read_output(path, index_col=0) for path in shard_paths])
+        merged_df = sort_by_input_order(merged_df, find_parent_ids(merged_df.index.to_list()), input_ids)
+        # Rightsholder ranks count across all books, so they are recomputed for the merged output
+        save_output(add_rightsholder_stats(merged_df), 'output')
+        logger.info(f'Merged {len(shard_paths)} shard outputs into output')
+
+    shard_paths = find_shard_paths('outputs', 'transient_failures', num_shards)
+    if shard_paths:
+        merged_df = pd.concat([read_output(path, index_col=0) for path in shard_paths])
+        merged_df = sort_by_input_order(merged_df, merged_df.index.to_list(), input_ids)
+        save_output(merged_df, 'transient_failures', excel=False)
+
+
+# Copy entries from other nodes' caches that the destination cache does not have yet, or has an older copy of
+def merge_caches(source_paths: Sequence[str], dest_path: str) -> int:
+    from db_cache import read_cache_entry
+
+    num_copied = 0
+    with Cache(dest_path) as dest_ref:
+        for source_path in source_paths:
+            with Cache(source_path) as source_ref:
+                for key in source_ref.iterkeys():
+                    source_value = source_ref[key]
+                    if key in dest_ref:
+                        source_fetched_at = read_cache_entry(source_value)['fetched_at']
+                        dest_fetched_at = read_cache_entry(dest_ref[key])['fetched_at']
+                        if source_fetched_at is None or (dest_fetched_at is not None and dest_fetched_at >= source_fetched_at):
+                            continue
+                    dest_ref[key] = source_value
+                    num_copied += 1
+            logger.info(f'Merged cache {source_path} into {dest_path}')
+    return num_copied
+
+
+# Main Program
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Merge the outputs or caches of a sharded run.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    merge_parser = subparsers.add_parser('merge', help='Merge per-shard outputs into single-run outputs')
+    merge_parser.add_argument('script', choices=['identify', 'hlapi'])
+    merge_parser.add_argument('num_shards', type=int)
+
+    merge_cache_parser = subparsers.add_parser('merge-cache', help='Copy missing entries from other caches')
+    merge_cache_parser.add_argument('dest_path')
+    merge_cache_parser.add_argument('source_paths', nargs='+')
+
+    args = parser.parse_args()
+    if args.command == 'merge':
+        if args.script == 'identify':
+            merge_identify_outputs(args.num_shards)
+        else:
+            merge_hlapi_outputs(args.num_shards)
+    else:
+        num_copied = merge_caches(args.source_paths, args.dest_path)
+        logger.info(f'Copied {num_copied} cache entries')
@@ -0,0 +1,92 @@
+# snapshot
+
+# standard libraries
+import glob, hashlib, json, logging, os
+from typing import Optional, Union
+
+# third-party libraries
+import numpy as np
+import pandas as pd
+
+
+# Initializing settings and global variables
+
+logger = logging.getLogger(__name__)
+
+try:
+    with open(os.path.join('config', 'env.json')) as env_file:
+        ENV = json.loads(env_file.read())
+except FileNotFoundError:
+    logger.error('Configuration file could not be found; please add env.json to the config directory.')
+
+SNAPSHOT_OPTS = ENV.get('SNAPSHOTS', {'ON': True})
+SNAPSHOT_DIR_STR = os.path.join(*SNAPSHOT_OPTS.get('PATH', ['data', 'snapshots']))
+
+
+# Functions
+
+def hash_file(path: str) -> str:
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+# Snapshots are named by the workbook's name and absolute path (so same-named workbooks in different
+# directories keep separate snapshots), then its content
+def create_snapshot_prefix(path: str) -> str:
+    path_hash = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+    return f'{os.path.basename(path)}-{path_hash}'
+
+
+def create_snapshot_path(path: str, file_hash: str) -> str:
+    return os.path.join(SNAPSHOT_DIR_STR, f'{create_snapshot_prefix(path)}-{file_hash[:16]}.parquet')
+
+
+# Parse a workbook with every cell as a string, converting it to a Parquet snapshot named by the workbook's
+# content hash the first time; later runs read the snapshot unless the workbook has changed
+def read_workbook(path: str) -> pd.DataFrame:
+    if not SNAPSHOT_OPTS.get('ON', True):
+        df = pd.read_excel(path, dtype=str)
+        df.columns = df.columns.map(str)
+        return df
+
+    snapshot_path = create_snapshot_path(path, hash_file(path))
+    if os.path.isfile(snapshot_path):
+        logger.info(f'Reading snapshot {snapshot_path} of {path}')
+        df = pd.read_parquet(snapshot_path)
+        # Parquet brings empty cells back as None; restore the NaN read_excel gives
+        return df.where(pd.notna(df), np.nan)
+
+    df = pd.read_excel(path, dtype=str)
+    # Parquet needs string column names (a header cell can hold a number)
+    df.columns = df.columns.map(str)
+    os.makedirs(SNAPSHOT_DIR_STR, exist_ok=True)
+    # Snapshots of earlier versions of the same workbook are no longer needed
+    for old_snapshot_path in glob.glob(os.path.join(SNAPSHOT_DIR_STR, f'{glob.escape(create_snapshot_prefix(path))}-*.parquet')):
+        os.remove(old_snapshot_path)
+    temp_path = snapshot_path + '.tmp'
+    df.to_parquet(temp_path, index=False)
+    os.replace(temp_path, snapshot_path)
+    logger.info(f'Wrote snapshot {snapshot_path} of {path}')
+    return df
+
+
+# Read an input table with string cells, from a workbook (through its snapshot) or a CSV
+def read_input_table(path: str, index_col: Optional[Union[int, str]] = None) -> pd.DataFrame:
+    if '.xlsx' in path:
+        df = read_workbook(path)
+        if index_col is not None:
+            df = df.set_index(df.columns[index_col] if isinstance(index_col, int) else index_col)
+        return df
+    return pd.read_csv(path, dtype=str, index_col=index_col)
+
+
+# Read the press's book list; workbooks exported from the press's system start with a dummy record, which
+# is dropped unless drop_first_row is False
+def read_books_table(path: str, drop_first_row: bool = True) -> pd.DataFrame:
+    if '.xlsx' in path:
+        df = read_workbook(path)
+        return df.iloc[1:] if drop_first_row else df
+    return pd.read_csv(path, dtype=str)
@@ -1,11 +1,13 @@
 # standard libraries
-import unittest
+import csv, json, os, tempfile, threading, time, unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 # third-party libarries
 import pandas as pd
 
 # local libraries
-import compare, identify
+import compare, db_cache, diagnostics, engine, estimate, hlapi, identify, incremental, metrics, output_fix, pipeline, output_store, publisher_authority, quota, rate_limit, record_index, records, shard, snapshot
 
 class TestComparison(unittest.TestCase):
 
@@ -24,5 +26,731 @@ class TestComparison(unittest.TestCase):
         result = compare_to_publisher(right)
         self.assertTrue(result)
 
+    def test_pruning_does_not_change_results(self):
+        lefts = ["University of MI Press", "The hound of the Baskervilles", "Holt"]
+        rights = [
+            "Univ. of Michigan Press", "HOUND OF THE BASKERVILLES.", "Henry Holt and Company",
+            "Oxford University Press", "A study in scarlet", "", "Holt", "The Hound"
+        ]
+        for left in lefts:
+            pruned_func = compare.create_compare_func([left], 85, [compare.normalize_univ])
+            unpruned_func = compare.create_compare_func([left], 85, [compare.normalize_univ], prune=False)
+            for right in rights:
+                self.assertEqual(pruned_func(right), unpruned_func(right), f'{left} ~ {right}')
+
+    def test_obvious_rejects_are_pruned(self):
+        compare.COMPARISON_STATS.clear()
+        compare_to_title = compare.create_compare_func(["The hound of the Baskervilles"], 85)
+        self.assertFalse(compare_to_title("Ulysses"))
+        self.assertEqual(compare.COMPARISON_STATS['full_ratios_pruned'], 1)
+        self.assertEqual(compare.COMPARISON_STATS['full_ratios_scored'], 0)
+
+    def test_isbn_canonicalization(self):
+        self.assertEqual(compare.canonicalize_isbn('0-306-40615-2 (pbk.)'), '9780306406157')
+        self.assertEqual(compare.canonicalize_isbn('9780306406157'), '9780306406157')
+        self.assertIsNone(compare.canonicalize_isbn('N/A'))
+        self.assertIsNone(compare.canonicalize_isbn('X-306-40615-2'))
+
+    def test_stored_decisions_are_reused(self):
+        decisions = {}
+        lefts = ["University of MI Press"]
+        rights = ["Univ. of Michigan Press", "Oxford University Press", "Univ. of Michigan Press"]
+        plain_func = compare.create_compare_func(lefts, 85, [compare.normalize_univ])
+        stored_func = compare.create_compare_func(lefts, 85, [compare.normalize_univ], decisions=decisions)
+        compare.COMPARISON_STATS.clear()
+        for right in rights:
+            self.assertEqual(stored_func(right), plain_func(right), right)
+        self.assertEqual(len(decisions), 2)
+        self.assertEqual(compare.COMPARISON_STATS['decisions_reused'], 1)
+
+
+class TestPublisherAuthority(unittest.TestCase):
+
+    def test_names_with_separators_round_trip(self):
+        decision_key = ('smith | sons', 'smith|sons press', 85, True)
+        with tempfile.TemporaryDirectory() as authority_dir:
+            authority = publisher_authority.PublisherAuthority(os.path.join(authority_dir, 'authority'))
+            authority[decision_key] = True
+            authority.add_variant('Smith | Sons')
+            self.assertNotIn(publisher_authority.create_variant_cache_key('Smith | Sons'), authority.cache)
+            authority.save_variants()
+            self.assertEqual(list(authority), [decision_key])
+            export_path = os.path.join(authority_dir, 'authority.csv')
+            authority.export(export_path)
+            authority.cache.close()
+            with open(export_path, newline='') as export_file:
+                rows = list(csv.reader(export_file))
+        self.assertIn(['decision', 'smith | sons', 'smith|sons press', '85', 'True'], rows)
+        self.assertIn('Smith | Sons', [row[1] for row in rows if row[0] == 'variant'])
+
+
+class TestSruBatch(unittest.TestCase):
+
+    def create_marcxml_record(self, title, author):
+        return (
+            '<recordData><record>'
+            f'<datafield tag="100"><subfield code="a">{author}</subfield></datafield>'
+            f'<datafield tag="245"><subfield code="a">{title}</subfield></datafield>'
+            '</record></recordData>'
+        )
+
+    def test_records_are_routed_to_their_books(self):
+        books = [
+            {'ID': 'HEB00001', 'Title': 'Poems', 'Subtitle': 'N/A', 'Author_Last': 'Frost'},
+            {'ID': 'HEB00002', 'Title': 'Poems', 'Subtitle': 'N/A', 'Author_Last': 'Dickinson'},
+            {'ID': 'HEB00003', 'Title': 'Walden', 'Subtitle': 'N/A', 'Author_Last': 'Thoreau'}
+        ]
+        response = (
+            '<searchRetrieveResponse><numberOfRecords>3</numberOfRecords><records>'
+            + self.create_marcxml_record('Poems /', 'Frost, Robert,')
+            + self.create_marcxml_record('Poems /', 'Dickinson, Emily,')
+            + self.create_marcxml_record('Walden, or, Life in the woods /', 'Thoreau, Henry David,')
+            + '</records></searchRetrieveResponse>'
+        )
+        batch = {'response': response, 'books': books, 'records_by_book': None}
+        records_by_book = identify.route_batch_records(batch)
+        self.assertEqual([len(records) for records in records_by_book], [1, 1, 1])
+        self.assertEqual(records_by_book[1][0]['Author'], 'Dickinson, Emily,')
+
+    def test_batch_query_is_a_disjunction(self):
+        books = [
+            {'Title': 'Poems', 'Subtitle': 'N/A', 'Author_Last': 'Frost'},
+            {'Title': 'Walden', 'Subtitle': 'N/A', 'Author_Last': 'Thoreau'}
+        ]
+        self.assertEqual(
+            identify.create_batch_query(books),
+            '(srw.ti all "poems" and srw.au all "Frost") or (srw.ti all "walden" and srw.au all "Thoreau")'
+        )
+
+
+class TestSruPaging(unittest.TestCase):
+
+    def test_has_enough_formats(self):
+        manifests_df = pd.DataFrame({'ISBN': ['9780472030002', '9780472130003'], 'Format': ['Paperback', 'Hardcover']})
+        self.assertFalse(identify.has_enough_formats(manifests_df))
+        manifests_df = manifests_df.append({'ISBN': '9780472120000', 'Format': 'Ebook'}, ignore_index=True)
+        self.assertTrue(identify.has_enough_formats(manifests_df))
+        self.assertFalse(identify.has_enough_formats(pd.DataFrame({})))
+
+    def test_page_manifests_are_merged(self):
+        manifests_df = pd.DataFrame({'ISBN': ['9780472030002'], 'Format': ['Paperback']})
+        merged_df, found_new = identify.merge_page_manifests(manifests_df, manifests_df.copy())
+        self.assertFalse(found_new)
+        self.assertEqual(len(merged_df), 1)
+        page_df = pd.DataFrame({'ISBN': ['9780472030002', '9780472120000'], 'Format': ['Paperback', 'Ebook']})
+        merged_df, found_new = identify.merge_page_manifests(manifests_df, page_df)
+        self.assertTrue(found_new)
+        self.assertEqual(merged_df['ISBN'].to_list(), ['9780472030002', '9780472120000'])
+        self.assertFalse(identify.merge_page_manifests(manifests_df, pd.DataFrame({}))[1])
+
+    def test_lazy_paging_fetches_an_unpaged_response_before_stopping(self):
+        page_records = [records.CatalogRecord.from_dict({'Title': 'Walden'})] * 25
+        paging_opts = {'ON': True, 'MAX_LAZY_PAGES': 10, 'MAX_RECORDS_PER_BOOK': 1000}
+        lookup = {'query': 'srw.ti all "walden"', 'number_of_records': 500}
+        with mock.patch.object(identify, 'SRU_PAGING_OPTS', paging_opts), \
+                mock.patch.object(identify, 'PAGE_SIZE', 25), \
+                mock.patch.object(identify, 'run_checks_and_return_matches', return_value=[]), \
+                mock.patch.object(identify, 'request_worldcat_query', return_value='<page/>') as request_mock, \
+                mock.patch.object(identify, 'parse_marcxml_page', return_value=(page_records, 500)):
+            manifests_df = identify.match_with_lazy_paging({'ID': 'HEB00001'}, page_records, lookup)
+        self.assertTrue(manifests_df.empty)
+        self.assertEqual([call[0][1] for call in request_mock.call_args_list], [26, 51, 76])
+
+
+class TestBatchMode(unittest.TestCase):
+
+    def create_record(self, title, publisher, isbn_pairs):
+        record_dict = {'Title': title, 'Subtitle': '', 'Publisher': publisher}
+        # Keys are named as parse_marcxml_page names them: numbered only when there are several 020 fields
+        for num, (isbn_a, isbn_q) in enumerate(isbn_pairs, 1):
+            record_dict[identify.mint_wc_key_name('ISBN', 'a', num, 2, len(isbn_pairs))] = isbn_a
+            record_dict[identify.mint_wc_key_name('ISBN', 'q', num, 2, len(isbn_pairs))] = isbn_q
+        return records.CatalogRecord.from_dict(record_dict)
+
+    def test_batch_and_per_book_paths_agree(self):
+        books = [
+            {'ID': 'HEB00001', 'Title': 'Walden', 'Subtitle': 'N/A', 'Publisher 1': 'Ticknor and Fields'},
+            {'ID': 'HEB00002', 'Title': 'Poems', 'Subtitle': 'N/A', 'Publisher 1': 'Roberts Brothers'},
+            {'ID': 'HEB00003', 'Title': 'Leaves of Grass', 'Subtitle': 'N/A', 'Publisher 1': 'University of MI Press'}
+        ]
+        candidates = [
+            [
+                self.create_record('Walden', 'Ticknor and Fields', [('9780691096124', 'pbk.'), ('9780691096131', 'hardcover')]),
+                self.create_record('Cape Cod', 'Ticknor and Fields', [('9780691118918', 'pbk.')])
+            ],
+            [self.create_record('Poems', 'Oxford University Press', [('9780199555178', 'pbk.')])],
+            [self.create_record('Leaves of grass', 'Univ. of Michigan Press', [('9780472030002 (ebook)', pd.NA)])]
+        ]
+        batch_manifests = identify.match_and_classify_batch(books, candidates)
+        self.assertEqual(len(batch_manifests), len(books))
+        for book_dict, records_for_book, batch_df in zip(books, candidates, batch_manifests):
+            per_book_df = identify.classify_and_find_unique_manifests(
+                book_dict, identify.run_checks_and_return_matches(book_dict, records_for_book)
+            )
+            pd.testing.assert_frame_equal(
+                batch_df.reset_index(drop=True), per_book_df.reset_index(drop=True), check_dtype=False
+            )
+        self.assertFalse(batch_manifests[0].empty)
+        self.assertTrue(batch_manifests[1].empty)
+
+    def test_single_isbn_records_are_isbn_hits(self):
+        single_record = self.create_record('Walden', 'Ticknor and Fields', [('0691096120 (pbk.)', 'pbk.')])
+        other_record = self.create_record('Walden', 'Ticknor and Fields', [('9780691096131', pd.NA)])
+        self.assertIn('ISBN a', single_record)
+        hits = identify.find_isbn_hits([single_record, other_record], ['9780691096124'])
+        self.assertEqual(hits, [single_record])
+
+
+class TestRecordIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.index_path = os.path.join(self.temp_dir.name, 'record_index')
+        self.cache_path = os.path.join(self.temp_dir.name, 'db_cache')
+        for name, path in [('INDEX_PATH_STR', self.index_path), ('DB_CACHE_PATH_STR', self.cache_path)]:
+            patcher = mock.patch.object(record_index, name, path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_index_tokens(self):
+        tokens = record_index.create_index_tokens({
+            'Title': 'The Hound of the Baskervilles :',
+            'Author': 'Doyle, Arthur Conan,',
+            'Publisher': 'Univ. of Michigan Press',
+            'ISBN a 1': '0-306-40615-2 (pbk.)',
+            'ISBN q 1': pd.NA
+        })
+        self.assertEqual({token for token in tokens if token.startswith('ti:')}, {'ti:hound', 'ti:baskervilles'})
+        self.assertTrue({'au:doyle', 'au:arthur', 'au:conan'} <= tokens)
+        self.assertTrue({'pu:university', 'pu:michigan', 'pu:press'} <= tokens)
+        self.assertIn('isbn:9780306406157', tokens)
+
+    def test_candidates_share_title_and_author_words(self):
+        hound_record = {'Control_Number': '1', 'Title': 'The hound of the Baskervilles', 'Author': 'Doyle, Arthur Conan'}
+        study_record = {'Control_Number': '2', 'Title': 'A study in scarlet', 'Author': 'Doyle, Arthur Conan'}
+        record_index.add_records('WorldCat', [hound_record, study_record])
+        record_index.add_records('Harvard Library', [{'ID': '990001', 'Main Title': 'The hound of the Baskervilles'}])
+        self.assertEqual(record_index.find_candidates('WorldCat', 'Hound of the Baskervilles', 'Doyle'), [hound_record])
+        self.assertEqual(record_index.find_candidates('WorldCat', 'Hound of the Baskervilles', 'Christie'), [])
+        self.assertEqual(
+            [record['ID'] for record in record_index.find_candidates('Harvard Library', 'The Hound of the Baskervilles')],
+            ['990001']
+        )
+
+    def test_cached_responses_are_indexed_by_longest_base_url(self):
+        base_url = 'https://api.lib.harvard.edu/v2/items'
+        with db_cache.Cache(self.cache_path) as cache_ref:
+            cache_ref[base_url + '.json?title=hound'] = 'json response'
+            cache_ref[base_url + '?title=scarlet'] = 'xml response'
+        parsed = []
+
+        def create_parser(title):
+            def parse(response_text):
+                parsed.append(response_text)
+                return [{'ID': title, 'Main Title': title}]
+            return parse
+
+        parsers = {
+            base_url: ('Harvard Library', create_parser('A study in scarlet')),
+            base_url + '.json': ('Harvard Library', create_parser('The hound of the Baskervilles'))
+        }
+        self.assertEqual(record_index.build_index(parsers), 2)
+        self.assertEqual(sorted(parsed), ['json response', 'xml response'])
+        self.assertEqual(
+            [record['ID'] for record in record_index.find_candidates('Harvard Library', 'Hound of the Baskervilles')],
+            ['The hound of the Baskervilles']
+        )
+        self.assertEqual(
+            [record['ID'] for record in record_index.find_candidates('Harvard Library', 'Study in scarlet')],
+            ['A study in scarlet']
+        )
+        # Requests already indexed are skipped
+        self.assertEqual(record_index.build_index(parsers), 0)
+
+
+class TestQuota(unittest.TestCase):
+
+    def test_cached_books_are_planned_first(self):
+        planned, deferred = quota.plan_books([1, 0, 1, 0, 1], 1)
+        self.assertEqual(planned, [1, 3, 0])
+        self.assertEqual(deferred, [2, 4])
+
+    def test_books_are_deferred_in_input_order(self):
+        # A later, cheaper book is not searched ahead of an earlier one the budget could not cover
+        planned, deferred = quota.plan_books([2, 1], 1)
+        self.assertEqual(planned, [])
+        self.assertEqual(deferred, [0, 1])
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(rate_limit.parse_retry_after('120'), 120.0)
+        self.assertIsNone(rate_limit.parse_retry_after(None))
+        self.assertIsNone(rate_limit.parse_retry_after('soon'))
+
+    def test_backoff_honors_retry_after(self):
+        self.assertEqual(rate_limit.compute_backoff(0, 2.5), 2.5)
+        for attempt in range(10):
+            self.assertLessEqual(rate_limit.compute_backoff(attempt), rate_limit.MAX_DELAY)
+
+
+class TestDbCache(unittest.TestCase):
+
+    def test_legacy_entries_have_unknown_age(self):
+        entry = db_cache.read_cache_entry('<searchRetrieveResponse/>')
+        self.assertEqual(entry['text'], '<searchRetrieveResponse/>')
+        self.assertIsNone(entry['fetched_at'])
+        with mock.patch.object(db_cache, 'MAX_AGE_SECONDS', 60):
+            self.assertTrue(db_cache.is_stale(entry))
+        with mock.patch.object(db_cache, 'MAX_AGE_SECONDS', None):
+            self.assertFalse(db_cache.is_stale(entry))
+
+    def test_staleness_and_conditional_headers(self):
+        entry = {'text': '', 'fetched_at': 1000.0, 'etag': '"abc"', 'last_modified': None}
+        with mock.patch.object(db_cache, 'MAX_AGE_SECONDS', 60):
+            self.assertFalse(db_cache.is_stale(entry, now=1030.0))
+            self.assertTrue(db_cache.is_stale(entry, now=1100.0))
+        self.assertEqual(db_cache.create_conditional_headers(entry), {'If-None-Match': '"abc"'})
+
+    def test_failed_revalidation_falls_back_to_stale_entry(self):
+        url, params = 'https://example.org/search', {'q': 'walden'}
+        entry = {'text': '<cached/>', 'fetched_at': 1000.0, 'etag': None, 'last_modified': None}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with db_cache.Cache(cache_dir) as ref:
+                ref[db_cache.create_unique_request_str(url, params)] = entry
+            with mock.patch.object(db_cache, 'DB_CACHE_PATH_STR', cache_dir), \
+                    mock.patch.object(db_cache, 'MAX_AGE_SECONDS', 60), \
+                    mock.patch.object(db_cache, 'revalidate_entry', side_effect=db_cache.TransientRequestError('503')):
+                self.assertEqual(db_cache.make_request_using_cache(url, params), '<cached/>')
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_records_share_schema(self):
+        first = records.CatalogRecord.from_dict({'Title': 'Dubliners', 'Publisher': 'Grant Richards'})
+        second = records.CatalogRecord.from_dict({'Title': 'Ulysses', 'Publisher': 'Shakespeare and Company'})
+        self.assertIs(first.schema, second.schema)
+        self.assertEqual(first['Title'], 'Dubliners')
+        self.assertEqual(second.to_dict(), {'Title': 'Ulysses', 'Publisher': 'Shakespeare and Company'})
+        self.assertNotIn('Subtitle', first)
+
+    def test_records_to_frame_fills_missing_fields(self):
+        frame = records.records_to_frame([
+            records.CatalogRecord.from_dict({'Title': 'Dubliners'}),
+            records.CatalogRecord.from_dict({'Title': 'Ulysses', 'Subtitle': 'A Novel'})
+        ])
+        self.assertEqual(list(frame.columns), ['Title', 'Subtitle'])
+        self.assertTrue(pd.isna(frame.at[0, 'Subtitle']))
+
+    def test_record_store_shares_records(self):
+        store = records.RecordStore()
+        first = store.add('WorldCat', '12345', records.CatalogRecord.from_dict({'Title': 'Walden'}))
+        second = store.add('WorldCat', '12345', records.CatalogRecord.from_dict({'Title': 'Walden'}))
+        self.assertIs(first, second)
+        self.assertIs(store.get('WorldCat', '12345'), first)
+        self.assertIsNone(store.get('Harvard Library', '12345'))
+        self.assertEqual(store.collect_metrics(), {'records_reused_total': {(('source', 'WorldCat'),): 1}})
+
+    def test_reused_records_are_not_counted_as_parsed(self):
+        response = (
+            '<searchRetrieveResponse><numberOfRecords>1</numberOfRecords><records><recordData><record>'
+            '<controlfield tag="001">test-reuse-0001</controlfield>'
+            '<datafield tag="245"><subfield code="a">Walden /</subfield></datafield>'
+            '</record></recordData></records></searchRetrieveResponse>'
+        )
+        num_parsed = metrics.REGISTRY.get_counter('records_parsed_total', source='WorldCat')
+        first = identify.parse_marcxml(response)[0]
+        second = identify.parse_marcxml(response)[0]
+        self.assertIs(first, second)
+        self.assertEqual(metrics.REGISTRY.get_counter('records_parsed_total', source='WorldCat'), num_parsed + 1)
+
+
+class TestQueryPlan(unittest.TestCase):
+
+    def test_slower_publisher_result_beats_faster_fallback(self):
+        query_plan = {'publisher': {'publisher': 'Holt'}, 'no_publisher': {}}
+        sent_queries = []
+
+        def fetch_and_parse_query(params, book_dict):
+            sent_queries.append(params)
+            if 'publisher' in params:
+                time.sleep(0.2)
+                return {'HEB00001_1': {'Publisher': 'Holt'}}
+            return {'HEB00001_2': {'Publisher': 'Oxford University Press'}}
+
+        with ThreadPoolExecutor(max_workers=3) as executor, \
+                mock.patch.object(hlapi, 'QUERY_EXECUTOR', executor), \
+                mock.patch.object(hlapi, 'fetch_and_parse_query', side_effect=fetch_and_parse_query):
+            records = hlapi.run_query_plan_concurrently(query_plan, {'ID': 'HEB00001'})
+        self.assertEqual(records, {'HEB00001_1': {'Publisher': 'Holt'}})
+        # Every query was sent at once
+        self.assertEqual(len(sent_queries), 2)
+
+
+class TestIsbnlibEnrichment(unittest.TestCase):
+
+    def test_only_results_about_the_isbn_are_cached(self):
+        def editions(isbn):
+            if isbn == '9780472030002':
+                raise hlapi.ISBNLibHTTPError('503')
+            if isbn == '9780472120000':
+                raise hlapi.ISBNLibException('no data')
+            return ['9780472130003']
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.object(hlapi, 'EDITIONS_CACHE_PATH', cache_dir), \
+                mock.patch.object(hlapi.ib, 'editions', side_effect=editions):
+            isbns = hlapi.fill_out_isbn_list(['9780472030002', '9780472120000', '9780472050000'])
+            with hlapi.Cache(cache_dir) as ref:
+                self.assertNotIn('Editions_API_9780472030002', ref)
+                self.assertEqual(ref['Editions_API_9780472120000'], [])
+                self.assertEqual(ref['Editions_API_9780472050000'], ['9780472130003'])
+        self.assertEqual(isbns, ['9780472030002', '9780472120000', '9780472050000', '9780472130003'])
+
+    def test_other_errors_propagate(self):
+        with mock.patch.object(hlapi.ib, 'meta', side_effect=KeyError('volumeInfo')):
+            with self.assertRaises(KeyError):
+                hlapi.fetch_meta('9780472030002')
+
+
+class TestModsParsing(unittest.TestCase):
+
+    MODS_XML = (
+        '<results><pagination><numFound>1</numFound></pagination><items>'
+        '<mods:mods xmlns:mods="http://www.loc.gov/mods/v3">'
+        '<mods:titleInfo><mods:nonSort>The </mods:nonSort><mods:title>hound of the Baskervilles</mods:title>'
+        '<mods:subTitle>another adventure of Sherlock Holmes</mods:subTitle></mods:titleInfo>'
+        '<mods:name><mods:namePart>Doyle, Arthur Conan</mods:namePart></mods:name>'
+        '<mods:originInfo><mods:place><mods:placeTerm type="text">London</mods:placeTerm></mods:place>'
+        '<mods:publisher>G. Newnes</mods:publisher><mods:dateIssued>1902</mods:dateIssued></mods:originInfo>'
+        '<mods:identifier type="isbn">9780140437867 (paperback)</mods:identifier>'
+        '<mods:recordInfo><mods:recordIdentifier>990012345670203941</mods:recordIdentifier></mods:recordInfo>'
+        '</mods:mods></items></results>'
+    )
+    MODS_JSON = {
+        'pagination': {'numFound': 1},
+        'items': {'mods': {
+            'titleInfo': {
+                'nonSort': 'The ',
+                'title': 'hound of the Baskervilles',
+                'subTitle': 'another adventure of Sherlock Holmes'
+            },
+            'name': {'namePart': 'Doyle, Arthur Conan'},
+            'originInfo': {
+                'place': {'placeTerm': {'@type': 'text', '#text': 'London'}},
+                'publisher': 'G. Newnes',
+                'dateIssued': '1902'
+            },
+            'identifier': {'@type': 'isbn', '#text': '9780140437867 (paperback)'},
+            'recordInfo': {'recordIdentifier': '990012345670203941'}
+        }}
+    }
+
+    def test_xml_and_json_parse_to_same_records(self):
+        # Each parse gets its own record store, so the JSON record is not simply the one the XML parse stored
+        with mock.patch.object(hlapi, 'RECORD_STORE', records.RecordStore()):
+            xml_records = hlapi.parse_modsxml(self.MODS_XML, {'ID': 'HEB01234'})
+        with mock.patch.object(hlapi, 'RECORD_STORE', records.RecordStore()):
+            json_records = hlapi.parse_modsjson(json.dumps(self.MODS_JSON), {'ID': 'HEB01234'})
+        self.assertEqual(list(xml_records.keys()), ['HEB01234_990012345670203941'])
+        self.assertEqual(
+            {key: record.to_dict() for key, record in xml_records.items()},
+            {key: record.to_dict() for key, record in json_records.items()}
+        )
+
+    def test_json_url_is_derived_from_base_url(self):
+        self.assertEqual(
+            hlapi.create_json_url('https://api.lib.harvard.edu/v2/items?'),
+            'https://api.lib.harvard.edu/v2/items.json?'
+        )
+        self.assertEqual(
+            hlapi.create_json_url('https://api.lib.harvard.edu/v2/items'),
+            'https://api.lib.harvard.edu/v2/items.json'
+        )
+
+
+class TestShard(unittest.TestCase):
+
+    def test_parse_shard_spec(self):
+        self.assertEqual(shard.parse_shard_spec('2/8'), (2, 8))
+        with self.assertRaises(Exception):
+            shard.parse_shard_spec('8/8')
+
+    def test_shards_partition_ids(self):
+        ids = [f'HEB{num:05d}' for num in range(200)]
+        selections = [shard.select_shard_rows(ids, (shard_index, 4)) for shard_index in range(4)]
+        for position in range(len(ids)):
+            self.assertEqual(sum(selection[position] for selection in selections), 1)
+        # The assignment must not depend on the process (unlike the built-in hash)
+        self.assertEqual(shard.find_shard_for_id('HEB00001', 4), shard.find_shard_for_id('HEB00001', 4))
+
+    def test_find_parent_ids(self):
+        sort_ids = ['HEB00001', 'HEB00001_990001', 'GB_API_9780472030002', 'HEB00002']
+        self.assertEqual(shard.find_parent_ids(sort_ids), ['HEB00001', 'HEB00001', 'HEB00001', 'HEB00002'])
+
+    def test_merged_identify_outputs_follow_input_order(self):
+        input_df = pd.DataFrame({'ID': ['HEB00001', 'HEB00002', 'HEB00003']})
+        save_output = mock.Mock()
+        orig_dir = os.getcwd()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.chdir(temp_dir)
+            try:
+                os.makedirs('data')
+                pd.DataFrame({'HEB_ID': ['HEB00003', 'HEB00001'], 'ISBN': ['9780472030002', '9780472120000']}) \
+                    .to_csv(os.path.join('data', 'matched_manifests.shard-0-of-2.csv'), index=False)
+                pd.DataFrame({'HEB_ID': ['HEB00002'], 'ISBN': ['9780472130003']}) \
+                    .to_csv(os.path.join('data', 'matched_manifests.shard-1-of-2.csv'), index=False)
+                with mock.patch.object(identify, 'load_press_books', return_value=input_df), \
+                        mock.patch.object(identify, 'save_output', save_output):
+                    shard.merge_identify_outputs(2)
+            finally:
+                os.chdir(orig_dir)
+        merged_df, stem = save_output.call_args[0]
+        self.assertEqual(stem, 'matched_manifests')
+        self.assertEqual(merged_df['HEB_ID'].to_list(), ['HEB00001', 'HEB00002', 'HEB00003'])
+
+    def test_merge_caches_keeps_newest_entry(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dest_path, source_path = os.path.join(temp_dir, 'dest'), os.path.join(temp_dir, 'source')
+            with db_cache.Cache(dest_path) as dest_ref, db_cache.Cache(source_path) as source_ref:
+                dest_ref['older'] = {'text': 'dest', 'fetched_at': 1.0}
+                source_ref['older'] = {'text': 'source', 'fetched_at': 2.0}
+                dest_ref['newer'] = {'text': 'dest', 'fetched_at': 3.0}
+                source_ref['newer'] = {'text': 'source', 'fetched_at': 2.0}
+                source_ref['missing'] = {'text': 'source', 'fetched_at': 2.0}
+            self.assertEqual(shard.merge_caches([source_path], dest_path), 2)
+            with db_cache.Cache(dest_path) as dest_ref:
+                self.assertEqual(dest_ref['older']['text'], 'source')
+                self.assertEqual(dest_ref['newer']['text'], 'dest')
+                self.assertEqual(dest_ref['missing']['text'], 'source')
+
+
+class TestEstimate(unittest.TestCase):
+
+    def test_wall_time_is_bounded_by_latency_and_rate(self):
+        self.assertEqual(estimate.project_wall_time(100, 0.5, 10.0, 1), 50.0)
+        self.assertEqual(estimate.project_wall_time(100, 0.5, 2.0, 4), 50.0)
+
+    def test_mean_latency_is_read_from_metrics(self):
+        metrics_json = {'histograms': {'request_latency_seconds': [
+            {'labels': {'endpoint': 'https://example.org/sru?'}, 'buckets': {}, 'sum': 3.0, 'count': 4}
+        ]}}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            metrics_path = os.path.join(temp_dir, 'metrics.json')
+            with open(metrics_path, 'w') as metrics_file:
+                json.dump(metrics_json, metrics_file)
+            self.assertEqual(estimate.read_mean_latency('https://example.org/sru?', metrics_path), 0.75)
+            self.assertIsNone(estimate.read_mean_latency('https://other.org/', metrics_path))
+
+
+class TestOutputFix(unittest.TestCase):
+
+    def test_children_of_one_parent_are_corrected_with_one_lookup(self):
+        df = pd.DataFrame({
+            'ID': ['HEB00001', '990001', '990002'],
+            'paper ISBN': ['', '9780472030002', '9780472030002'],
+            'ebook ISBN': ['', '', '']
+        }, index=['HEB00001', 'HEB00001_990001', 'HEB00001_990002'])
+        new_records_df = pd.DataFrame({
+            'paper ISBN': [pd.NA, '9780472030002'],
+            'ebook ISBN': ['9780472120000', pd.NA],
+            'Uncategorized ISBN': [pd.NA, '9780472130003']
+        }, index=['HEB00001_990001', 'HEB00001_990002'])
+        with mock.patch.object(output_fix, 'look_up_book_in_resource', return_value=new_records_df) as look_up_mock:
+            fixed_df, failed_hebids = output_fix.remove_false_paper_positives(df)
+        self.assertEqual(look_up_mock.call_count, 1)
+        self.assertEqual(failed_hebids, [])
+        self.assertEqual(fixed_df.loc['HEB00001_990001', 'ebook ISBN'], '9780472120000')
+        self.assertIsNone(fixed_df.loc['HEB00001_990001', 'paper ISBN'])
+        self.assertEqual(fixed_df.loc['HEB00001_990002', 'paper ISBN'], '9780472030002')
+        self.assertEqual(fixed_df.loc['HEB00001_990002', 'Uncategorized ISBN'], '9780472130003')
+        self.assertEqual(fixed_df.loc['HEB00001', 'paper ISBN'], '')
+
+
+class TestIncremental(unittest.TestCase):
+
+    def test_row_fingerprint(self):
+        prefixes = ['ID', 'Title', 'Author']
+        book_dict = {'ID': 'HEB00001', 'Title': 'Moby Dick', 'Author_Last': 'Melville', 'Price': '10.00'}
+        fingerprint = incremental.create_row_fingerprint(book_dict, 'v1', prefixes)
+        self.assertEqual(fingerprint, incremental.create_row_fingerprint({**book_dict, 'Price': '12.00'}, 'v1', prefixes))
+        self.assertNotEqual(fingerprint, incremental.create_row_fingerprint({**book_dict, 'Title': 'Moby-Dick'}, 'v1', prefixes))
+        self.assertNotEqual(fingerprint, incremental.create_row_fingerprint(book_dict, 'v2', prefixes))
+
+    def test_paging_settings_change_identify_config_version(self):
+        paging_opts = {'ON': True, 'PAGE_SIZE': 25, 'WORKERS': 3}
+        with tempfile.TemporaryDirectory() as results_dir, \
+                mock.patch.object(incremental, 'RESULTS_PATH_STR', results_dir), \
+                mock.patch.dict(incremental.INCREMENTAL_OPTS, {'ON': True}):
+            with mock.patch.object(identify, 'SRU_PAGING_OPTS', paging_opts):
+                config_version = identify.open_identify_result_store().config_version
+            with mock.patch.object(identify, 'SRU_PAGING_OPTS', {**paging_opts, 'WORKERS': 6}):
+                self.assertEqual(identify.open_identify_result_store().config_version, config_version)
+            with mock.patch.object(identify, 'SRU_PAGING_OPTS', {**paging_opts, 'PAGE_SIZE': 50}):
+                self.assertNotEqual(identify.open_identify_result_store().config_version, config_version)
+
+
+class TestOutputStore(unittest.TestCase):
+
+    def create_output_df(self):
+        return pd.DataFrame({
+            'ISBN': ['0306406152', '9780472030002'],
+            'Format': ['Paperback', 'Ebook'],
+            'New Rightsholder': [True, False],
+            'Rank': [1, 2]
+        }, index=pd.Index(['HEB00001', 'HEB00002'], name='Sort'))
+
+    def test_typed_output_round_trips(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = output_store.save_parquet(self.create_output_df(), out_dir, 'output', 'run1', partition_by=None)
+            read_df = output_store.read_output(path)
+        self.assertEqual(read_df.index.to_list(), ['HEB00001', 'HEB00002'])
+        self.assertEqual(read_df['ISBN'].dtype, 'string')
+        self.assertEqual(read_df['ISBN'].to_list(), ['0306406152', '9780472030002'])
+        self.assertEqual(read_df['Format'].dtype, 'category')
+        self.assertEqual(read_df['New Rightsholder'].dtype, bool)
+        self.assertEqual(read_df['Rank'].dtype, 'int64')
+
+    def test_runs_are_partitions_of_one_dataset(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            output_store.save_parquet(self.create_output_df(), out_dir, 'output', 'run1', partition_by='run')
+            path = output_store.save_parquet(self.create_output_df().iloc[:1], out_dir, 'output', 'run2', partition_by='run')
+            self.assertEqual(len(output_store.read_output(path)), 3)
+            self.assertEqual(output_store.read_output(path, run_ts='run2')['ISBN'].to_list(), ['0306406152'])
+
+    def test_outputs_without_partition_column_are_one_file(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = output_store.save_parquet(self.create_output_df(), out_dir, 'failures', 'run1', partition_by='Source')
+            self.assertTrue(os.path.isfile(path))
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_same_named_workbooks_get_separate_snapshots(self):
+        first_path = snapshot.create_snapshot_path(os.path.join('2019', 'books.xlsx'), 'abc123')
+        second_path = snapshot.create_snapshot_path(os.path.join('2020', 'books.xlsx'), 'abc123')
+        self.assertNotEqual(first_path, second_path)
+        self.assertTrue(os.path.basename(first_path).startswith('books.xlsx-'))
+
+
+class TestDiagnostics(unittest.TestCase):
+
+    def test_sampling_is_stable(self):
+        self.assertFalse(diagnostics.is_sampled('B1', 0))
+        self.assertTrue(diagnostics.is_sampled('B1', 1))
+        sampled = [book_id for book_id in range(1000) if diagnostics.is_sampled(book_id, 0.1)]
+        self.assertEqual(sampled, [book_id for book_id in range(1000) if diagnostics.is_sampled(book_id, 0.1)])
+        self.assertTrue(50 < len(sampled) < 150)
+
+    def test_lazy_arguments_are_not_rendered_when_disabled(self):
+        rendered = []
+        quiet_logger = diagnostics.logging.getLogger('test_diagnostics_quiet')
+        quiet_logger.setLevel(diagnostics.logging.INFO)
+        quiet_logger.debug('%s', diagnostics.Lazy(lambda: rendered.append(True)))
+        self.assertEqual(rendered, [])
+
+    def test_summary_fields(self):
+        self.assertEqual(
+            diagnostics.format_summary_fields(id='B1', result='matched', isbns=2, formats='Ebook,Hardcover'),
+            'id=B1 result=matched isbns=2 formats=Ebook,Hardcover'
+        )
+        self.assertEqual(diagnostics.format_summary_fields(title='Two words'), 'title="Two words"')
+
+
+class TestEngine(unittest.TestCase):
+
+    def test_source_results_are_merged_with_provenance(self):
+        merged_df = engine.merge_source_results('B1', {
+            'WorldCat': pd.DataFrame({'ISBN': ['9780306406157'], 'Source': ['WorldCat']}),
+            'LibraryCloud': pd.DataFrame({'ID': ['990001'], 'Source': ['Harvard Library']}, index=['B1_990001']),
+            'Other': None
+        })
+        self.assertEqual(merged_df['Lookup_Source'].to_list(), ['WorldCat', 'LibraryCloud'])
+        self.assertEqual(merged_df['Book_ID'].to_list(), ['B1', 'B1'])
+        self.assertEqual(merged_df['Source'].to_list(), ['WorldCat', 'Harvard Library'])
+
+    def test_unknown_sources_are_rejected(self):
+        with self.assertRaises(ValueError):
+            engine.create_adapters(['Nowhere'])
+
+    def test_library_cloud_records_use_worldcat_matcher(self):
+        book_dict = {
+            'ID': 'HEB00001', 'Main Title': 'Walden', 'Subtitle': 'Life in the Woods',
+            'Publisher': 'Ticknor and Fields', 'Copyright Holder': 'Ticknor and Fields'
+        }
+        records_df = pd.DataFrame({
+            'Main Title': ['Walden', 'Cape Cod'],
+            'Subtitle': ['life in the woods', ''],
+            'Publisher': ['Ticknor and Fields', 'Ticknor and Fields']
+        }, index=['HEB00001_990001', 'HEB00001_990002'])
+        match_book_dict, match_records = engine.create_match_inputs(book_dict, records_df)
+        matches = identify.run_checks_and_return_matches(match_book_dict, match_records)
+        self.assertEqual([match_record['Key'] for match_record in matches], ['HEB00001_990001'])
+
+    def test_first_workbook_row_is_skipped_per_source(self):
+        adapters = engine.create_adapters(['WorldCat', 'LibraryCloud'])
+        self.assertEqual([adapter.name for adapter in engine.select_adapters(0, adapters, 'books.xlsx')], ['LibraryCloud'])
+        self.assertEqual(engine.select_adapters(1, adapters, 'books.xlsx'), adapters)
+        self.assertEqual(engine.select_adapters(0, adapters, 'books.csv'), adapters)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_results_keep_input_order(self):
+        stages = [pipeline.Stage('fetch', lambda num: num * 2, 4), pipeline.Stage('parse', lambda num: num + 1, 2)]
+        results = list(pipeline.run_pipeline(range(100), stages, queue_size=2))
+        self.assertEqual(results, [(num, num * 2 + 1) for num in range(100)])
+
+    def test_error_after_earlier_results(self):
+        def fail_on_ten(num):
+            if num == 10:
+                raise ValueError('failed')
+            return num
+        finished = []
+        with self.assertRaises(ValueError):
+            for num, _ in pipeline.run_pipeline(range(20), [pipeline.Stage('fetch', fail_on_ten, 3)]):
+                finished.append(num)
+        self.assertEqual(finished, list(range(10)))
+
+    def test_workers_exit_when_consumer_stops_early(self):
+        stages = [pipeline.Stage('fetch', lambda num: num, 2), pipeline.Stage('parse', lambda num: num, 2)]
+        results = pipeline.run_pipeline(range(1000), stages, queue_size=2)
+        for num, _ in results:
+            if num == 3:
+                break
+        results.close()
+        self.assertEqual([thread for thread in threading.enumerate() if thread.name.startswith('pipeline-')], [])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_prometheus_export(self):
+        registry = metrics.MetricsRegistry()
+        registry.inc('cache_hits_total', store='request_cache')
+        registry.inc('cache_hits_total', store='request_cache')
+        registry.observe('request_latency_seconds', 0.3, endpoint='https://example.org/sru')
+        exposition = registry.to_prometheus()
+        self.assertIn('ebook_ident_cache_hits_total{store="request_cache"} 2', exposition)
+        self.assertIn(
+            'ebook_ident_request_latency_seconds_bucket{endpoint="https://example.org/sru",le="0.5"} 1',
+            exposition
+        )
+        self.assertIn('ebook_ident_request_latency_seconds_bucket{endpoint="https://example.org/sru",le="0.25"} 0', exposition)
+
+    def test_collectors_are_exported(self):
+        registry = metrics.MetricsRegistry()
+        registry.register_collector(lambda: {'comparison_outcomes_total': {(('outcome', 'exact_matches'),): 3}})
+        counters = registry.to_json()['counters']
+        self.assertEqual(counters['comparison_outcomes_total'], [{'labels': {'outcome': 'exact_matches'}, 'value': 3}])
+
+    def test_comparison_total_is_unlabeled(self):
+        compare.COMPARISON_STATS.clear()
+        compare.create_compare_func(["The hound of the Baskervilles"], 85)("Ulysses")
+        counters = metrics.REGISTRY.collect_counters()
+        self.assertEqual(counters['comparisons_total'], {(): 1})
+        self.assertNotIn((('outcome', 'comparisons'),), counters['comparison_outcomes_total'])
+
 
 unittest.main()
\ No newline at end of file